@@ -0,0 +1,43 @@
+import time
+from argparse import ArgumentParser
+from grammar.stage import binary_ops, chain_ops
+from grammar.arrays import numpy, from_values, boxed, elementwise, elements
+from grammar.persistent import Vector
+
+# each operator over two lists of n numbers, one element at a time on persistent vectors
+# against one numpy call on packed arrays
+
+
+def timed(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        value = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    argparser.add_argument('--repeat', type=int, default=5)
+    args = argparser.parse_args()
+
+    if numpy is None:
+        print('numpy is not installed, timing element by element only')
+    ops = [(op, binary_ops[op]) for op in ['+', '-', '*', '/', '^']] + [('<', chain_ops['<'])]
+    for n in args.sizes:
+        left = [i % 7 + 1 for i in range(n)]
+        right = [i % 5 + 1 for i in range(n)]
+        boxed_operands = Vector.from_iterable(left), Vector.from_iterable(right)
+        packed_operands = from_values(left), from_values(right)
+        for name, fn in ops:
+            slow, expected = timed(lambda: boxed(fn, *boxed_operands), args.repeat)
+            if numpy is None:
+                print('n={:<6} {:<2} boxed {:.3f}ms'.format(n, name, slow * 1000))
+                continue
+            fast, value = timed(lambda: elementwise(fn, *packed_operands), args.repeat)
+            print('n={:<6} {:<2} boxed {:.3f}ms, vectorized {:.3f}ms ({:.1f}x){}'.format(
+                n, name, slow * 1000, fast * 1000, slow / fast,
+                '' if list(elements(value)) == list(expected) else ', RESULTS DIFFER'))
@@ -0,0 +1,94 @@
+import io
+import sys
+import time
+import random
+from argparse import ArgumentParser
+from interpreter import op_parser, keywords
+from preprocessor import preprocess
+from grammar.fun import core_parser
+from grammar.stage import Stager, parse_body
+from grammar.schedule import run_program
+from grammar.context import Context
+from grammar.names import NameTable, interning
+from grammar.hashcons import NodeTable, hashconsing
+from grammar.emit import TextEmitter
+
+# kernels like generated code: a handful of terms recombined over and over, and a loop over
+# static coefficients that staging unrolls into the same terms once per coefficient
+
+
+def statements(num_stmts, seed):
+    rand = random.Random(seed)
+    terms = ['(a * x + b)', '(x * x - c)', '(a * b)', '(x + c) * (x - c)']
+    return ['acc = acc + k * {} * {} - {}'.format(*(rand.choice(terms) for _ in range(3)))
+            for i in range(num_stmts)]
+
+
+def generate(num_stmts, seed):
+    lines = ['fun kernel(ks, a, b, c, x)', '    acc = 0', '    for k in ks']
+    lines += ['        ' + stmt for stmt in statements(num_stmts, seed)]
+    lines.append('    acc')
+    return '\n'.join(lines) + '\n'
+
+
+def footprint(value, seen=None):
+    # bytes held by the trees under value, counting each shared object once; spans point into the
+    # source map, which the trees share either way
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(footprint(v, seen) for v in value)
+    elif hasattr(value, '__dict__'):
+        size += sys.getsizeof(value.__dict__)
+        size += sum(footprint(v, seen) for k, v in vars(value).items() if k != 'span')
+    return size
+
+
+def load(source, stager, nodes):
+    with hashconsing(nodes):
+        text, source_map, indent_str = preprocess(source)
+        program = core_parser.parse(text, source_map=source_map, trace=False)
+        run_program(program, Context(op_parser, keywords, None, TextEmitter(io.StringIO()), None, stager))
+
+
+def timed(fn, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        value = fn(i)
+    return (time.perf_counter() - start) / calls, value
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--stmts', type=int, default=20)
+    argparser.add_argument('--coeffs', type=int, default=8)
+    argparser.add_argument('--calls', type=int, default=200)
+    args = argparser.parse_args()
+
+    source = generate(args.stmts, 0)
+    with interning(NameTable()):
+        context = Context(op_parser, keywords)
+        text, source_map, indent_str = preprocess('\n'.join(statements(args.stmts, 0)) + '\n')
+        plain = footprint(parse_body(text, context))
+        nodes = NodeTable()
+        with hashconsing(nodes):
+            shared = footprint(parse_body(text, context))
+        print('kernel body of {} statements: {:.1f}KB as trees, {:.1f}KB hash-consed ({:.1f}x less), '
+              '{} nodes built, {} distinct'.format(args.stmts, plain / 1024, shared / 1024, plain / max(1, shared),
+                                                 nodes.built, len(nodes)))
+
+        ks = tuple(range(1, args.coeffs + 1))
+        results = {}
+        for cse in [False, True]:
+            stager = Stager(cse=cse)
+            load(source, stager, NodeTable() if cse else None)
+            spec = stager.specialize('kernel', {'ks': ks})
+            elapsed, value = timed(lambda i: stager.call(spec.name, [2, 3, 5, i]), args.calls)
+            results[cse] = elapsed, value, len(spec.body)
+        (off, expected, before), (on, value, after) = results[False], results[True]
+        print('specialized over {} coefficients: {} statements, {} with cse; {:.3f}ms a call, {:.3f}ms with cse '
+              '({:.2f}x){}'.format(args.coeffs, before, after, off * 1000, on * 1000, off / on,
+                                   '' if value == expected else ', RESULTS DIFFER'))
@@ -0,0 +1,66 @@
+import gc
+import random
+import tracemalloc
+from argparse import ArgumentParser
+from preprocessor import preprocess
+from grammar.fun import core_parser
+from grammar.model import ModelNode, Identifier, Op
+from grammar.names import NameTable, interning
+
+
+def generate(num_stmts, vocab_size, seed=0):
+    rand = random.Random(seed)
+    names = ['value_{}'.format(i) for i in range(vocab_size)]
+    lines = []
+    for i in range(num_stmts):
+        a, b, c, d = (rand.choice(names) for _ in range(4))
+        lines.append('{} = {} + {} * {} - {}'.format(a, b, c, d, rand.choice(names)))
+    return '\n'.join(lines) + '\n'
+
+
+def leaves(ast, found=None):
+    found = [] if found is None else found
+    if isinstance(ast, (Identifier, Op)):
+        found.append(ast)
+    elif isinstance(ast, (list, tuple)):
+        for elem in ast:
+            leaves(elem, found)
+    elif isinstance(ast, ModelNode):
+        for value in vars(ast).values():
+            leaves(value, found)
+    return found
+
+
+def parse(text, table):
+    gc.collect()
+    tracemalloc.start()
+    if table is None:
+        program = core_parser.parse(text)
+    else:
+        with interning(table):
+            program = core_parser.parse(text)
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return program, retained
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--stmts', type=int, default=2000)
+    argparser.add_argument('--vocab', type=int, default=50)
+    args = argparser.parse_args()
+
+    text, source_map, indent_str = preprocess(generate(args.stmts, args.vocab))
+
+    plain, plain_bytes = parse(text, None)
+    table = NameTable()
+    interned, interned_bytes = parse(text, table)
+
+    plain_names = [node.name for node in leaves(plain) if isinstance(node, Identifier)]
+    interned_nodes = [node for node in leaves(interned) if isinstance(node, Identifier)]
+    print('identifiers: {}, distinct string objects: plain {}, interned {}'.format(
+        len(plain_names), len({id(n) for n in plain_names}), len({id(n.name) for n in interned_nodes})))
+    print('retained AST memory: plain {:.1f} KiB, interned {:.1f} KiB ({:.1%})'.format(
+        plain_bytes / 1024, interned_bytes / 1024, interned_bytes / plain_bytes))
+
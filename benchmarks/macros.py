@@ -0,0 +1,84 @@
+import io
+import time
+import random
+from argparse import ArgumentParser
+from interpreter import op_parser, keywords
+from preprocessor import preprocess
+from grammar.fun import core_parser, body_parser, parse_stmt
+from grammar.macros import Expander, unquoted, hole
+from grammar.schedule import run_program
+from grammar.context import Context
+from grammar.names import NameTable, interning
+from grammar.emit import TextEmitter
+
+# a few macros, some built from others, called from many sites with a handful of distinct
+# arguments, as generated code does. the naive way substitutes argument text into the macro's
+# text and parses the result at every site
+
+macros = [
+    ('square', ['x'], ['&x * &x']),
+    ('lerp', ['a', 'b', 't'], ['&a + (&b - &a) * &t']),
+    ('norm', ['x', 'y'], ['square(&x) + square(&y)']),
+    ('clamp', ['x', 'lo', 'hi'], ['min(max(&x, &lo), &hi)']),
+    ('swap', ['a', 'b'], ['tmp = &a', '&a = &b', '&b = tmp']),
+]
+
+
+def generate(sites, distinct, seed):
+    rand = random.Random(seed)
+    args = ['a', 'b + 1', 'c * d', 'e - f / 2', '(g + h) * i'][:distinct]
+    lines = []
+    for name, params, body in macros:
+        lines += ['macro {}({})'.format(name, ', '.join(params))] + ['    ' + stmt for stmt in body] + ['']
+    for i in range(sites):
+        name, params, body = rand.choice(macros)
+        call = '{}({})'.format(name, ', '.join(rand.choice(args) if name != 'swap' else rand.choice('pqrs')
+                                               for p in params))
+        lines.append(call if name == 'swap' else 'v{} = {}'.format(i, call))
+    return '\n'.join(lines) + '\n'
+
+
+def parse(source):
+    text, source_map, indent_str = preprocess(source)
+    return core_parser.parse(text, source_map=source_map, trace=False)
+
+
+def run(program, expander):
+    out = io.StringIO()
+    start = time.perf_counter()
+    run_program(program, Context(op_parser, keywords, None, TextEmitter(out), None, None, expander))
+    return time.perf_counter() - start, out.getvalue()
+
+
+class Reparsing(Expander):
+    # parses the macro's text with the arguments pasted in at every call
+    def define(self, name, params, body, context):
+        super().define(name, params, body, context)
+        self.macros[name].text = unquoted(body)
+
+    def expand(self, call, context):
+        macro = self.macros[call.expr.name]
+        lexemes = [call.contents.element_lexemes(i) for i in range(call.contents.num_elements())]
+        args = {param: ' '.join(l) if len(l) == 1 else '( {} )'.format(' '.join(l))
+                for param, l in zip(macro.params, lexemes)}
+        text = hole.sub(lambda m: args[m.group(1)], macro.text)
+        return [s for stmt in body_parser.parse(text, trace=False) for s in parse_stmt(stmt, context)]
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--sites', type=int, default=200)
+    argparser.add_argument('--distinct', type=int, default=3, help='distinct arguments at the call sites')
+    args = argparser.parse_args()
+
+    with interning(NameTable()):
+        program = parse(generate(args.sites, args.distinct, 0))
+        naive, expected = run(program, Reparsing())
+        print('{} call sites, {} distinct arguments'.format(args.sites, args.distinct))
+        print('re-parsing the macro text at each site: {:.1f}ms'.format(naive * 1000))
+        for memoize in [False, True]:
+            expander = Expander(memoize=memoize)
+            elapsed, output = run(program, expander)
+            print('{}: {:.1f}ms, {:.1f}x faster ({} expansions, {} from the memo){}'.format(
+                'filled templates, memoized' if memoize else 'filled templates', elapsed * 1000, naive / elapsed,
+                expander.misses + expander.hits, expander.hits, '' if output == expected else ', OUTPUT DIFFERS'))
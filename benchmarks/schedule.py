@@ -0,0 +1,41 @@
+import io
+import os
+import time
+from argparse import ArgumentParser
+from interpreter import interpret
+from grammar.emit import TextEmitter
+
+
+def generate(num_funs, body_len):
+    lines = []
+    for i in range(num_funs):
+        lines.append('fun f{}(a, b)'.format(i))
+        for j in range(body_len):
+            lines.append('    a * {} + b / (a - {}) ^ 2'.format(j, i))
+        lines.append('    g(a, b)')
+        lines.append('x{} = f{}(1, 2)'.format(i, i))
+    return '\n'.join(lines) + '\n'
+
+
+def run(text, jobs):
+    out = io.StringIO()
+    start = time.perf_counter()
+    interpret(text, TextEmitter(out), jobs)
+    return time.perf_counter() - start, out.getvalue()
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--funs', type=int, default=200)
+    argparser.add_argument('--body', type=int, default=10)
+    argparser.add_argument('-j', '--jobs', type=int, nargs='+', default=[2, 4, os.cpu_count()])
+    args = argparser.parse_args()
+
+    text = generate(args.funs, args.body)
+    base, expected = run(text, None)
+    print('{} functions x {} statements'.format(args.funs, args.body))
+    print('sequential: {:.2f}s'.format(base))
+    for jobs in args.jobs:
+        elapsed, output = run(text, jobs)
+        print('{} jobs: {:.2f}s ({:.2f}x){}'.format(
+            jobs, elapsed, base / elapsed, '' if output == expected else ' OUTPUT DIFFERS'))
@@ -0,0 +1,58 @@
+import io
+import os
+import time
+import tempfile
+from argparse import ArgumentParser
+from interpreter import interpret_module
+from modules import ModuleLoader
+from snapshots import SnapshotCache
+from grammar.emit import make_emitter
+
+# a large prelude of functions and specializations, imported by a small program: the first run
+# runs the prelude and saves a snapshot, later runs start from it
+
+
+def prelude(num_funs):
+    lines = []
+    for i in range(num_funs):
+        lines += ['fun f{}(coeffs, x)'.format(i), '    acc = {}'.format(i), '    for c in coeffs',
+                  '        acc = acc * x + c', '    acc', '',
+                  'specialize f{}'.format(i), '    coeffs = (1, 2, {})'.format(i), '']
+    return '\n'.join(lines)
+
+
+def main(num_funs):
+    return 'import prelude\n\nfun main(x)\n    f0((1, 2, 3), x) + f{}((4, 5), x)\n\nspecialize main\n    x = 2\n'.format(
+        num_funs - 1)
+
+
+def run(fnm, snapshots):
+    out = io.StringIO()
+    start = time.perf_counter()
+    modules = interpret_module(fnm, make_emitter('text', out), loader=ModuleLoader(), snapshots=snapshots)
+    return time.perf_counter() - start, out.getvalue(), modules
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--funs', type=int, default=100)
+    argparser.add_argument('--runs', type=int, default=3)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'prelude.on'), 'w') as f:
+            f.write(prelude(args.funs))
+        fnm = os.path.join(root, 'main.on')
+        with open(fnm, 'w') as f:
+            f.write(main(args.funs))
+        snapshots = SnapshotCache(os.path.join(root, 'snapshots'))
+
+        cold, expected, modules = run(fnm, None)
+        print('prelude of {} functions, no snapshot: {:.1f}ms (prelude {:.1f}ms parse, {:.1f}ms run)'.format(
+            args.funs, cold * 1000, modules[0].parse_time * 1000, modules[0].run_time * 1000))
+        saving, output, modules = run(fnm, snapshots)
+        print('saving the snapshot: {:.1f}ms{}'.format(saving * 1000, '' if output == expected else ', OUTPUT DIFFERS'))
+        for i in range(args.runs):
+            elapsed, output, modules = run(fnm, snapshots)
+            print('from the snapshot ({}): {:.1f}ms, {:.1f}x faster{}'.format(
+                modules[0].status, elapsed * 1000, cold / elapsed, '' if output == expected else ', OUTPUT DIFFERS'))
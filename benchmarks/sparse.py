@@ -0,0 +1,93 @@
+import io
+import os
+import random
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from interpreter import interpret
+from grammar.emit import TextEmitter
+from grammar.cgen import SourceWriter, c_array, c_number
+from grammar.sparse import dense_kernel
+
+harness = '''
+static double now(void) {{
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + t.tv_nsec * 1e-9;
+}}
+
+int main(void) {{
+    int m = {m}, l = {l}, n = {n}, reps = {reps};
+    double *B = malloc(sizeof(double) * l * n);
+    double *C = malloc(sizeof(double) * m * n);
+    double *D = malloc(sizeof(double) * m * n);
+    unsigned s = 12345;
+    for (int i = 0; i < l * n; i++) {{
+        s = s * 1103515245 + 12345;
+        B[i] = (double)(s >> 16 & 0x7fff) / 0x7fff - 0.5;
+    }}
+    double start = now();
+    for (int r = 0; r < reps; r++)
+        kernel(B, C, n);
+    double generated = now() - start;
+    start = now();
+    for (int r = 0; r < reps; r++)
+        dense(A, B, D, m, l, n);
+    double reference = now() - start;
+    double diff = 0.0;
+    for (int i = 0; i < m * n; i++)
+        diff = fmax(diff, fabs(C[i] - D[i]));
+    printf("%.9e %.9e %g\\n", generated / reps, reference / reps, diff);
+    return 0;
+}}
+'''
+
+
+def generate(rows, cols, density, seed=0):
+    r = random.Random(seed)
+    return [[r.choice([-3, -2, -1, 1, 2, 3]) if r.random() < density else 0 for j in range(cols)]
+            for i in range(rows)]
+
+
+def source(matrix):
+    lines = ['sparse kernel(B, C, n)']
+    lines += ['    ' + ' '.join(str(v) for v in row) for row in matrix]
+    return '\n'.join(lines) + '\n'
+
+
+def build(matrix, n, reps, fnm):
+    with open(fnm, 'w') as f:
+        f.write('#include <math.h>\n#include <stdio.h>\n#include <stdlib.h>\n#include <time.h>\n\n')
+        code = SourceWriter(f)
+        interpret(source(matrix), TextEmitter(io.StringIO()), code=code)
+        code.line(c_array('double', 'A', [c_number(v) for row in matrix for v in row]))
+        dense_kernel(code, 'dense')
+        code.line(harness.format(m=len(matrix), l=len(matrix[0]), n=n, reps=reps))
+        code.close()
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--rows', type=int, default=128)
+    argparser.add_argument('--cols', type=int, default=128)
+    argparser.add_argument('--n', type=int, default=512, help='columns of the runtime matrix')
+    argparser.add_argument('--density', type=float, nargs='+', default=[0.01, 0.05, 0.2, 0.5])
+    argparser.add_argument('--reps', type=int, default=50)
+    argparser.add_argument('--cc', default=os.environ.get('CC', 'cc'))
+    argparser.add_argument('--cflags', default='-O2')
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print('{}x{} fixed matrix times {}x{}, {}'.format(args.rows, args.cols, args.cols, args.n, args.cflags))
+        for density in args.density:
+            c_fnm = os.path.join(tmp, 'kernel.c')
+            exe = os.path.join(tmp, 'kernel')
+            build(generate(args.rows, args.cols, density), args.n, args.reps, c_fnm)
+            subprocess.run([args.cc] + args.cflags.split() + [c_fnm, '-o', exe, '-lm'], check=True)
+            generated, reference, diff = subprocess.run([exe], check=True, capture_output=True,
+                                                        text=True).stdout.split()
+            generated, reference = float(generated), float(reference)
+            # a kernel can run faster than the clock ticks, and time as zero
+            speedup = 'n/a' if generated == 0 else '{:.1f}x'.format(reference / generated)
+            print('density {:.2f}: generated {:.4f}ms, dense {:.4f}ms ({}), max difference {}'.format(
+                density, generated * 1000, reference * 1000, speedup, diff))
@@ -0,0 +1,72 @@
+import io
+import time
+from argparse import ArgumentParser
+from interpreter import op_parser, keywords
+from preprocessor import preprocess
+from grammar.fun import core_parser
+from grammar.stage import Stager
+from grammar.schedule import run_program
+from grammar.context import Context
+from grammar.names import NameTable, interning
+from grammar.emit import TextEmitter
+
+source = '''
+fun poly(coeffs, x)
+    acc = 0
+    p = 1
+    for c in coeffs
+        acc = acc + c * p
+        p = p * x
+    acc
+
+fun power(x, n)
+    r = 1
+    for i in range(n)
+        r = r * x
+    r
+'''
+
+
+def load(stager):
+    text, source_map, indent_str = preprocess(source)
+    program = core_parser.parse(text, source_map=source_map, trace=False)
+    run_program(program, Context(op_parser, keywords, None, TextEmitter(io.StringIO()), None, stager))
+
+
+def timed(fn, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        value = fn(i)
+    return (time.perf_counter() - start) / calls, value
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--degree', type=int, default=12)
+    argparser.add_argument('--calls', type=int, default=200)
+    args = argparser.parse_args()
+
+    with interning(NameTable()):
+        stager = Stager()
+        load(stager)
+        coeffs = tuple(range(args.degree + 1))
+        cases = [('poly', 'coeffs', coeffs, lambda i: [coeffs, i]),
+                 ('power', 'n', args.degree, lambda i: [i, args.degree])]
+        for name, param, static, generic_args in cases:
+            start = time.perf_counter()
+            spec = stager.specialize(name, {param: static})
+            cost = time.perf_counter() - start
+            generic, expected = timed(lambda i: stager.call(name, generic_args(i)), args.calls)
+            # the residual body run through the staging evaluator, then as typed code
+            residual, value = timed(lambda i: stager.stage(spec.body, {spec.params[0]: i}, spec.fun.context)[1],
+                                    args.calls)
+            typed, typed_value = timed(lambda i: stager.call(spec.name, [i]), args.calls)
+            covered, total = stager.infer(spec, ['int']).coverage()
+            print('{}: generic {:.3f}ms, specialized {:.3f}ms ({:.1f}x), typed {:.3f}ms ({:.1f}x)'.format(
+                spec.name, generic * 1000, residual * 1000, generic / residual, typed * 1000, generic / typed))
+            print('    {} residual statements staged once in {:.2f}ms, {} of {} expressions typed{}'.format(
+                len(spec.body), cost * 1000, covered, total,
+                '' if value == expected == typed_value else ', RESULTS DIFFER'))
+        for i in range(args.calls):
+            stager.specialize('power', {'n': args.degree})
+        print('cache: {} hits, {} misses'.format(stager.hits, stager.misses))
@@ -0,0 +1,53 @@
+import io
+import sys
+import time
+import random
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from interpreter import interpret
+from grammar.emit import make_emitter
+
+
+def generate(num_stmts, seed):
+    # a fun with a loop and some arithmetic per source, so each thread parses, folds operators and emits
+    rand = random.Random(seed)
+    names = ['v{}'.format(i) for i in range(8)]
+    lines = ['fun f{}(x, y)'.format(seed), '    for i in range(x)', '        y = y + i * x', '    y']
+    for i in range(num_stmts):
+        a, b, c, d = (rand.choice(names) for _ in range(4))
+        lines.append('{} = {} + {} * ({} - {}) / 2'.format(a, b, c, d, rand.randint(0, 9)))
+    return '\n'.join(lines) + '\n'
+
+
+def run(text):
+    out = io.StringIO()
+    interpret(text, make_emitter('text', out))
+    return out.getvalue()
+
+
+def throughput(sources, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        outputs = list(pool.map(run, sources))
+    return time.perf_counter() - start, outputs
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--sources', type=int, default=16)
+    argparser.add_argument('--stmts', type=int, default=40)
+    argparser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = argparser.parse_args()
+
+    sources = [generate(args.stmts, seed) for seed in range(args.sources)]
+    expected = [run(text) for text in sources]
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('{} sources of {} statements, {}'.format(
+        args.sources, args.stmts, 'GIL enabled' if gil else 'free-threaded'))
+    base = None
+    for threads in args.threads:
+        elapsed, outputs = throughput(sources, threads)
+        base = elapsed if base is None else base
+        print('{} threads: {:.2f}s, {:.1f} sources/s ({:.2f}x){}'.format(
+            threads, elapsed, len(sources) / elapsed, base / elapsed,
+            '' if outputs == expected else ', OUTPUT DIFFERS'))
@@ -0,0 +1,42 @@
+import time
+from argparse import ArgumentParser
+from grammar.fun import body_parser
+from grammar.persistent import Vector, HashMap, destructure
+from grammar.unpack import plan_for
+
+cases = [
+    ('(a, b)', (1, 2)),
+    ('(a, (b, (c, d)), e)', (1, (2, (3, 4)), 5)),
+    ('[a, b:rest]', Vector.from_iterable(range(10))),
+    ('{1 -> v}', HashMap.from_pairs([(1, 'one'), (2, 'two')])),
+    ('{k -> v}', HashMap.from_pairs([('key', 1)])),
+]
+
+
+def timed(fn, reps, seconds):
+    # stops early once seconds have passed, since naive map keys are re-parsed every time
+    start = time.perf_counter()
+    for i in range(reps):
+        fn()
+        if time.perf_counter() - start > seconds:
+            break
+    return (time.perf_counter() - start) / (i + 1)
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--reps', type=int, default=100000)
+    argparser.add_argument('--seconds', type=float, default=1.0, help='time limit for each measurement')
+    args = argparser.parse_args()
+
+    for text, value in cases:
+        stmt = body_parser.parse('{} = value#[ENDL]#'.format(text))[0]
+        env = {}
+        start = time.perf_counter()
+        plan = plan_for(stmt)
+        compiled = time.perf_counter() - start
+        naive = timed(lambda: destructure(stmt.name, value, env), args.reps, args.seconds)
+        planned = timed(lambda: plan.run(value, env), args.reps, args.seconds)
+        same = destructure(stmt.name, value) == dict((name, env[name]) for name in env)
+        print('{:<22} naive {:.2f}us, plan {:.2f}us ({:.1f}x), compiled once in {:.0f}us{}'.format(
+            text, naive * 1e6, planned * 1e6, naive / planned, compiled * 1e6, '' if same else ', BINDINGS DIFFER'))
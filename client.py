@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import socket
+import struct
+from argparse import ArgumentParser
+
+# kept free of tatsu and grammar imports so the client starts fast
+
+RUN = b'r'
+HEALTH = b'h'
+OUT = b'o'
+ERR = b'e'
+EXIT = b'x'
+
+header = struct.Struct('!cI')
+
+
+def default_socket():
+    return os.environ.get('OBSIDIAN_SOCKET', '/tmp/obsidian-{}.sock'.format(os.getuid()))
+
+
+def read_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def send_frame(sock, kind, payload=b''):
+    sock.sendall(header.pack(kind, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    head = read_exact(sock, header.size)
+    if head is None:
+        return None, None
+    kind, size = header.unpack(head)
+    payload = read_exact(sock, size) if size > 0 else b''
+    if payload is None:
+        return None, None
+    return kind, payload
+
+
+class FrameWriter:
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+
+    def write(self, text):
+        if text:
+            send_frame(self.sock, self.kind, text.encode())
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def request(kind, payload=b'', path=None, out=sys.stdout, err=sys.stderr):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(default_socket() if path is None else path)
+    try:
+        send_frame(sock, kind, payload)
+        sock.shutdown(socket.SHUT_WR)
+        while True:
+            kind, payload = recv_frame(sock)
+            if kind is None:
+                raise Exception('Server closed the connection without an exit status')
+            elif kind == OUT:
+                out.write(payload.decode())
+                out.flush()
+            elif kind == ERR:
+                err.write(payload.decode())
+                err.flush()
+            elif kind == EXIT:
+                return int(payload.decode())
+    finally:
+        sock.close()
+
+
+def health(path=None):
+    lines = []
+
+    class Collect:
+        def write(self, text):
+            lines.append(text)
+
+        def flush(self):
+            pass
+
+    request(HEALTH, path=path, out=Collect())
+    return json.loads(''.join(lines))
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('fnm', nargs='?', help='filename to interpret on the server')
+    argparser.add_argument('--socket', default=None, help='path of the server socket')
+    argparser.add_argument('--health', action='store_true', help='print the server status and exit')
+    argparser.add_argument('-I', '--path', action='append', default=[], help='directory to search for imports')
+    args = argparser.parse_args()
+
+    if args.health:
+        print(json.dumps(health(args.socket), indent=2))
+        sys.exit(0)
+    if args.fnm is None:
+        argparser.error('a filename is required unless --health is given')
+    # the server reads the file itself, so its imports are found next to it
+    run = {'fnm': os.path.abspath(args.fnm), 'path': [os.path.abspath(p) for p in args.path]}
+    sys.exit(request(RUN, json.dumps(run).encode(), path=args.socket))
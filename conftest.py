@@ -0,0 +1 @@
+# makes pytest put the repository root on sys.path, so tests import the interpreter
@@ -0,0 +1,127 @@
+from .persistent import Vector, Slice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# list literals whose elements are all ints, or all floats, are packed into numpy arrays when numpy
+# is installed, and arithmetic and comparisons on them run over the whole array at once. anything
+# else, mixed ints and floats included, stays a persistent vector, and operators on it go an
+# element at a time, so a list's elements are the same with or without numpy
+
+array_types = () if numpy is None else (numpy.ndarray,)
+lists = (Vector, Slice) + array_types
+int64 = (-2 ** 63, 2 ** 63 - 1)
+# int results at least this large might have wrapped, so they are worked out boxed instead
+int_bound = 2.0 ** 62
+
+
+def is_array(value):
+    return isinstance(value, array_types)
+
+
+def is_list(value):
+    return isinstance(value, lists)
+
+
+def packed(values):
+    # the dtype values pack into, or None when they have to stay boxed
+    if numpy is None or len(values) == 0:
+        return None
+    if all(type(v) is float for v in values):
+        return numpy.float64
+    if all(type(v) is int and int64[0] <= v <= int64[1] for v in values):
+        return numpy.int64
+    return None
+
+
+def from_values(values):
+    values = list(values)
+    dtype = packed(values)
+    if dtype is None:
+        return Vector.from_iterable(values)
+    return numpy.array(values, dtype=dtype)
+
+
+def scalar(value):
+    # numpy's scalars back to python's, so they reify and print like any other number
+    if numpy is not None and isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+def elements(value):
+    return value.tolist() if is_array(value) else value
+
+
+def negate(value):
+    # -(-2 ** 63) wraps in int64
+    if is_array(value) and not (value.dtype.kind == 'i' and (value == int64[0]).any()):
+        return -value
+    return from_values(-v for v in elements(value))
+
+
+def broadcast(value, length):
+    if is_list(value):
+        if len(value) != length:
+            raise Exception('Cannot combine lists of lengths {} and {}'.format(length, len(value)))
+        return elements(value)
+    return [value] * length
+
+
+def boxed(fn, left, right):
+    # one element at a time, for lists with something other than numbers in them
+    length = len(left) if is_list(left) else len(right)
+    return from_values(fn(a, b) for a, b in zip(broadcast(left, length), broadcast(right, length)))
+
+
+def floats(value):
+    return value.astype(numpy.float64) if is_array(value) else float(value)
+
+
+def wrapped(fn, left, right, result):
+    # int64 arithmetic wraps around without an error, so an int result is checked against the same
+    # operation on floats, which overflow to inf rather than wrap
+    if not is_array(result) or result.dtype.kind != 'i':
+        return False
+    with numpy.errstate(all='ignore'):
+        approx = fn(floats(left), floats(right))
+    return not (numpy.abs(approx) < int_bound).all()
+
+
+def vectorized(fn, left, right):
+    # arrays with arrays or plain numbers in one numpy call. errors numpy would turn into infs or
+    # nans raise instead, and ints that would wrap go the boxed way, so they fail or grow as they
+    # would on plain numbers
+    if all(is_array(v) or type(v) in (int, float) for v in (left, right)):
+        if is_array(left) and is_array(right) and len(left) != len(right):
+            raise Exception('Cannot combine lists of lengths {} and {}'.format(len(left), len(right)))
+        try:
+            with numpy.errstate(all='raise'):
+                result = fn(left, right)
+            if not wrapped(fn, left, right, result):
+                return result
+        except (FloatingPointError, OverflowError, ValueError):
+            pass
+    return boxed(fn, left, right)
+
+
+def elementwise(fn, left, right):
+    if is_array(left) or is_array(right):
+        return vectorized(fn, left, right)
+    return boxed(fn, left, right)
+
+
+def compare(fns, operands):
+    # a chain of comparisons holds where every link in it holds, element by element
+    result = None
+    for i, fn in enumerate(fns):
+        link = elementwise(fn, operands[i], operands[i + 1])
+        if result is None:
+            result = link
+        elif is_array(result) and is_array(link):
+            result = numpy.logical_and(result, link)
+        else:
+            result = boxed(lambda a, b: a and b, result, link)
+    return result
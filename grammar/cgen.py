@@ -0,0 +1,50 @@
+import math
+from contextlib import contextmanager
+
+
+class SourceWriter:
+    # C source is buffered a line at a time and written out every flush_every lines,
+    # so large generated kernels stream to the sink instead of piling up as one string
+    def __init__(self, sink, indent='    ', flush_every=1024):
+        self.sink = sink
+        self.indent = indent
+        self.flush_every = flush_every
+        self.depth = 0
+        self.buffer = []
+
+    def line(self, text=''):
+        self.buffer.append('{}{}\n'.format(self.indent * self.depth, text) if text else '\n')
+        if self.flush_every is not None and len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def lines(self, texts):
+        for text in texts:
+            self.line(text)
+
+    @contextmanager
+    def block(self, header):
+        self.line('{} {{'.format(header))
+        self.depth += 1
+        yield
+        self.depth -= 1
+        self.line('}')
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.sink.write(''.join(self.buffer))
+            self.buffer = []
+        self.sink.flush()
+
+    def close(self):
+        self.flush()
+
+
+def c_number(value):
+    value = float(value)
+    if not math.isfinite(value):
+        raise Exception('Cannot write {} as a C constant'.format(value))
+    return repr(value)
+
+
+def c_array(ctype, name, values):
+    return 'static const {} {}[{}] = {{{}}};'.format(ctype, name, len(values), ', '.join(values))
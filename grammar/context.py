@@ -1,7 +1,12 @@
 
 class Context:
-    def __init__(self, op_parser, keywords):
+    def __init__(self, op_parser, keywords, names=None, emitter=None, code=None, stager=None, macros=None):
         self.op_parser = op_parser
         self.keywords = keywords
+        self.names = names
+        self.emitter = emitter
+        self.code = code
+        self.stager = stager
+        self.macros = macros
 
 
@@ -16,7 +16,7 @@ for flag in ['indent', 'dedent', 'endl']:
 simple_atoms = [
     ('identifier', Regex('[_a-zA-Z][_a-zA-Z0-9]*[?!]?'), Identifier),
     ('int', Regex('[0-9]+'), Int),
-    ('float', Regex('([0-9]+)|([0-9]+\.[0-9]*)|(\.[0-9]+)'), Float),
+    ('float', Regex(r'(?:[0-9]+\.[0-9]*)|(?:\.[0-9]+)'), Float),
     ('char', Regex(r"'([^'\\]|\\.)'"), Char),
     ('string', Regex(r'"([^"\\]|\\.)*"'), String),
 ]
@@ -29,8 +29,9 @@ core_grammar.add_rule('symbol', [Literal('~'), ('@', Regex('[a-zA-Z][a-zA-Z0-9]*
 
 atoms = [Name(name) for name in [
     'identifier',
-    'int',
+    # float first, or the int rule takes the digits before the point
     'float',
+    'int',
     'char',
     'string',
     'symbol',
@@ -57,15 +58,17 @@ for left, right in [('[', ']'), ('{', '}')]:
     collections.append(wrap(left, [Cut(), ('contents', Name('chunk'))], right, label='surrounder'))
 core_grammar.add_rule('collection', *collections, semantics=collection)
 
-core_grammar.add_rule('op', Regex('[-@$%^&*+~<>/:][-@$%^&*+<>/=:]*'), semantics=Op)
+core_grammar.add_rule('op', Regex('[-@$%^&*+~<>/:][-@$%^&*+<>/=:]*|[=!]=[-@$%^&*+<>/=:]*'), semantics=Op)
 
 core_grammar.add_rule('atomexpr',
     Name('trailerexpr'),
     Name('atom'),
-    wrap('(', [('@', Name('expr'))], ')')
+    wrap('(', [('@', Name('expr'))], ')'),
+    Name('tuple'),
+    Name('collection'),
 )
 
-core_grammar.add_rule('unaryexpr', [('op', Or(Literal('!'), Literal('-')))],
+core_grammar.add_rule('unaryexpr', [('op', Or(Literal('!'), Literal('-'))), ('expr', Name('unaryexpr'))],
                       ('subexpr', Name('atomexpr')), semantics=unaryexpr)
 core_grammar.add_rule('binaryexpr', PosJoin(Name('op'), Name('unaryexpr')), semantics=binaryexpr)
 core_grammar.add_rule('expr', Name('binaryexpr'))
@@ -74,7 +77,8 @@ core_grammar.add_rule('expr', Name('binaryexpr'))
 # core_grammar.add_rule('surrounder', *surrounders)
 core_grammar.add_rule('separator', Literal(',',), Literal(';'))
 
-core_grammar.add_rule('lexeme', Name('atom'), Name('op'), Name('separator'), semantics=lexeme)
+# chunks also take a lone '=', so block bodies can hold assignments
+core_grammar.add_rule('lexeme', Name('atom'), Name('op'), Literal('='), Name('separator'), semantics=lexeme)
 core_grammar.add_rule('bundle', PosClosure(Name('lexeme')))
 core_grammar.add_rule('chunk', PosClosure(Or(Name('surrounded'), Name('bundle'))), semantics=chunk)
 
@@ -86,6 +90,7 @@ core_grammar.add_rule('surrounded', *surroundeds, semantics=surrounded)
 core_grammar.add_rule('chunkstmt', [('chunk', Optional(Name('chunk'))), ('endl', Name('endl'))], semantics=chunkstmt)
 core_grammar.add_rule('block', [
     ('keyword', Name('identifier')),
+    NegativeLookahead(Literal('=')),
     ('header', Optional(Name('chunk'))),
     Name('endl'), Name('indent'), Cut(),
     ('body', PosClosure(Or(Name('block'), Name('chunkstmt')))),
@@ -112,7 +117,7 @@ core_grammar.add_rule('collectiontarget', Name('collection'), semantics=collecti
 
 core_grammar.add_rule('assignment', [
     ('target', Name('target')),
-    Literal('='), Cut(),
+    Literal('='), NegativeLookahead(Literal('=')), Cut(),
     ('expr', Name('expr')),
     Name('endl'),
 ], semantics=assignment)
@@ -126,3 +131,12 @@ core_grammar.add_rule('stmt',
     [('@', Name('expr')), Name('endl')])
 
 core_grammar.add_rule('stmtlist', Closure(Name('stmt')), semantics=stmtlist)
+
+core_grammar.add_rule('signature', [('name', Name('identifier')), ('params', Name('params'))])
+core_grammar.add_rule('params', wrap('(', [Gather(Literal(','), Name('identifier'))], ')'))
+
+core_grammar.add_start('stmtlist')
+core_grammar.add_start('signature')
+core_grammar.add_start('expr')
+core_grammar.add_start('block')
+core_grammar.add_start('chunkstmt')
@@ -0,0 +1,177 @@
+import re
+from collections import Counter
+from .model import *
+from .operators import BinaryExpr, ChainExpr
+from .hashcons import NodeTable
+
+# common subexpression elimination over a straight-line body: a pure expression met more than once,
+# with nothing it reads assigned in between, is computed once into a temporary before its first use,
+# unless something that might have effects runs before that use in its statement. the body is
+# hash-consed first, so equal expressions are the same node and compare by identity
+
+pure = (BinaryExpr, UnaryExpr, ChainExpr, Index)
+constants = (Int, Float, String, Char, Symbol)
+# the right side of these only runs sometimes, so nothing in it is hoisted
+lazy = ['&&', '||']
+name = re.compile(r'[_a-zA-Z][_a-zA-Z0-9]*')
+
+
+def children(node):
+    # the nodes node evaluates, in order
+    if isinstance(node, BinaryExpr):
+        return [node.left] if str(node.op) in lazy else [node.left, node.right]
+    elif isinstance(node, UnaryExpr):
+        return [node.expr]
+    elif isinstance(node, ChainExpr):
+        return list(node.elems[::2])
+    elif isinstance(node, Index):
+        return [node.expr, node.index]
+    elif isinstance(node, Tuple):
+        return list(node.contents)
+    elif isinstance(node, Call):
+        return list(node.args)
+    return []
+
+
+def effects(node):
+    # whether evaluating node, once its children are evaluated, might do more than compute a value
+    return not isinstance(node, pure + constants + (Identifier, Tuple))
+
+
+def rebuild(node, kids):
+    if all(a is b for a, b in zip(kids, children(node))):
+        return node
+    if isinstance(node, BinaryExpr):
+        return BinaryExpr(node.op, kids[0], kids[1] if len(kids) > 1 else node.right)
+    elif isinstance(node, UnaryExpr):
+        return node.spanned(UnaryExpr(node.op, kids[0]))
+    elif isinstance(node, ChainExpr):
+        elems = list(node.elems)
+        elems[::2] = kids
+        return ChainExpr(elems)
+    elif isinstance(node, Index):
+        return node.spanned(Index(kids[0], kids[1]))
+    elif isinstance(node, Tuple):
+        return node.spanned(Tuple(kids))
+    return node.spanned(Call(node.fn, kids))
+
+
+class Eliminator:
+    def __init__(self, stmts):
+        self.table = NodeTable()
+        # every name the body mentions, so temporaries don't take one
+        self.taken = set(name.findall(' '.join('{} {}'.format(s, getattr(s, 'body', '')) for s in stmts)))
+        self.temps = 0
+        # id(node) -> the names a shared node reads, or None if it isn't pure
+        self.names = {}
+
+    def reads(self, node):
+        if id(node) not in self.names:
+            if isinstance(node, Identifier):
+                names = frozenset([node.name])
+            elif isinstance(node, constants):
+                names = frozenset()
+            elif isinstance(node, pure):
+                kids = [self.reads(k) for k in children(node)]
+                if isinstance(node, BinaryExpr) and str(node.op) in lazy:
+                    kids.append(self.reads(node.right))
+                names = None if None in kids else frozenset().union(*kids)
+            else:
+                names = None
+            self.names[id(node)] = names
+        return self.names[id(node)]
+
+    def temp(self):
+        while True:
+            temp = 'cse{}'.format(self.temps)
+            self.temps += 1
+            if temp not in self.taken:
+                return temp
+
+    def each(self, stmts, fn, nested):
+        # calls fn on each statement's expressions with the key an expression has at that point,
+        # and returns the statements rebuilt from what fn returns
+        versions = {}
+        epoch = [0]
+
+        def key(node):
+            return (id(node), epoch[0], tuple((n, versions.get(n, 0)) for n in sorted(self.reads(node))))
+
+        out = []
+        for stmt in stmts:
+            if isinstance(stmt, Assignment):
+                expr = fn(stmt.expr, key, out)
+                out.append(stmt if expr is stmt.expr else stmt.spanned(Assignment(stmt.name, expr)))
+                if isinstance(stmt.name, Identifier):
+                    versions[stmt.name.name] = versions.get(stmt.name.name, 0) + 1
+                else:
+                    epoch[0] += 1
+            elif isinstance(stmt, Loop):
+                # whatever the loop assigns, nothing from before it is reused after it
+                out.append(Loop(stmt.var, fn(stmt.iterable, key, out), nested(stmt.body)))
+                epoch[0] += 1
+            elif isinstance(stmt, Block):
+                out.append(stmt)
+                epoch[0] += 1
+            else:
+                out.append(fn(stmt, key, out))
+        return out
+
+    def candidate(self, node):
+        return isinstance(node, pure) and self.reads(node) is not None
+
+    def count(self, node, key, counts):
+        if self.candidate(node):
+            counts[key(node)] += 1
+        for kid in children(node):
+            self.count(kid, key, counts)
+        return node
+
+    def use(self, node, key, counts, uses, seen, effected):
+        # the uses left once repeated expressions are hoisted: inside a repeated expression only
+        # its first occurrence is evaluated, and one after an effect can't be the one hoisted
+        if self.candidate(node) and counts[key(node)] > 1:
+            k = key(node)
+            if k in seen:
+                uses[k] += 1
+                return node
+            if not effected[0]:
+                uses[k] += 1
+                seen.add(k)
+        for kid in children(node):
+            self.use(kid, key, counts, uses, seen, effected)
+        if effects(node):
+            effected[0] = True
+        return node
+
+    def rewrite(self, node, key, hoisted, temps, out, effected):
+        # effected is set once something in the statement that might have effects has run, and
+        # nothing after it is hoisted ahead of it
+        k = key(node) if self.candidate(node) else None
+        if k in temps:
+            return temps[k]
+        node = rebuild(node, [self.rewrite(kid, key, hoisted, temps, out, effected) for kid in children(node)])
+        if k in hoisted and not effected[0]:
+            temp = Identifier(self.temp())
+            out.append(Assignment(temp, node))
+            temps[k] = temp
+            return temp
+        if effects(node):
+            effected[0] = True
+        return node
+
+    def body(self, stmts):
+        stmts = [self.table.share(stmt) for stmt in stmts]
+        counts = Counter()
+        self.each(stmts, lambda node, key, out: self.count(node, key, counts), lambda body: body)
+        uses = Counter()
+        seen = set()
+        self.each(stmts, lambda node, key, out: self.use(node, key, counts, uses, seen, [False]), lambda body: body)
+        hoisted = set(k for k, n in uses.items() if n > 1)
+        temps = {}
+        return self.each(stmts, lambda node, key, out: self.rewrite(node, key, hoisted, temps, out, [False]),
+                         self.body)
+
+
+def eliminate(stmts):
+    return Eliminator(stmts).body(stmts)
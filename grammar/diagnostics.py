@@ -0,0 +1,147 @@
+import re
+from tatsu.exceptions import FailedParse
+from .fun import core_parser, body_parser, block_parser, chunkstmt_parser
+from .model import Block
+
+markers = re.compile(r'#\[(ENDL|INDENT|DEDENT)\]#')
+opens_block = re.compile(r'[ \n]*#\[INDENT\]#')
+leading = re.compile(r'(?:\s|#\[(?:ENDL|INDENT|DEDENT)\]#)*')
+# keywords whose bodies are parsed as statements when they run; macro bodies hold unquotes and
+# sparse bodies rows of numbers, so they aren't
+statement_bodies = ('fun', 'for', 'specialize')
+
+
+class Diagnostic:
+    def __init__(self, stage, message, line, column, source):
+        self.stage = stage
+        self.message = message
+        self.line = line
+        self.column = column
+        self.source = source
+
+    def __str__(self):
+        return '{}:{}: {} error: {}\n    {}\n    {}^'.format(
+            self.line, self.column, self.stage, self.message, self.source.expandtabs(),
+            ' ' * len(self.source[:self.column - 1].expandtabs()))
+
+    def __repr__(self):
+        return 'Diagnostic({}:{} {})'.format(self.line, self.column, self.message)
+
+
+class Diagnostics:
+    # errors collected instead of raised, each pointing at the line in the original source
+    def __init__(self, text):
+        self.lines = text.split('\n')
+        self.entries = []
+
+    def add(self, stage, message, offset, source_map):
+        line, column = source_map.location(offset)
+        source = self.lines[line - 1] if line <= len(self.lines) else ''
+        self.entries.append(Diagnostic(stage, message, line, column, source))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(sorted(self.entries, key=lambda d: (d.line, d.column)))
+
+    def report(self, file, fnm=None):
+        for diagnostic in self:
+            print(diagnostic if fnm is None else '{}:{}'.format(fnm, diagnostic), file=file)
+
+
+class Shifted:
+    # a source map for a piece of the text parsed on its own, starting at base
+    def __init__(self, source_map, base):
+        self.source_map = source_map
+        self.base = base
+
+    def location(self, offset):
+        return self.source_map.location(self.base + offset)
+
+
+def units(text, start=0, end=None):
+    # top level statements of text[start:end]: a line, or a block header with its indented body
+    end = len(text) if end is None else end
+    depth = 0
+    unit_start = start
+    for match in markers.finditer(text, start, end):
+        kind = match.group(1)
+        if kind == 'INDENT':
+            depth += 1
+        elif kind == 'DEDENT':
+            depth -= 1
+            if depth == 0:
+                yield unit_start, match.end()
+                unit_start = match.end()
+        elif depth == 0 and opens_block.match(text, match.end(), end) is None:
+            yield unit_start, match.end()
+            unit_start = match.end()
+    if text[unit_start:end].strip() != '':
+        yield unit_start, end
+
+
+def failed(e, text, start, source_map, diagnostics):
+    # parse failures point at where tatsu gave up, anything else at the start of the statement
+    if isinstance(e, FailedParse):
+        diagnostics.add('parse', e.message.strip().split('\n')[0], start + e.pos, source_map)
+    else:
+        start = leading.match(text, start).end()
+        diagnostics.add('parse', '{}: {}'.format(type(e).__name__, e), start, source_map)
+
+
+def parse_unit(parser, text, start, end, source_map):
+    return parser.parse(text[start:end], source_map=Shifted(source_map, start), trace=False)
+
+
+def check_block(text, start, end, source_map, diagnostics):
+    # a block that failed to parse: report its header or each bad line of its body
+    indent = text.find('#[INDENT]#', start, end)
+    try:
+        chunkstmt_parser.parse(text[start:indent], trace=False)
+    except Exception as e:
+        failed(e, text, start, source_map, diagnostics)
+        return
+    dedent = end - len('#[DEDENT]#')
+    found = False
+    for unit_start, unit_end in units(text, indent + len('#[INDENT]#'), dedent):
+        parser = block_parser if '#[INDENT]#' in text[unit_start:unit_end] else chunkstmt_parser
+        try:
+            parse_unit(parser, text, unit_start, unit_end, source_map)
+        except Exception as e:
+            found = True
+            if parser is block_parser:
+                check_block(text, unit_start, unit_end, source_map, diagnostics)
+            else:
+                failed(e, text, unit_start, source_map, diagnostics)
+    if not found:
+        diagnostics.add('parse', 'Malformed block', start, source_map)
+
+
+def parse_recovering(text, source_map, diagnostics, parser=core_parser):
+    # parses what it can, one top level statement at a time once the whole program fails
+    try:
+        return parser.parse(text, source_map=source_map, trace=False)
+    except Exception:
+        pass
+    program = []
+    for start, end in units(text):
+        try:
+            program += parse_unit(body_parser, text, start, end, source_map)
+        except Exception as e:
+            if '#[INDENT]#' in text[start:end]:
+                check_block(text, start, end, source_map, diagnostics)
+            else:
+                failed(e, text, start, source_map, diagnostics)
+    return program
+
+
+def check_bodies(stmts, diagnostics):
+    # keyword bodies are only parsed when their keyword runs, so they are parsed here as well,
+    # through the maps their blocks carry back to the file
+    for stmt in stmts:
+        if not isinstance(stmt, Block) or stmt.keyword not in statement_bodies:
+            continue
+        body_map = getattr(stmt.body, 'source_map', None)
+        if body_map is not None:
+            check_bodies(parse_recovering(stmt.body, body_map, diagnostics, body_parser), diagnostics)
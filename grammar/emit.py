@@ -0,0 +1,226 @@
+import io
+import json
+import struct
+from .model import *
+from .operators import BinaryExpr, ChainExpr
+from .serialize import schema, write_header, check_header, dumps_body, loads_body
+
+
+def joined(open, elems, sep, close):
+    parts = [open]
+    for i, elem in enumerate(elems):
+        if i > 0:
+            parts.append(sep)
+        parts.append(elem)
+    parts.append(close)
+    return parts
+
+
+# each entry gives the pieces of a node's textual form: strings are written as is,
+# anything else is expanded in turn, so formatting never recurses
+text_parts = {
+    TupleTarget: lambda n: joined('Tuple(', n.targets, ', ', ')'),
+    UnaryExpr: lambda n: ['Unary(', str(n.op), '(', n.expr, '))'],
+    TrailerExpr: lambda n: [n.expr, '{}{}{}'.format(n.surrounder, n.contents.text(),
+                                                    conjugate_surrounder(n.surrounder))],
+    Assignment: lambda n: ['Assignment(', n.name, ' = ', n.expr, ')'],
+    Tuple: lambda n: joined('Tuple(', n.contents, ', ', ')'),
+    PartialBinaryExpr: lambda n: joined('PartialBinary(', n.exprs, ' ', ')'),
+    BinaryExpr: lambda n: ['Binary(', n.left, ' ', str(n.op), ' ', n.right, ')'],
+    ChainExpr: lambda n: joined('Chain(', n.elems, ' ', ')'),
+}
+
+fields = {cls: names for cls, names in schema}
+
+
+def lookup(table, node):
+    # lazily loaded image nodes are subclasses of the model classes
+    for cls in type(node).__mro__:
+        if cls in table:
+            return table[cls]
+    return None
+
+
+def dispatch(table):
+    cache = {}
+
+    def find(node):
+        t = type(node)
+        if t not in cache:
+            cache[t] = lookup(table, node)
+        return cache[t]
+    return find
+
+
+text_dispatch = dispatch(text_parts)
+node_class = dispatch({cls: cls for cls in fields})
+
+
+class Emitter:
+    def __init__(self, sink, flush_every=None, fragment=False):
+        # a fragment is output to be passed on to another emitter's raw, and leaves out
+        # anything that goes once at the start of a stream
+        self.sink = sink
+        self.flush_every = flush_every
+        self.buffer = []
+        self.pending = 0
+        if not fragment:
+            self.start()
+
+    def start(self):
+        pass
+
+    def emit(self, node):
+        self.write_node(node)
+        self.written()
+
+    def event(self, name, value):
+        self.write_event(name, value)
+        self.written()
+
+    def raw(self, output):
+        # output already rendered by an emitter of the same kind
+        self.buffer.append(output)
+        self.written()
+
+    def written(self):
+        self.pending += 1
+        if self.flush_every is not None and self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.sink.write(self.empty.join(self.buffer))
+            self.buffer = []
+        self.sink.flush()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+
+
+class TextEmitter(Emitter):
+    empty = ''
+    events = {'function': 'FUNCTION {}', 'end_function': 'END FUNCTION {}', 'kernel': 'KERNEL {}',
+              'loop': 'FOR {}', 'end_loop': 'END FOR {}'}
+
+    def write_node(self, node):
+        append = self.buffer.append
+        stack = [node]
+        pop = stack.pop
+        extend = stack.extend
+        while stack:
+            part = pop()
+            if type(part) is str:
+                append(part)
+                continue
+            parts = text_dispatch(part)
+            if parts is not None:
+                extend(reversed(parts(part)))
+            elif isinstance(part, list):
+                extend(reversed(joined('[', [p if not isinstance(p, str) else repr(p) for p in part], ', ', ']')))
+            else:
+                append(str(part))
+        append('\n')
+
+    def write_event(self, name, value):
+        self.buffer.append(self.events[name].format(value))
+        self.buffer.append('\n')
+
+
+class Raw:
+    def __init__(self, text):
+        self.text = text
+
+
+class JsonEmitter(Emitter):
+    # one JSON object per line; nodes become {"node": <class>, <field>: ...} using the AST image schema
+    empty = ''
+
+    def write_node(self, node):
+        buffer = self.buffer
+        stack = [node]
+        while len(stack) > 0:
+            part = stack.pop()
+            if isinstance(part, Raw):
+                buffer.append(part.text)
+            elif part is None or isinstance(part, (str, int, float)):
+                buffer.append(json.dumps(part))
+            elif isinstance(part, (list, tuple)):
+                stack += reversed(joined(Raw('['), part, Raw(', '), Raw(']')))
+            elif node_class(part) is None:
+                buffer.append(json.dumps(str(part)))
+            else:
+                cls = node_class(part)
+                parts = [Raw('{{"node": {}'.format(json.dumps(cls.__name__)))]
+                for field in fields[cls]:
+                    parts += [Raw(', {}: '.format(json.dumps(field))), getattr(part, field)]
+                parts.append(Raw('}'))
+                stack += reversed(parts)
+        buffer.append('\n')
+
+    def write_event(self, name, value):
+        self.buffer.append(json.dumps({'event': name, 'value': value}))
+        self.buffer.append('\n')
+
+
+frame = struct.Struct('<cI')
+
+
+class BinaryEmitter(Emitter):
+    # frames of (kind, length): b'H' is the stream header, written once, that the images
+    # in the b'N' frames share; each b'N' carries a one-statement image, b'E' a JSON event
+    empty = b''
+
+    def start(self):
+        data = write_header()
+        self.buffer += [frame.pack(b'H', len(data)), data]
+
+    def write_node(self, node):
+        data = dumps_body([node])
+        self.buffer += [frame.pack(b'N', len(data)), data]
+
+    def write_event(self, name, value):
+        data = json.dumps({'event': name, 'value': value}).encode()
+        self.buffer += [frame.pack(b'E', len(data)), data]
+
+
+def capture(emitter):
+    # an emitter of the same kind writing to memory, whose output can be passed to emitter.raw
+    sink = io.BytesIO() if isinstance(emitter.empty, bytes) else io.StringIO()
+    return type(emitter)(sink, fragment=True), sink
+
+
+def read_frames(data):
+    # yields the statements and events in a binary emitter's output
+    pos = 0
+    headed = False
+    while pos < len(data):
+        kind, length = frame.unpack_from(data, pos)
+        pos += frame.size
+        payload = data[pos:pos + length]
+        pos += length
+        if kind == b'H':
+            check_header(payload)
+            headed = True
+        elif not headed:
+            raise Exception('Binary output has a frame before its stream header')
+        elif kind == b'N':
+            yield loads_body(payload)[0]
+        elif kind == b'E':
+            yield json.loads(payload.decode())
+        else:
+            raise Exception('Unknown frame kind {}'.format(kind))
+
+
+emitters = {
+    'text': TextEmitter,
+    'jsonl': JsonEmitter,
+    'binary': BinaryEmitter,
+}
+
+
+def make_emitter(format, sink, flush_every=None):
+    if format == 'binary' and hasattr(sink, 'buffer'):
+        sink = sink.buffer
+    return emitters[format](sink, flush_every)
@@ -1,43 +1,84 @@
-from .core import core_grammar, wrap
+from .core import core_grammar
 from .rules import *
-from .grammar import Grammar
 from .context import Context
 from .model import Block, PartialBinaryExpr, cata
+from .sampler import watch
+from .hashcons import share
 
 
-body_grammar = Grammar()
-body_grammar.add_rule('start', [Name('stmtlist'), EOF()])
-body_grammar.add_rules(core_grammar.slice_rule('stmtlist'))
+core_parser = core_grammar.compile()
+body_parser = core_parser.entry('stmtlist')
+header_parser = core_parser.entry('signature')
+expr_parser = core_parser.entry('expr')
+block_parser = core_parser.entry('block')
+chunkstmt_parser = core_parser.entry('chunkstmt')
 
-body_parser = body_grammar.compile()
 
-header_grammar = Grammar()
-header_grammar.add_rules(core_grammar.slice_rule('identifier'))
-header_grammar.add_rule('start', [Name('signature'), EOF()])
-header_grammar.add_rule('signature', [('name', Name('identifier')), ('params', Name('params'))])
-header_grammar.add_rule('params', wrap('(', [Gather(Literal(','), Name('identifier'))], ')'))
+def parse_ops(ast, context):
+    if isinstance(ast, PartialBinaryExpr):
+        return share(context.op_parser.parse(ast.exprs))
+    if context.macros is not None:
+        ast = context.macros.expression(ast, context)
+    return share(ast)
 
-header_parser = header_grammar.compile()
 
+def parse_stmt(stmt, context):
+    # a statement with its operators parsed and macros expanded; blocks are left to their keywords,
+    # and a macro call standing as a statement may expand to several
+    if isinstance(stmt, Block):
+        return [stmt]
+    if context.macros is not None:
+        stmts = context.macros.statement(stmt, context)
+        if stmts is not None:
+            return stmts
+    return [cata(stmt, lambda ast: parse_ops(ast, context))]
 
-def parse_ops(ast, context):
-    if isinstance(ast, PartialBinaryExpr):
-        return context.op_parser.parse(ast.exprs)
-    return ast
+
+def run_body(body, context, global_context):
+    for stmt in body:
+        for stmt in parse_stmt(stmt, context):
+            if isinstance(stmt, Block):
+                context.keywords[stmt.keyword](stmt.header, stmt.body, context, global_context)
+            else:
+                context.emitter.emit(stmt)
+
+
+def declare_fun(header, body, context):
+    # top-level functions are known to the stager, so specialize can find them
+    if context.stager is not None:
+        signature = header_parser.parse(header)
+        context.stager.define(signature.name.name, [p.name for p in signature.params[1]], body, context)
 
 
 def process_fun(header, body, ext_context, global_context):
+    if ext_context is global_context:
+        declare_fun(header, body, ext_context)
+
     header = header_parser.parse(header)
+    name = header.name.name
     body = body_parser.parse(body, trace=False)
 
-    name = header.name
-
-    context = Context(ext_context.op_parser, ext_context.keywords)
+    context = Context(ext_context.op_parser, ext_context.keywords, ext_context.names, ext_context.emitter,
+                      ext_context.code, ext_context.stager, ext_context.macros)
     
-    print('FUNCTION {}'.format(name))
-    for stmt in body:
-        if isinstance(stmt, Block):
-            context.keywords[stmt.keyword](stmt.header, stmt.body, context, global_context)
-        else:
-            print(cata(stmt, lambda ast: parse_ops(ast, context)))
-    print('END FUNCTION {}'.format(name))
+    context.emitter.event('function', name)
+    run_body(body, context, global_context)
+    context.emitter.event('end_function', name)
+
+
+process_fun.mutates = ()
+# the scheduler declares functions in the parent before forking, so later statements see them
+process_fun.declare = declare_fun
+
+
+def process_for(header, body, context, global_context):
+    body = body_parser.parse(body, trace=False)
+    context.emitter.event('loop', header)
+    run_body(body, context, global_context)
+    context.emitter.event('end_loop', header)
+
+
+process_for.mutates = ()
+
+watch(run_body, node='stmt')
+watch(process_fun, function='name')
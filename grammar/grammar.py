@@ -1,12 +1,61 @@
-import tatsu
+import copy
+import queue
+import hashlib
+import threading
+from contextlib import contextmanager
+from tatsu.grammars import Grammar as LinkedGrammar, ModelContext
 from tatsu.model import ModelBuilderSemantics
-from .rules import Name
+from tatsu.tool import GrammarGenerator
+from .rules import Name, EOF
+from .model import ModelNode, Block
+from .source import Span, current_source, mapping
+from .parsestats import current_stats
 
 ident = lambda x: x
 
+def start_rule(name):
+    return '{}_start'.format(name)
+
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+# rules compiled one at a time, shared by every grammar: parsed_rules maps the hash of a rule's
+# ebnf to its compiled rule, linked_rules maps the hash of everything a rule reaches to the copy
+# used in assembled grammars. tatsu writes left recursion and memoization flags onto the rules
+# when a grammar is assembled, so a rule object is only shared between slices with the same contents
+parsed_rules = {}
+claimed_rules = set()
+linked_rules = {}
+compile_stats = {'parsed': 0, 'copied': 0, 'reused': 0}
+# grammars may be extended from several interpreter threads at once
+link_lock = threading.RLock()
+
+
+def parse_rule(text):
+    key = content_hash(text)
+    if key not in parsed_rules:
+        # a fresh generator each time, since it remembers the rules it has seen
+        parsed_rules[key] = GrammarGenerator('Grammar').parse(text, start='rule')
+        compile_stats['parsed'] += 1
+    if key in claimed_rules:
+        compile_stats['copied'] += 1
+        return copy.deepcopy(parsed_rules[key])
+    claimed_rules.add(key)
+    return parsed_rules[key]
+
 class Grammar:
     def __init__(self, rules=None):
         self.rules = {} if rules is None else rules
+        self.starts = []
+        self.slices = {}
+        self.changed = set(self.rules)
+        self.texts = {}
+        self.keys = {}
+        self.linked = None
+        # counts changes to the rules, so what is derived from all of them knows when to redo it
+        self.revision = 0
 
     def add_rule(self, name, *rules, semantics=ident):
         # print('Adding rules:')
@@ -26,47 +75,88 @@ class Grammar:
         # print(rules)
         # print('Adding rule to grammar {}'.format(name))
         self.rules[name] = (rules, semantics)
+        self.changed.add(name)
+        self.slices = {}
+        self.revision += 1
 
     def add_rules(self, rules):
         self.rules.update(rules)
+        self.changed.update(rules)
+        self.slices = {}
+        self.revision += 1
+
+    def add_start(self, name):
+        # extra entry point so one compiled parser can be entered at `name`
+        self.add_rule(start_rule(name), [Name(name), EOF()])
+        self.starts.append(name)
+
+    def rule_ebnf(self, name):
+        rule, semantics = self.rules[name]
+        and_rules = []
+        for and_rule in rule:
+            new_and_rule = []
+            for (label, sub) in and_rule:
+                if label is not None:
+                    new_and_rule.append('{}:{}'.format(label, sub.ebnf()))
+                else:
+                    new_and_rule.append(sub.ebnf())
+            and_rules.append(new_and_rule)
+        rule = ' | '.join(' '.join(and_rule) for and_rule in and_rules)
+        return '{} = {} ;'.format(name, rule)
 
     def gen_grammar(self):
         grammar = ['@@grammar :: Grammar']
-        # print('All rules:')
-        # print(self.rules)
-        for name, (rule, semantics) in self.rules.items():
-            # print('Rule:')
-            # print(rule)
-            and_rules = []
-            for and_rule in rule:
-                new_and_rule = []
-                # print('And rule:')
-                # print(and_rule)
-                for (label, sub) in and_rule:
-                    if label is not None:
-                        new_and_rule.append('{}:{}'.format(label, sub.ebnf()))
-                    else:
-                        new_and_rule.append(sub.ebnf())
-                and_rules.append(new_and_rule)
-
-            rule = ' | '.join(' '.join(and_rule) for and_rule in and_rules)
-            # rule = ' | '.join(' '.join(
-            #     ('{}:{}'.format(name, sub) if name is not None else sub)
-            #     for (name, sub) in subrule)
-            #     for subrule in rule)
-            # print('Adding rule {}'.format(name))
-            grammar.append('{} = {} ;'.format(name, rule))
+        for name in self.rules:
+            grammar.append(self.rule_ebnf(name))
         return '\n'.join(grammar)
 
     def semantics(self):
         return {name: semantics for name, (rule, semantics) in self.rules.items()}
 
     def compile(self):
-        grammar = self.gen_grammar()
-        # print(grammar)
-        return Parser(tatsu.compile(grammar), self.semantics())
+        return Parser(self.link(), self.semantics())
+
+    def link(self):
+        with link_lock:
+            return self.relink()
+
+    def relink(self):
+        # only rules that changed, or that reach one that did, get recompiled
+        if self.linked is not None and len(self.changed) == 0:
+            return self.linked
+        for name in self.changed:
+            self.texts.pop(name, None)
+        for name in list(self.keys):
+            if name not in self.rules:
+                del self.keys[name]
+        for name in self.rules:
+            if name in self.texts:
+                continue
+            self.texts[name] = self.rule_ebnf(name)
+        affected = [name for name in self.rules
+                    if name not in self.keys or not self.changed.isdisjoint(self.slice_rule(name))]
+        for name in affected:
+            # rules in a cycle reach the same slice, so the key leads with the rule's own name
+            self.keys[name] = content_hash('\n'.join([name] + sorted(self.texts[n] for n in self.slice_rule(name))))
+        rules = []
+        for name in self.rules:
+            key = self.keys[name]
+            if key in linked_rules:
+                compile_stats['reused'] += 1
+            else:
+                linked_rules[key] = parse_rule(self.texts[name])
+            rules.append(linked_rules[key])
+        # the first rule stays the default start rule
+        self.linked = LinkedGrammar('Grammar', rules)
+        self.changed = set()
+        return self.linked
 
     def slice_rule(self, name):
+        if name not in self.slices:
+            self.slices[name] = self.compute_slice(name)
+        return dict(self.slices[name])
+
+    def compute_slice(self, name):
         # print('Slicing rules')
         subrules = set()
         new_subrules = {name}
@@ -85,19 +175,75 @@ class Grammar:
     def __getitem__(self, name):
         return Grammar(self.slice_rule(name))
 
+def rule_extent(ctx):
+    # the start and end offsets of the rule tatsu is finishing. the rule's start is on the state
+    # below the one pushed for the rule, and the end is the current position. parseinfo would give
+    # both publicly, but it is kept on the ast the semantic actions consume, and costs a line
+    # lookup per node. tatsu's private parse state is read here and in parsestats.py's
+    # ProfilingContext, which overrides _call and _invoke_rule and reads _memo_for, _pos and
+    # _rule_stack; requirements.txt pins tatsu's version for both
+    return ctx._statestack[-2].pos, ctx._pos
+
+
+class ParserPool:
+    # parse contexts for one compiled grammar, reused between parses. a context belongs to one parse
+    # at a time, so parses can run in any number of threads; at most size contexts are ever made
+    # and further parses wait for one to come back
+    def __init__(self, rules, size=8):
+        self.rules = rules
+        self.free = queue.LifoQueue()
+        for i in range(size):
+            self.free.put(None)
+
+    @contextmanager
+    def context(self):
+        ctx = self.free.get()
+        if ctx is None:
+            ctx = ModelContext(self.rules)
+        try:
+            yield ctx
+        finally:
+            self.free.put(ctx)
+
+
 class Parser:
-    def __init__(self, parser, semantics):
+    def __init__(self, parser, semantics, start=None, pool=None):
         self.parser = parser
+        self.rule_semantics = semantics
+        self.start = start
+        self.pool = ParserPool(parser.rules) if pool is None else pool
 
         class Semantics(ModelBuilderSemantics):
-            pass
+            def _postproc(self, ctx, node):
+                # the innermost rule that produced a node gives it its span
+                if isinstance(node, ModelNode) and node.span is None:
+                    start, end = rule_extent(ctx)
+                    node.span = Span(start, end, current_source.get())
+                    if isinstance(node, Block) and node.span.source_map is not None:
+                        node.locate(ctx.tokenizer.text, node.span.source_map)
             # def _default(self, ast):
             #     return semantics[ast.parseinfo.rule](ast)
-        self.semantics = Semantics()
+        # the actions are set on the class, and each parse gets an instance of its own
         for name, fn in semantics.items():
-            # def wrapper(this, *ast):
-            #     return fn(*ast)
-            setattr(self.semantics, name, fn)
+            setattr(Semantics, name, staticmethod(fn))
+        self.semantics = Semantics
+
+    def entry(self, name):
+        # shares the compiled grammar and its contexts, only the start rule differs
+        return Parser(self.parser, self.rule_semantics, start=start_rule(name), pool=self.pool)
 
-    def parse(self, *args, **kwargs):
-        return self.parser.parse(*args, semantics=self.semantics, **kwargs)
+    def parse(self, *args, source_map=None, ctx=None, **kwargs):
+        # a block body brings its own source map
+        if source_map is None and len(args) > 0:
+            source_map = getattr(args[0], 'source_map', None)
+        if self.start is not None:
+            kwargs.setdefault('start', self.start)
+        profiled = current_stats.get() if ctx is None else None
+        if profiled is not None:
+            stats, label, original = profiled
+            return stats.parse(self, *args, source_map=source_map, label=label, original=original, **kwargs)
+        with mapping(source_map):
+            if ctx is not None:
+                return self.parser.parse(*args, semantics=self.semantics(), ctx=ctx, **kwargs)
+            with self.pool.context() as ctx:
+                return self.parser.parse(*args, semantics=self.semantics(), ctx=ctx, **kwargs)
@@ -0,0 +1,96 @@
+import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
+from .model import *
+from .operators import BinaryExpr, ChainExpr
+
+# while a table is current, expressions come out of parse_ops hash-consed: a subtree equal to one
+# built before is that one, so repeated subexpressions are one object. a shared node keeps the
+# span of the first place it was built
+current_nodes = ContextVar('current_nodes', default=None)
+
+leaves = (Int, Float, String, Char, Symbol, Identifier, Op)
+
+# for each kind of node: the fields holding nodes, the fields holding lists of nodes, and the
+# fields compared by their text
+fields = {
+    UnaryExpr: (['expr'], [], ['op']),
+    BinaryExpr: (['left', 'right'], [], ['op']),
+    ChainExpr: ([], ['elems'], []),
+    TrailerExpr: (['expr'], [], ['surrounder', 'contents']),
+    Assignment: (['name', 'expr'], [], []),
+    Tuple: ([], ['contents'], []),
+    TupleTarget: ([], ['targets'], []),
+    Collection: ([], [], ['surrounder', 'contents']),
+    CollectionTarget: ([], [], ['surrounder', 'contents']),
+    Call: (['fn'], ['args'], []),
+    Index: (['expr', 'index'], [], []),
+}
+
+
+def text(value):
+    if value is None:
+        return None
+    return value.text() if isinstance(value, Contents) else str(value)
+
+
+class NodeTable:
+    def __init__(self):
+        self.nodes = {}
+        # structure -> node, and id(node) -> its structure for the nodes in the table
+        self.shapes = {}
+        self.built = 0
+
+    def shape(self, node):
+        # children are already shared, so they are compared by identity
+        kind = type(node)
+        if isinstance(node, leaves):
+            return (kind, node.literal)
+        nodes, lists, texts = fields[kind]
+        return (kind,
+                tuple(id(getattr(node, f)) for f in nodes),
+                tuple(tuple(id(e) if isinstance(e, (ModelNode, BinaryExpr, ChainExpr)) else text(e)
+                            for e in getattr(node, f)) for f in lists),
+                tuple(text(getattr(node, f)) for f in texts))
+
+    def share(self, node):
+        if id(node) in self.shapes and self.nodes.get(self.shapes[id(node)]) is node:
+            return node
+        if not isinstance(node, leaves) and type(node) not in fields:
+            return node
+        self.built += 1
+        if not isinstance(node, leaves):
+            # the shared children go into a copy, so trees holding the node, like a fun's parsed
+            # body, keep it as it was
+            node = copy.copy(node)
+            nodes, lists, texts = fields[type(node)]
+            for f in nodes:
+                setattr(node, f, self.share(getattr(node, f)))
+            for f in lists:
+                setattr(node, f, [self.share(e) if isinstance(e, (ModelNode, BinaryExpr, ChainExpr)) else e
+                                  for e in getattr(node, f)])
+        shape = self.shape(node)
+        shared = self.nodes.get(shape)
+        if shared is None:
+            self.nodes[shape] = shared = node
+            self.shapes[id(node)] = shape
+        return shared
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def share(node):
+    table = current_nodes.get()
+    if table is None:
+        return node
+    return table.share(node)
+
+
+@contextmanager
+def hashconsing(table):
+    token = current_nodes.set(table)
+    try:
+        yield table
+    finally:
+        current_nodes.reset(token)
@@ -0,0 +1,409 @@
+import operator
+from .model import *
+from .operators import BinaryExpr, ChainExpr
+from .persistent import identifier
+from .unpack import plan_for
+from .arrays import is_array
+
+# flow-insensitive type inference over fun bodies: a name's type is the join of everything
+# assigned to it anywhere in the body, so the body is walked until no name's type changes
+# and then every expression in it has its final label
+
+INT = 'int'
+FLOAT = 'float'
+STRING = 'string'
+BOOL = 'bool'
+UNKNOWN = 'unknown'
+
+# sequences are ('seq', element type)
+scalars = (INT, FLOAT, STRING, BOOL)
+numbers = (INT, FLOAT)
+
+
+def seq(element):
+    return ('seq', element)
+
+
+def is_concrete(t):
+    if isinstance(t, tuple):
+        return is_concrete(t[1])
+    return t in scalars
+
+
+def join(a, b):
+    # None is a name nothing has been assigned to yet
+    if a is None:
+        return b
+    if b is None or a == b:
+        return a
+    return UNKNOWN
+
+
+def element(t):
+    if t is None:
+        return None
+    if isinstance(t, tuple):
+        return t[1]
+    return STRING if t == STRING else UNKNOWN
+
+
+def value_type(value):
+    if isinstance(value, bool):
+        return BOOL
+    elif isinstance(value, int):
+        return INT
+    elif isinstance(value, float):
+        return FLOAT
+    elif isinstance(value, str):
+        return STRING
+    elif is_array(value):
+        return seq(INT if value.dtype.kind == 'i' else FLOAT)
+    elif isinstance(value, (tuple, list)):
+        t = None
+        for v in value:
+            t = join(t, value_type(v))
+        return seq(UNKNOWN if t is None else t)
+    return UNKNOWN
+
+
+arithmetic = {
+    ('+', STRING, STRING): STRING,
+    ('*', STRING, INT): STRING,
+    ('*', INT, STRING): STRING,
+    ('/', INT, INT): FLOAT,
+    ('&&', BOOL, BOOL): BOOL,
+    ('||', BOOL, BOOL): BOOL,
+}
+for op in ['+', '-', '*']:
+    arithmetic[(op, INT, INT)] = INT
+for op in ['+', '-', '*', '/', '^']:
+    for pair in [(INT, FLOAT), (FLOAT, INT), (FLOAT, FLOAT)]:
+        arithmetic[(op,) + pair] = FLOAT
+# int ^ int is an int only for exponents that aren't negative, which isn't known here
+
+# the operations specialized code runs on operands of these types, with no checks
+typed_ops = {key: {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv,
+                   '^': operator.pow}.get(key[0]) for key in arithmetic}
+typed_ops[('&&', BOOL, BOOL)] = lambda a, b: a and b
+typed_ops[('||', BOOL, BOOL)] = lambda a, b: a or b
+
+comparisons = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+
+def compare_type(op, left, right):
+    if op in ['==', '!='] or left in numbers and right in numbers or left == right == STRING:
+        return BOOL
+    return UNKNOWN
+
+
+def number_join(args):
+    t = None
+    for arg in args:
+        t = join(t, arg)
+    return t if t in numbers else UNKNOWN
+
+
+builtin_types = {
+    'range': lambda args: seq(INT),
+    'len': lambda args: INT,
+    'abs': lambda args: args[0] if len(args) == 1 and args[0] in numbers else UNKNOWN,
+    'min': lambda args: number_join(element(args[0]) if len(args) == 1 else args),
+    'max': lambda args: number_join(element(args[0]) if len(args) == 1 else args),
+    'sum': lambda args: element(args[0]) if len(args) == 1 and element(args[0]) in numbers else UNKNOWN,
+}
+
+constant_types = {'true': BOOL, 'false': BOOL}
+
+
+class Inference:
+    # labels the expressions of one body, asking the stager for fun bodies, for blocks and call arguments
+    def __init__(self, stager, context, returns=None):
+        self.stager = stager
+        self.context = context
+        self.labels = {}
+        # what each (function, argument types) returns, shared with the inferences of callees
+        self.returns = {} if returns is None else returns
+
+    def of(self, node):
+        label = self.labels.get(id(node))
+        return UNKNOWN if label is None or label[1] is None else label[1]
+
+    def label(self, node, t):
+        self.labels[id(node)] = (node, t)
+        return t
+
+    def body(self, stmts, env):
+        while True:
+            before = dict(env)
+            result = self.stmts(stmts, env)
+            if env == before:
+                return UNKNOWN if result is None else result
+
+    def stmts(self, stmts, env):
+        result = None
+        for stmt in stmts:
+            if isinstance(stmt, Assignment):
+                result = self.expr(stmt.expr, env)
+                self.bind(stmt.name, result, env)
+            elif isinstance(stmt, Loop):
+                self.bind_loop(stmt.var, self.expr(stmt.iterable, env), stmt.body, env)
+                result = UNKNOWN
+            elif isinstance(stmt, Block) and stmt.keyword == 'for':
+                var, iterable, body = self.stager.for_loop(stmt, self.context)
+                self.bind_loop(var, self.expr(iterable, env), body, env)
+                result = UNKNOWN
+            elif isinstance(stmt, Block):
+                result = UNKNOWN
+            else:
+                result = self.expr(stmt, env)
+        return result
+
+    def bind(self, target, t, env):
+        if isinstance(target, Identifier):
+            env[target.name] = join(env.get(target.name), t)
+        elif isinstance(target, TupleTarget):
+            for name in target.targets:
+                self.bind(name, element(t), env)
+        elif isinstance(target, CollectionTarget):
+            # rest names and map entries aren't tracked
+            for lexeme in target.contents:
+                if identifier.fullmatch(str(lexeme)) is not None:
+                    env[str(lexeme)] = UNKNOWN
+
+    def bind_loop(self, var, iterable, body, env):
+        env[var] = join(env.get(var), element(iterable))
+        self.stmts(body, env)
+
+    def expr(self, node, env):
+        return self.label(node, self.infer(node, env))
+
+    def infer(self, node, env):
+        if isinstance(node, Int):
+            return INT
+        elif isinstance(node, Float):
+            return FLOAT
+        elif isinstance(node, (String, Char)):
+            return STRING
+        elif isinstance(node, Identifier):
+            if node.name in env:
+                return env[node.name]
+            return constant_types.get(node.name, UNKNOWN)
+        elif isinstance(node, Tuple):
+            t = None
+            for c in node.contents:
+                t = join(t, self.expr(c, env))
+            return seq(UNKNOWN if t is None else t)
+        elif isinstance(node, UnaryExpr):
+            t = self.expr(node.expr, env)
+            if str(node.op) == '-':
+                return t if t in numbers or t is None else UNKNOWN
+            return BOOL if t == BOOL else UNKNOWN
+        elif isinstance(node, BinaryExpr):
+            left, right = self.expr(node.left, env), self.expr(node.right, env)
+            if left is None or right is None:
+                return None
+            return arithmetic.get((str(node.op), left, right), UNKNOWN)
+        elif isinstance(node, ChainExpr):
+            types = [self.expr(e, env) for e in node.elems[::2]]
+            if any(t is None for t in types):
+                return None
+            ops = [str(op) for op in node.elems[1::2]]
+            if all(compare_type(op, types[i], types[i + 1]) == BOOL for i, op in enumerate(ops)):
+                return BOOL
+            return UNKNOWN
+        elif isinstance(node, TrailerExpr):
+            args = [self.expr(arg, env) for arg in self.stager.arguments(node, self.context)]
+            if node.surrounder == '(' and isinstance(node.expr, Identifier):
+                return self.call(node.expr.name, args, env)
+            elif node.surrounder == '[' and len(args) == 1:
+                return self.index(self.expr(node.expr, env), args[0])
+        elif isinstance(node, Call):
+            args = [self.expr(arg, env) for arg in node.args]
+            if isinstance(node.fn, Identifier):
+                return self.call(node.fn.name, args, env)
+        elif isinstance(node, Index):
+            return self.index(self.expr(node.expr, env), self.expr(node.index, env))
+        return UNKNOWN
+
+    def index(self, t, index):
+        if index != INT:
+            return UNKNOWN
+        return element(t)
+
+    def call(self, name, args, env):
+        if name in env:
+            return UNKNOWN
+        if any(a is None for a in args):
+            return None
+        if name in builtin_types:
+            return builtin_types[name](args)
+        stager = self.stager
+        if name in stager.specs:
+            spec = stager.specs[name]
+            static = {p: value_type(v) for p, v in spec.static.items()}
+            return self.returned(name, spec.params, spec.body, args, static)
+        if name in stager.funs:
+            fun = stager.funs[name]
+            return self.returned(name, fun.params, fun.body(), args, {})
+        return UNKNOWN
+
+    def returned(self, name, params, body, args, static):
+        key = (name, tuple(args))
+        if key not in self.returns:
+            # a recursive call sees unknown until the outer call is done
+            self.returns[key] = UNKNOWN
+            env = dict(static)
+            env.update(zip(params, args))
+            self.returns[key] = Inference(self.stager, self.context, self.returns).body(body, env)
+        return self.returns[key]
+
+    def coverage(self):
+        # (expressions with a concrete type, expressions)
+        labels = list(self.labels.values())
+        return sum(1 for node, t in labels if is_concrete(t)), len(labels)
+
+
+
+class TypedCode:
+    # closures for a fully typed body: each operation is picked once from its operand types,
+    # so running it does no dispatch on node kinds or value types
+    def __init__(self, inference, builtins):
+        self.inference = inference
+        self.stager = inference.stager
+        self.context = inference.context
+        self.builtins = builtins
+
+    def body(self, stmts):
+        steps = [self.stmt(stmt) for stmt in stmts]
+
+        def run(env):
+            value = None
+            for step in steps:
+                value = step(env)
+            return value
+        return run
+
+    def stmt(self, stmt):
+        if isinstance(stmt, Assignment):
+            return self.assign(stmt, self.expr(stmt.expr))
+        elif isinstance(stmt, Loop):
+            return self.loop(stmt.var, self.expr(stmt.iterable), self.body(stmt.body))
+        elif isinstance(stmt, Block) and stmt.keyword == 'for':
+            var, iterable, body = self.stager.for_loop(stmt, self.context)
+            return self.loop(var, self.expr(iterable), self.body(body))
+        return self.expr(stmt)
+
+    def assign(self, stmt, expr):
+        if isinstance(stmt.name, Identifier):
+            name = stmt.name.name
+
+            def run(env):
+                env[name] = value = expr(env)
+                return value
+            return run
+
+        unpack = plan_for(stmt).run
+
+        def run(env):
+            value = expr(env)
+            unpack(value, env)
+            return value
+        return run
+
+    def loop(self, var, iterable, body):
+        def run(env):
+            for item in iterable(env):
+                env[var] = item
+                body(env)
+        return run
+
+    def expr(self, node):
+        if isinstance(node, (Int, Float)):
+            value = node.value
+            return lambda env: value
+        elif isinstance(node, String):
+            value = node.string
+            return lambda env: value
+        elif isinstance(node, Char):
+            value = node.char
+            return lambda env: value
+        elif isinstance(node, Identifier):
+            name = node.name
+            if name in constant_types:
+                value = name == 'true'
+                return lambda env: value
+            return lambda env: env[name]
+        elif isinstance(node, Tuple):
+            contents = [self.expr(c) for c in node.contents]
+            return lambda env: tuple(c(env) for c in contents)
+        elif isinstance(node, UnaryExpr):
+            fn = operator.neg if str(node.op) == '-' else operator.not_
+            expr = self.expr(node.expr)
+            return lambda env: fn(expr(env))
+        elif isinstance(node, BinaryExpr):
+            fn = typed_ops[(str(node.op), self.inference.of(node.left), self.inference.of(node.right))]
+            left, right = self.expr(node.left), self.expr(node.right)
+            return lambda env: fn(left(env), right(env))
+        elif isinstance(node, ChainExpr):
+            return self.chain(node)
+        elif isinstance(node, TrailerExpr) and node.surrounder == '(':
+            return self.call(node.expr.name, [self.expr(a) for a in self.stager.arguments(node, self.context)])
+        elif isinstance(node, TrailerExpr):
+            expr, index = self.expr(node.expr), self.expr(self.stager.arguments(node, self.context)[0])
+            return lambda env: expr(env)[index(env)]
+        elif isinstance(node, Call):
+            return self.call(node.fn.name, [self.expr(a) for a in node.args])
+        elif isinstance(node, Index):
+            expr, index = self.expr(node.expr), self.expr(node.index)
+            return lambda env: expr(env)[index(env)]
+        raise Exception('Cannot compile {}'.format(node))
+
+    def chain(self, node):
+        operands = [self.expr(e) for e in node.elems[::2]]
+        fns = [comparisons[str(op)] for op in node.elems[1::2]]
+        if len(fns) == 1:
+            fn, left, right = fns[0], operands[0], operands[1]
+            return lambda env: fn(left(env), right(env))
+
+        def run(env):
+            values = [operand(env) for operand in operands]
+            return all(fn(values[i], values[i + 1]) for i, fn in enumerate(fns))
+        return run
+
+    def call(self, name, args):
+        if name in self.builtins:
+            fn = self.builtins[name]
+        else:
+            stager = self.stager
+            fn = lambda *values: stager.call(name, list(values))
+        return lambda env: fn(*[arg(env) for arg in args])
+
+
+def compile_typed(stmts, inference, builtins):
+    # None unless every expression in stmts got a concrete type
+    typed, total = inference.coverage()
+    if typed < total:
+        return None
+    return TypedCode(inference, builtins).body(stmts)
+
+
+def report(stager, file):
+    # how much of each fun, with unknown arguments, and each specialization got a concrete type
+    typed_total, total = 0, 0
+    targets = list(stager.funs.values()) + list(stager.specs.values())
+    for target in targets:
+        typed, count = stager.infer(target).coverage()
+        typed_total += typed
+        total += count
+        print('{:>5} of {:>5} expressions typed  {}'.format(typed, count, target.name), file=file)
+    if total > 0:
+        print('{:>5} of {:>5} expressions typed ({:.0f}%) in {} bodies'.format(
+            typed_total, total, 100 * typed_total / total, len(targets)), file=file)
+    print('{:>5} calls ran typed code'.format(stager.typed_runs), file=file)
@@ -0,0 +1,171 @@
+import re
+import copy
+from .context import Context
+from .model import *
+from .operators import BinaryExpr, ChainExpr
+from .hashcons import leaves, fields
+from .fun import body_parser, header_parser, parse_ops, parse_stmt
+
+# macro blocks quote their body: it is parsed once into a template whose holes are the
+# parameters marked with &, and a call fills the holes with the arguments' trees, or with their
+# text where the template holds raw lexemes or nested blocks. expansions are kept per macro and
+# argument text, and what an expansion contains is expanded in turn, up to max_depth deep
+#
+# macro square(x)
+#     &x * &x
+#
+# y = square(a + 1)
+
+# bodies come lexed, so `&x` arrives as `& x`; a & after an operand is left alone as an operator
+unquote = re.compile(r'(\S?)(\s*)(?<!&)&(?!&)\s*([_a-zA-Z][_a-zA-Z0-9]*)')
+operand_ends = set('_?!)]}"\'')
+hole_prefix = 'unquote__'
+hole = re.compile(r'\b{}([_a-zA-Z0-9]+)'.format(hole_prefix))
+
+
+def unquoted(text):
+    def replace(match):
+        before, space, name = match.groups()
+        if before.isalnum() or before in operand_ends:
+            return match.group(0)
+        return before + space + hole_prefix + name
+    return unquote.sub(replace, text)
+
+
+class Macro:
+    def __init__(self, name, params, stmts):
+        self.name = name
+        self.params = params
+        self.stmts = stmts
+
+
+class Expander:
+    def __init__(self, max_depth=16, memoize=True):
+        self.macros = {}
+        # (macro, argument texts) -> expanded statements
+        self.memo = {}
+        self.memoize = memoize
+        self.max_depth = max_depth
+        self.depth = 0
+        self.hits = 0
+        self.misses = 0
+
+    def define(self, name, params, body, context):
+        text = unquoted(body)
+        for name_used in hole.findall(text):
+            if name_used not in params:
+                raise Exception('Macro {} unquotes &{}, which is not one of its parameters'.format(name, name_used))
+        # templates keep the macro calls in them, so they see macros defined after this one
+        quoting = Context(context.op_parser, context.keywords)
+        stmts = [s for stmt in body_parser.parse(text, trace=False) for s in parse_stmt(stmt, quoting)]
+        self.macros[name] = Macro(name, params, stmts)
+        # anything expanded so far may have used an earlier definition
+        self.memo = {}
+
+    def invoked(self, node):
+        return isinstance(node, TrailerExpr) and node.surrounder == '(' and \
+            isinstance(node.expr, Identifier) and node.expr.name in self.macros
+
+    def statement(self, stmt, context):
+        # the statements a macro call standing as a statement expands to, or None
+        if not self.invoked(stmt):
+            return None
+        return self.expand(stmt, context)
+
+    def expression(self, node, context):
+        if not self.invoked(node):
+            return node
+        stmts = self.expand(node, context)
+        if len(stmts) != 1 or isinstance(stmts[0], (Assignment, Block)):
+            raise Exception('Macro {} expands to statements, so it can only be used as a statement'.format(
+                node.expr.name))
+        return stmts[0]
+
+    def expand(self, call, context):
+        macro = self.macros[call.expr.name]
+        lexemes = [call.contents.element_lexemes(i) for i in range(call.contents.num_elements())]
+        if len(lexemes) != len(macro.params):
+            raise Exception('Macro {} takes {} arguments, got {}'.format(macro.name, len(macro.params), len(lexemes)))
+        key = (macro.name, tuple(' '.join(l) for l in lexemes))
+        if key in self.memo:
+            self.hits += 1
+            return self.memo[key]
+        self.misses += 1
+        if self.depth >= self.max_depth:
+            raise Exception('Expanding {} nested more than {} macros deep'.format(macro.name, self.max_depth))
+        self.depth += 1
+        try:
+            args = {}
+            for i, param in enumerate(macro.params):
+                node = cata(call.contents.element(i), lambda ast: parse_ops(ast, context))
+                # pasted as text, an argument of several lexemes keeps its grouping
+                text = list(lexemes[i]) if len(lexemes[i]) == 1 else ['('] + list(lexemes[i]) + [')']
+                args[param] = (node, text)
+            stmts = []
+            for stmt in macro.stmts:
+                if self.invoked(stmt):
+                    stmts += self.expand(self.fill(stmt, args), context)
+                else:
+                    stmts.append(self.fill(stmt, args, context))
+        finally:
+            self.depth -= 1
+        if self.memoize:
+            self.memo[key] = stmts
+        return stmts
+
+    def text(self, text, args):
+        return hole.sub(lambda m: ' '.join(args[m.group(1)][1]), text)
+
+    def fill(self, node, args, context=None):
+        # a copy of a template node with its holes filled; with a context, macro calls in the
+        # template are expanded as they're filled
+        if isinstance(node, Identifier) and node.name.startswith(hole_prefix):
+            return args[node.name[len(hole_prefix):]][0]
+        elif isinstance(node, String):
+            text = self.text(node.literal, args)
+            return node if text == node.literal else node.spanned(String(text))
+        elif isinstance(node, leaves) or not isinstance(node, (ModelNode, BinaryExpr, ChainExpr)):
+            return node
+        elif isinstance(node, Block):
+            # a nested block is text until its keyword runs, so its holes are filled as text
+            filled = copy.copy(node)
+            for f in ['header', 'body', 'literal']:
+                setattr(filled, f, self.text(getattr(node, f), args))
+            return filled
+        elif type(node) not in fields:
+            return node
+        filled = copy.copy(node)
+        filled.__dict__.pop('plan', None)
+        nodes, lists, texts = fields[type(node)]
+        for f in nodes:
+            setattr(filled, f, self.fill(getattr(node, f), args, context))
+        for f in lists:
+            setattr(filled, f, [self.fill(e, args, context) for e in getattr(node, f)])
+        if 'contents' in texts and isinstance(node.contents, Contents) and \
+                any(hole.fullmatch(str(l)) for l in node.contents):
+            filled.contents = Contents(self.lexemes(node.contents, args))
+        if context is not None and self.invoked(filled):
+            return self.expression(filled, context)
+        return filled
+
+    def lexemes(self, contents, args):
+        lexemes = []
+        for lexeme in contents:
+            match = hole.fullmatch(str(lexeme))
+            lexemes += args[match.group(1)][1] if match is not None else [lexeme]
+        return lexemes
+
+
+def expander_of(context):
+    if context.macros is None:
+        raise Exception('This interpreter has no macro expander')
+    return context.macros
+
+
+def process_macro(header, body, ext_context, global_context):
+    signature = header_parser.parse(header)
+    expander_of(ext_context).define(signature.name.name, [p.name for p in signature.params[1]], body, ext_context)
+
+
+# later statements expand with the new macro, so nothing after it runs before it
+process_macro.mutates = ('macros',)
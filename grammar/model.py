@@ -1,4 +1,9 @@
+import re
 from tatsu.model import ModelBuilderSemantics
+from .names import intern_name
+from .source import Body, BodyMap
+
+whitespace = re.compile(r'\s*')
 
 
 def conjugate_surrounder(surrounder):
@@ -10,6 +15,64 @@ def conjugate_surrounder(surrounder):
         return '}'
 
 
+closers = {')', ']', '}'}
+separators = {',', ';'}
+
+
+class Contents(list):
+    # raw lexemes of a trailer or collection; elements are split and parsed on first access
+    def __init__(self, lexemes):
+        super().__init__(lexemes)
+        self.joined = None
+        self.bounds = None
+        self.parsed = {}
+
+    def text(self):
+        if self.joined is None:
+            self.joined = ' '.join(str(c) for c in self)
+        return self.joined
+
+    def split(self):
+        if self.bounds is None:
+            bounds = []
+            depth = 0
+            start = 0
+            for i, lexeme in enumerate(self):
+                if conjugate_surrounder(lexeme) is not None:
+                    depth += 1
+                elif lexeme in closers:
+                    depth -= 1
+                elif depth == 0 and lexeme in separators:
+                    bounds.append((start, i))
+                    start = i + 1
+            bounds.append((start, len(self)))
+            self.bounds = [(start, end) for start, end in bounds if end > start]
+        return self.bounds
+
+    def num_elements(self):
+        return len(self.split())
+
+    def element_lexemes(self, i):
+        start, end = self.split()[i]
+        return self[start:end]
+
+    def element(self, i):
+        if i not in self.parsed:
+            from .fun import expr_parser
+            self.parsed[i] = expr_parser.parse(' '.join(self.element_lexemes(i)))
+        return self.parsed[i]
+
+    def elements(self):
+        for i in range(self.num_elements()):
+            yield self.element(i)
+
+
+def contents_view(contents):
+    if contents is None or isinstance(contents, Contents):
+        return contents
+    return Contents(contents)
+
+
 def cata(model, fn):
     if isinstance(model, list):
         return [elem.cata(fn) for elem in model]
@@ -17,9 +80,15 @@ def cata(model, fn):
 
 
 class ModelNode:
+    span = None
+
     def cata(self, fn):
         return fn(self)
 
+    def spanned(self, node):
+        node.span = self.span
+        return node
+
 
 class Int(ModelNode):
     def __init__(self, string):
@@ -53,8 +122,15 @@ class String(ModelNode):
 
 class Symbol(ModelNode):
     def __init__(self, symbol):
+        self.symbol = intern_name(symbol)
         self.literal = '~{}'.format(self.symbol)
-        self.symbol = symbol
+
+    # symbols are atoms, so two with the same name are the same value
+    def __eq__(self, other):
+        return isinstance(other, Symbol) and other.symbol == self.symbol
+
+    def __hash__(self):
+        return hash(self.symbol)
 
     def __repr__(self):
         return 'Symbol(~{})'.format(self.symbol)
@@ -71,8 +147,8 @@ class Char(ModelNode):
 
 class Identifier(ModelNode):
     def __init__(self, name):
-        self.literal = name
-        self.name = name
+        self.name = intern_name(name)
+        self.literal = self.name
 
     def __repr__(self):
         return 'Ident({})'.format(self.name)
@@ -80,8 +156,8 @@ class Identifier(ModelNode):
 
 class Op(ModelNode):
     def __init__(self, op):
-        self.literal = op
-        self.op = op
+        self.op = intern_name(op)
+        self.literal = self.op
 
     def __repr__(self):
         return self.op
@@ -92,7 +168,7 @@ class TupleTarget(ModelNode):
         self.targets = targets
 
     def cata(self, fn):
-        return fn(TupleTarget(t.cata(fn) for t in self.targets))
+        return fn(self.spanned(TupleTarget([t.cata(fn) for t in self.targets])))
 
     def __repr__(self):
         return 'Tuple({})'.format(', '.join(str(t) for t in self.targets))
@@ -101,13 +177,13 @@ class TupleTarget(ModelNode):
 class CollectionTarget(ModelNode):
     def __init__(self, surrounder, contents):
         self.surrounder = surrounder
-        self.contents = contents
+        self.contents = contents_view(contents)
 
     def cata(self, fn):
-        return fn(CollectionTarget(self.surrounder, self.contents))
+        return fn(self.spanned(CollectionTarget(self.surrounder, self.contents)))
 
     def __repr__(self):
-        return 'Collection({}{}{})'.format(self.surrounder, ' '.join(str(c) for c in self.contents), conjugate_surrounder(self.surrounder))
+        return 'Collection({}{}{})'.format(self.surrounder, self.contents.text(), conjugate_surrounder(self.surrounder))
 
 
 class UnaryExpr(ModelNode):
@@ -116,7 +192,7 @@ class UnaryExpr(ModelNode):
         self.expr = expr
 
     def cata(self, fn):
-        return fn(UnaryExpr(self.op, self.expr.cata(fn)))
+        return fn(self.spanned(UnaryExpr(self.op, self.expr.cata(fn))))
 
     def __repr__(self):
         return 'Unary({}({}))'.format(self.op, self.expr)
@@ -126,13 +202,13 @@ class TrailerExpr(ModelNode):
     def __init__(self, expr, surrounder, contents):
         self.expr = expr
         self.surrounder = surrounder
-        self.contents = contents
+        self.contents = contents_view(contents)
 
     def cata(self, fn):
-        return fn(TrailerExpr(self.expr.cata(fn), self.surrounder, self.contents))
+        return fn(self.spanned(TrailerExpr(self.expr.cata(fn), self.surrounder, self.contents)))
 
     def __repr__(self):
-        return '{}{}{}{}'.format(self.expr, self.surrounder, ' '.join(str(c) for c in self.contents),
+        return '{}{}{}{}'.format(self.expr, self.surrounder, self.contents.text(),
                                  conjugate_surrounder(self.surrounder))
 
 
@@ -150,26 +226,61 @@ class Block(ModelNode):
         self.header = ' '.join(header)
         # print('Body')
         # print(body)
+        self.nested = [stmt if isinstance(stmt, Block) else None for stmt in body]
         body = [' '.join(stmt) if isinstance(stmt, list) else stmt.literal for stmt in body]
+        # where each statement starts in the body
+        self.offsets = [0]
+        for stmt in body[:-1]:
+            self.offsets.append(self.offsets[-1] + len(stmt) + len('#[ENDL]#\n'))
         self.body = '#[ENDL]#\n'.join(body)
-        self.literal = '{} {} #[ENDL]#\n#[INDENT]# {} #[ENDL]#\n#[DEDENT]#'.format(self.keyword, self.header, self.body)
+        head = '{} {} #[ENDL]#\n#[INDENT]# '.format(self.keyword, self.header)
+        self.body_start = len(head)
+        self.literal = head + self.body + ' #[ENDL]#\n#[DEDENT]#'
         # print('Block literal')
         # print(self.literal)
 
+    def locate(self, text, source_map):
+        # text is what the block was parsed from; a statement runs to its endl, a nested block to its
+        # end, and offsets inside a nested block's body go on through that block's own map
+        starts = []
+        inner = []
+        pos = text.find('#[INDENT]#', self.span.start) + len('#[INDENT]#')
+        for block in self.nested:
+            pos = whitespace.match(text, pos).end()
+            starts.append(pos)
+            if block is None:
+                pos = text.find('#[ENDL]#', pos) + len('#[ENDL]#')
+                inner.append(None)
+            else:
+                pos = block.span.end
+                body_map = getattr(block.body, 'source_map', None)
+                inner.append(None if body_map is None else (body_map, block.body_start))
+        self.body = Body(self.body, BodyMap(self.offsets, starts, inner, source_map))
+
     def cata(self, fn):
-        return fn(Block(self.keyword, self.header, self.body))
+        # a block is text until its keyword runs, so there is nothing under it to fold
+        return fn(self)
 
     def __repr__(self):
         return 'Block({}, header={}, ...)'.format(self.keyword, self.header)
 
 
 class Assignment(ModelNode):
+    # the unpack plan for the target, built the first time it runs
+    plan = None
+
     def __init__(self, name, expr):
         self.name = name
         self.expr = expr
 
     def cata(self, fn):
-        return fn(Assignment(self.name, self.expr.cata(fn)))
+        return fn(self.spanned(Assignment(self.name, self.expr.cata(fn))))
+
+    def __getstate__(self):
+        # plans are compiled code, built again on the first run after unpickling
+        state = dict(self.__dict__)
+        state.pop('plan', None)
+        return state
 
     def __repr__(self):
         return 'Assignment({} = {})'.format(self.name, self.expr)
@@ -180,7 +291,7 @@ class Tuple(ModelNode):
         self.contents = contents
 
     def cata(self, fn):
-        return fn(Tuple(c.cata(fn) for c in self.contents))
+        return fn(self.spanned(Tuple([c.cata(fn) for c in self.contents])))
 
     def __repr__(self):
         return 'Tuple({})'.format(', '.join(str(c) for c in self.contents))
@@ -189,13 +300,13 @@ class Tuple(ModelNode):
 class Collection(ModelNode):
     def __init__(self, surrounder, contents):
         self.surrounder = surrounder
-        self.contents = contents
+        self.contents = contents_view(contents)
 
     def cata(self, fn):
-        return fn(Collection(self.surrounder, self.contents))
+        return fn(self.spanned(Collection(self.surrounder, self.contents)))
 
     def __repr__(self):
-        return 'Collection({}{}{})'.format(self.surrounder, ' '.join(str(c) for c in self.contents), conjugate_surrounder(self.surrounder))
+        return 'Collection({}{}{})'.format(self.surrounder, self.contents.text(), conjugate_surrounder(self.surrounder))
 
 
 class PartialBinaryExpr(ModelNode):
@@ -203,12 +314,42 @@ class PartialBinaryExpr(ModelNode):
         self.exprs = exprs
 
     def cata(self, fn):
-        return fn(PartialBinaryExpr(e.cata(fn) if i % 2 == 0 else e for i, e in enumerate(self.exprs)))
+        return fn(self.spanned(PartialBinaryExpr(e.cata(fn) if i % 2 == 0 else e for i, e in enumerate(self.exprs))))
 
     def __repr__(self):
         return 'PartialBinary({})'.format(' '.join(str(e) for e in self.exprs))
 
 
+# nodes that only appear in residual programs left by staging
+class Call(ModelNode):
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+    def __repr__(self):
+        return '{}({})'.format(self.fn, ', '.join(str(a) for a in self.args))
+
+
+class Index(ModelNode):
+    def __init__(self, expr, index):
+        self.expr = expr
+        self.index = index
+
+    def __repr__(self):
+        return '{}[{}]'.format(self.expr, self.index)
+
+
+class Loop(ModelNode):
+    # a for block over a collection that is only known at run time
+    def __init__(self, var, iterable, body):
+        self.var = var
+        self.iterable = iterable
+        self.body = body
+
+    def __repr__(self):
+        return 'For({} in {}: {})'.format(self.var, self.iterable, '; '.join(str(s) for s in self.body))
+
+
 def unaryexpr(ast):
     if ast.subexpr is not None:
         return ast.subexpr
@@ -269,7 +410,9 @@ def assignment(ast):
 
 
 def tuple_sem(ast):
-    return Tuple([] if ast.contents is None else [ast.first] + ast.contents)
+    # () comes back as its bare tokens
+    contents = getattr(ast, 'contents', None)
+    return Tuple([] if contents is None else [ast.first] + contents)
 
 
 def parenstarget(ast):
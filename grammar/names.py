@@ -0,0 +1,32 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+current_names = ContextVar('current_names', default=None)
+
+
+class NameTable:
+    def __init__(self):
+        self.names = {}
+
+    def intern(self, name):
+        # equal names share one string object
+        return self.names.setdefault(name, name)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def intern_name(name):
+    table = current_names.get()
+    if table is None:
+        return name
+    return table.intern(name)
+
+
+@contextmanager
+def interning(table):
+    token = current_names.set(table)
+    try:
+        yield table
+    finally:
+        current_names.reset(token)
@@ -1,5 +1,6 @@
 import tatsu
 from tatsu.model import ModelBuilderSemantics
+from .grammar import ParserPool
 
 
 def parse_ops(ast, context):
@@ -89,9 +90,23 @@ def simplify_expr(ast):
     return ast
 
 
+class OperatorSemantics(ModelBuilderSemantics):
+    # made for each parse, since atoms are indices into that parse's expressions
+    def __init__(self, exprs):
+        super().__init__()
+        self.exprs = exprs
+
+    def atom(self, idx):
+        return self.exprs[int(idx)]
+
+    def expr(self, ast):
+        return simplify_expr(ast)
+
+
 class OperatorParser:
     def __init__(self, parser):
         self.parser = parser
+        self.pool = ParserPool(parser.rules)
 
     def parse(self, elems):
         elems = list(elems)
@@ -105,16 +120,9 @@ class OperatorParser:
             else:
                 text[i] = text[i].op
 
-        class Semantics(ModelBuilderSemantics):
-            def atom(self, idx):
-                return exprs[int(idx)]
-
-            def expr(self, ast):
-                return simplify_expr(ast)
-
         text = ' '.join(text)
         # print(text)
         # print('Exprs:')
         # print(exprs)
-        return self.parser.parse(text, semantics=Semantics())
-        
+        with self.pool.context() as ctx:
+            return self.parser.parse(text, semantics=OperatorSemantics(exprs), ctx=ctx)
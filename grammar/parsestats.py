@@ -0,0 +1,112 @@
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from tatsu.exceptions import FailedParse
+from tatsu.grammars import ModelContext
+
+
+# the stats the parses a running module makes go through, with the module's name and text
+current_stats = ContextVar('current_stats', default=None)
+
+
+def location(source_map, pos):
+    # without a source map, offsets are reported as columns of line 1
+    return (1, pos + 1) if source_map is None else source_map.location(pos)
+
+
+class ParseStats:
+    # per-rule counts across every parse run through it, and an optional budget per parse
+    def __init__(self, max_steps=None, max_seconds=None):
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.entered = Counter()
+        self.backtracked = Counter()
+        self.memo_hits = Counter()
+        self.lines = Counter()
+        self.sources = {}
+        # label -> the lines of its text, split once however many parses report on it
+        self.texts = {}
+        self.steps = 0
+        self.seconds = 0.0
+
+    def parse(self, parser, text, source_map=None, label=None, original=None, **kwargs):
+        # original is the text before preprocessing, for showing the hottest lines
+        ctx = ProfilingContext(parser.parser.rules, self, source_map)
+        kwargs['trace'] = False
+        start = time.perf_counter()
+        try:
+            return parser.parse(text, source_map=source_map, ctx=ctx, **kwargs)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.steps += ctx.steps
+            if original is not None and label not in self.texts:
+                self.texts[label] = original.split('\n')
+            original = None if original is None else self.texts[label]
+            for pos, count in ctx.failures.items():
+                line = location(source_map, pos)[0]
+                self.lines[(label, line)] += count
+                if original is not None and line <= len(original):
+                    self.sources[(label, line)] = original[line - 1].strip()
+
+    def report(self, file, top=10):
+        print('{} rule calls in {:.1f}ms'.format(self.steps, self.seconds * 1000), file=file)
+        print('{:<20} {:>10} {:>12} {:>10}'.format('rule', 'entered', 'backtracked', 'memo hits'), file=file)
+        for name, count in self.backtracked.most_common(top):
+            print('{:<20} {:>10} {:>12} {:>10}'.format(
+                name, self.entered[name], count, self.memo_hits[name]), file=file)
+        if len(self.lines) > 0:
+            print('lines with the most backtracking:', file=file)
+        for (label, line), count in self.lines.most_common(top):
+            where = str(line) if label is None else '{}:{}'.format(label, line)
+            print('{:>10} {:<20} {}'.format(count, where, self.sources.get((label, line), '')), file=file)
+
+
+@contextmanager
+def profiling(stats, label=None, original=None):
+    # parses made while a module runs, such as the bodies of its blocks, are counted and budgeted
+    # like the module's own parse
+    token = current_stats.set(None if stats is None else (stats, label, original))
+    try:
+        yield stats
+    finally:
+        current_stats.reset(token)
+
+
+class ProfilingContext(ModelContext):
+    # hooks tatsu's private rule calls and memo lookups, like rule_extent in grammar.py, so both
+    # depend on the tatsu version requirements.txt pins
+    def __init__(self, rules, stats, source_map, **settings):
+        super().__init__(rules, **settings)
+        self.stats = stats
+        self.source_map = source_map
+        self.steps = 0
+        self.failures = Counter()
+        self.deadline = None if stats.max_seconds is None else time.perf_counter() + stats.max_seconds
+
+    def _call(self, ruleinfo):
+        self.steps += 1
+        self.stats.entered[ruleinfo.name] += 1
+        # the clock is only read every 256 calls
+        if self.stats.max_steps is not None and self.steps > self.stats.max_steps or \
+                self.deadline is not None and self.steps % 256 == 0 and time.perf_counter() > self.deadline:
+            self.exceeded()
+        pos = self._pos
+        try:
+            return super()._call(ruleinfo)
+        except FailedParse:
+            self.stats.backtracked[ruleinfo.name] += 1
+            self.failures[pos] += 1
+            raise
+
+    def _invoke_rule(self, ruleinfo, key):
+        if self._memo_for(key) is not None:
+            self.stats.memo_hits[ruleinfo.name] += 1
+        return super()._invoke_rule(ruleinfo, key)
+
+    def exceeded(self):
+        line, column = location(self.source_map, self._pos)
+        budget = '{} rule calls'.format(self.stats.max_steps) if self.stats.max_steps is not None and \
+            self.steps > self.stats.max_steps else '{}s'.format(self.stats.max_seconds)
+        raise Exception('Parse budget of {} exceeded at line {}, column {}, in {}'.format(
+            budget, line, column, ' > '.join(rule.name for rule in self._rule_stack[-3:])))
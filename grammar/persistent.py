@@ -0,0 +1,476 @@
+import re
+from .model import Int, Float, String, Char, Symbol, Identifier, TupleTarget, CollectionTarget, Collection, \
+    conjugate_surrounder, closers, contents_view
+
+# runtime values for list and map literals: a persistent vector (32-way trie with a tail, as in
+# Clojure) and a hash array mapped trie; updates copy one path and share everything else
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+
+def tail_offset(count):
+    return 0 if count < WIDTH else ((count - 1) >> BITS) << BITS
+
+
+def new_path(level, node):
+    while level > 0:
+        node = (node,)
+        level -= BITS
+    return node
+
+
+def push_tail(count, level, parent, tail):
+    sub = ((count - 1) >> level) & MASK
+    if level == BITS:
+        child = tail
+    elif sub < len(parent):
+        child = push_tail(count, level - BITS, parent[sub], tail)
+    else:
+        child = new_path(level - BITS, tail)
+    return parent[:sub] + (child,) + parent[sub + 1:]
+
+
+def assoc_path(level, node, i, value):
+    if level == 0:
+        j = i & MASK
+        return node[:j] + (value,) + node[j + 1:]
+    sub = (i >> level) & MASK
+    return node[:sub] + (assoc_path(level - BITS, node[sub], i, value),) + node[sub + 1:]
+
+
+def index_of(i, length):
+    if i < 0:
+        i += length
+    if not 0 <= i < length:
+        raise IndexError('vector index out of range')
+    return i
+
+
+class Vector:
+    __slots__ = ['count', 'shift', 'root', 'tail']
+
+    def __init__(self, count=0, shift=BITS, root=(), tail=()):
+        self.count = count
+        self.shift = shift
+        self.root = root
+        self.tail = tail
+
+    @staticmethod
+    def from_iterable(values):
+        # builds the trie bottom up rather than appending one value at a time
+        values = tuple(values)
+        count = len(values)
+        tail_start = tail_offset(count)
+        nodes = [values[i:i + WIDTH] for i in range(0, tail_start, WIDTH)]
+        shift = BITS
+        while len(nodes) > WIDTH:
+            nodes = [tuple(nodes[i:i + WIDTH]) for i in range(0, len(nodes), WIDTH)]
+            shift += BITS
+        return Vector(count, shift, tuple(nodes), values[tail_start:])
+
+    def leaf(self, i):
+        if i >= tail_offset(self.count):
+            return self.tail
+        node = self.root
+        level = self.shift
+        while level > 0:
+            node = node[(i >> level) & MASK]
+            level -= BITS
+        return node
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.count)
+            if step != 1:
+                return Vector.from_iterable(self[j] for j in range(start, stop, step))
+            return Slice(self, start, max(start, stop))
+        i = index_of(i, self.count)
+        return self.leaf(i)[i & MASK]
+
+    def __iter__(self):
+        for start in range(0, self.count, WIDTH):
+            yield from self.leaf(start)
+
+    def set(self, i, value):
+        i = index_of(i, self.count)
+        if i >= tail_offset(self.count):
+            j = i & MASK
+            return Vector(self.count, self.shift, self.root, self.tail[:j] + (value,) + self.tail[j + 1:])
+        return Vector(self.count, self.shift, assoc_path(self.shift, self.root, i, value), self.tail)
+
+    def append(self, value):
+        if self.count - tail_offset(self.count) < WIDTH:
+            return Vector(self.count + 1, self.shift, self.root, self.tail + (value,))
+        if (self.count >> BITS) > (1 << self.shift):
+            return Vector(self.count + 1, self.shift + BITS, (self.root, new_path(self.shift, self.tail)), (value,))
+        return Vector(self.count + 1, self.shift, push_tail(self.count, self.shift, self.root, self.tail), (value,))
+
+    def __eq__(self, other):
+        return isinstance(other, (Vector, Slice)) and len(self) == len(other) and \
+            all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Vector([{}])'.format(', '.join(repr(v) for v in self))
+
+
+class Slice:
+    # a window onto a vector; taking the tail of a list shares the whole trie
+    __slots__ = ['vector', 'start', 'stop']
+
+    def __init__(self, vector, start, stop):
+        self.vector = vector
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return Vector.from_iterable(self[j] for j in range(start, stop, step))
+            return Slice(self.vector, self.start + start, self.start + max(start, stop))
+        return self.vector[self.start + index_of(i, len(self))]
+
+    def __iter__(self):
+        i = self.start
+        while i < self.stop:
+            j = i & MASK
+            values = self.vector.leaf(i)[j:j + self.stop - i]
+            yield from values
+            i += len(values)
+
+    def set(self, i, value):
+        return Slice(self.vector.set(self.start + index_of(i, len(self)), value), self.start, self.stop)
+
+    def append(self, value):
+        if self.stop == len(self.vector):
+            return Slice(self.vector.append(value), self.start, self.stop + 1)
+        return Slice(self.vector.set(self.stop, value), self.start, self.stop + 1)
+
+    __eq__ = Vector.__eq__
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Vector([{}])'.format(', '.join(repr(v) for v in self))
+
+
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def hash_of(key):
+    return hash(key) & HASH_MASK
+
+
+def popcount(n):
+    return bin(n).count('1')
+
+
+class BitmapNode:
+    # entries are (key, value) pairs or child nodes, one per set bit of the bitmap;
+    # nodes created under an edit token are updated in place while that token builds the map
+    __slots__ = ['bitmap', 'entries', 'edit']
+
+    def __init__(self, bitmap, entries, edit=None):
+        self.bitmap = bitmap
+        self.entries = entries
+        self.edit = edit
+
+    def find(self, shift, h, key, default):
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit:
+            return default
+        entry = self.entries[popcount(self.bitmap & (bit - 1))]
+        if isinstance(entry, tuple):
+            return entry[1] if entry[0] == key else default
+        return entry.find(shift + BITS, h, key, default)
+
+    def with_entry(self, i, entry, edit):
+        if edit is not None and self.edit is edit:
+            self.entries[i] = entry
+            return self
+        entries = list(self.entries)
+        entries[i] = entry
+        return BitmapNode(self.bitmap, entries, edit)
+
+    def assoc(self, shift, h, key, value, edit):
+        bit = 1 << ((h >> shift) & MASK)
+        i = popcount(self.bitmap & (bit - 1))
+        if not self.bitmap & bit:
+            if edit is not None and self.edit is edit:
+                self.entries.insert(i, (key, value))
+                self.bitmap |= bit
+                return self, True
+            return BitmapNode(self.bitmap | bit, self.entries[:i] + [(key, value)] + self.entries[i:], edit), True
+        entry = self.entries[i]
+        if isinstance(entry, tuple):
+            if entry[0] == key:
+                if entry[1] is value:
+                    return self, False
+                return self.with_entry(i, (key, value), edit), False
+            node = make_node(shift + BITS, entry, (key, value), h, edit)
+            return self.with_entry(i, node, edit), True
+        node, added = entry.assoc(shift + BITS, h, key, value, edit)
+        if node is entry:
+            return self, added
+        return self.with_entry(i, node, edit), added
+
+    def without(self, shift, h, key):
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit:
+            return self
+        i = popcount(self.bitmap & (bit - 1))
+        entry = self.entries[i]
+        if isinstance(entry, tuple):
+            if entry[0] != key:
+                return self
+            node = None
+        else:
+            node = entry.without(shift + BITS, h, key)
+            if node is entry:
+                return self
+        if node is None:
+            if self.bitmap == bit:
+                return None
+            return BitmapNode(self.bitmap ^ bit, self.entries[:i] + self.entries[i + 1:])
+        if isinstance(node, BitmapNode) and len(node.entries) == 1 and isinstance(node.entries[0], tuple):
+            node = node.entries[0]
+        return BitmapNode(self.bitmap, self.entries[:i] + [node] + self.entries[i + 1:])
+
+    def items(self):
+        for entry in self.entries:
+            if isinstance(entry, tuple):
+                yield entry
+            else:
+                yield from entry.items()
+
+
+class CollisionNode:
+    # keys whose whole hashes are equal
+    __slots__ = ['hash', 'pairs']
+
+    def __init__(self, h, pairs):
+        self.hash = h
+        self.pairs = pairs
+
+    def find(self, shift, h, key, default):
+        for k, v in self.pairs:
+            if k == key:
+                return v
+        return default
+
+    def assoc(self, shift, h, key, value, edit):
+        if h != self.hash:
+            node = BitmapNode(1 << ((self.hash >> shift) & MASK), [self], edit)
+            return node.assoc(shift, h, key, value, edit)
+        for i, (k, v) in enumerate(self.pairs):
+            if k == key:
+                return CollisionNode(h, self.pairs[:i] + [(key, value)] + self.pairs[i + 1:]), False
+        return CollisionNode(h, self.pairs + [(key, value)]), True
+
+    def without(self, shift, h, key):
+        pairs = [(k, v) for k, v in self.pairs if k != key]
+        if len(pairs) == len(self.pairs):
+            return self
+        return CollisionNode(h, pairs) if len(pairs) > 0 else None
+
+    def items(self):
+        return iter(self.pairs)
+
+
+def make_node(shift, pair, new_pair, h, edit):
+    old_hash = hash_of(pair[0])
+    if old_hash == h:
+        return CollisionNode(h, [pair, new_pair])
+    node = BitmapNode(1 << ((old_hash >> shift) & MASK), [pair], edit)
+    return node.assoc(shift, h, new_pair[0], new_pair[1], edit)[0]
+
+
+missing = object()
+
+
+class HashMap:
+    __slots__ = ['count', 'root']
+
+    def __init__(self, count=0, root=None):
+        self.count = count
+        self.root = root
+
+    @staticmethod
+    def from_pairs(pairs):
+        edit = object()
+        root = BitmapNode(0, [], edit)
+        count = 0
+        for key, value in pairs:
+            root, added = root.assoc(0, hash_of(key), key, value, edit)
+            count += added
+        return HashMap(count, root)
+
+    def get(self, key, default=None):
+        if self.root is None:
+            return default
+        return self.root.find(0, hash_of(key), key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, missing)
+        if value is missing:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, missing) is not missing
+
+    def set(self, key, value):
+        root = BitmapNode(0, []) if self.root is None else self.root
+        root, added = root.assoc(0, hash_of(key), key, value, None)
+        return self if root is self.root else HashMap(self.count + added, root)
+
+    def remove(self, key):
+        if self.root is None:
+            return self
+        root = self.root.without(0, hash_of(key), key)
+        return self if root is self.root else HashMap(self.count - 1, root)
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        return iter(()) if self.root is None else self.root.items()
+
+    def __iter__(self):
+        for key, value in self.items():
+            yield key
+
+    def __eq__(self, other):
+        return isinstance(other, HashMap) and len(self) == len(other) and \
+            all(other.get(k, missing) == v for k, v in self.items())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'HashMap({{{}}})'.format(', '.join('{!r} -> {!r}'.format(k, v) for k, v in self.items()))
+
+
+identifier = re.compile(r'[_a-zA-Z][_a-zA-Z0-9]*[?!]?$')
+arrows = {'->', ':'}
+
+
+def split_top(lexemes, seps):
+    groups = [[]]
+    depth = 0
+    for lexeme in lexemes:
+        if conjugate_surrounder(lexeme) is not None:
+            depth += 1
+        elif lexeme in closers:
+            depth -= 1
+        elif depth == 0 and lexeme in seps:
+            groups.append([])
+            continue
+        groups[-1].append(lexeme)
+    return groups
+
+
+def parse_lexemes(lexemes):
+    from .fun import expr_parser
+    return expr_parser.parse(' '.join(lexemes))
+
+
+def evaluate(node):
+    # literals become runtime values; anything else is left as its node
+    if isinstance(node, (Int, Float)):
+        return node.value
+    elif isinstance(node, String):
+        return node.string
+    elif isinstance(node, Char):
+        return node.char
+    elif isinstance(node, Collection):
+        return from_collection(node)
+    return node
+
+
+def map_entry(lexemes):
+    groups = split_top(lexemes, arrows)
+    if len(groups) != 2:
+        raise Exception('Expected key -> value, got {}'.format(' '.join(lexemes)))
+    return evaluate(parse_lexemes(groups[0])), evaluate(parse_lexemes(groups[1]))
+
+
+def from_collection(node):
+    contents = contents_view(node.contents)
+    if node.surrounder == '[':
+        return Vector.from_iterable(evaluate(contents.element(i)) for i in range(contents.num_elements()))
+    elif node.surrounder == '{':
+        return HashMap.from_pairs(map_entry(contents.element_lexemes(i)) for i in range(contents.num_elements()))
+    raise Exception('Cannot build a collection from {}'.format(node))
+
+
+def target_name(lexemes):
+    lexemes = [str(l) for l in lexemes]
+    if len(lexemes) != 1 or identifier.match(lexemes[0]) is None:
+        raise Exception('Expected a name to bind, got {}'.format(' '.join(lexemes)))
+    return lexemes[0]
+
+
+def bind_sequence(contents, value, bindings):
+    # [a, b] matches exactly two values, [a:rest] binds the first and a view of the others
+    groups = split_top([str(l) for l in contents], {':'})
+    heads = [target_name(names) for group in groups[:-1] for names in split_top(group, {','})]
+    rest = None
+    if len(groups) > 1:
+        rest = target_name(groups[-1])
+    else:
+        heads += [target_name(names) for names in split_top(groups[-1], {','}) if len(names) > 0]
+    if len(value) < len(heads) or (rest is None and len(value) != len(heads)):
+        raise Exception('Cannot unpack {} values into {}'.format(len(value), ' '.join(contents)))
+    for i, name in enumerate(heads):
+        bindings[name] = value[i]
+    if rest is not None:
+        bindings[rest] = value[len(heads):]
+
+
+def bind_map(contents, value, bindings):
+    # {"key" -> v} looks a key up; {k -> v} binds the key and value of a one-entry map
+    entries = [split_top(e, arrows) for e in split_top([str(l) for l in contents], {',', ';'}) if len(e) > 0]
+    for groups in entries:
+        if len(groups) != 2:
+            raise Exception('Expected key -> name, got {}'.format(' '.join(contents)))
+        name = target_name(groups[1])
+        if len(groups[0]) == 1 and identifier.match(groups[0][0]) is not None:
+            if len(entries) != 1 or len(value) != 1:
+                raise Exception('Cannot unpack {} entries into {}'.format(len(value), ' '.join(contents)))
+            key, bindings[name] = next(iter(value.items()))
+            bindings[groups[0][0]] = key
+        else:
+            key = evaluate(parse_lexemes(groups[0]))
+            if key not in value:
+                raise Exception('Key {} not found'.format(' '.join(groups[0])))
+            bindings[name] = value[key]
+
+
+def destructure(target, value, bindings=None):
+    # name -> value for each name in the target; values are shared, never copied
+    bindings = {} if bindings is None else bindings
+    if isinstance(target, Identifier):
+        bindings[target.name] = value
+    elif isinstance(target, TupleTarget):
+        targets = list(target.targets)
+        if len(targets) != len(value):
+            raise Exception('Cannot unpack {} values into {} targets'.format(len(value), len(targets)))
+        for t, v in zip(targets, value):
+            destructure(t, v, bindings)
+    elif isinstance(target, CollectionTarget) and target.surrounder == '[':
+        bind_sequence(target.contents, value, bindings)
+    elif isinstance(target, CollectionTarget) and target.surrounder == '{':
+        bind_map(target.contents, value, bindings)
+    else:
+        raise Exception('Cannot destructure into {}'.format(target))
+    return bindings
@@ -145,6 +145,17 @@ class Lookahead(Rule):
         return '&{}'.format(self.rule.ebnf())
 
 
+class NegativeLookahead(Rule):
+    def __init__(self, rule):
+        self.rule = rule
+
+    def subrules(self):
+        return self.rule.subrules()
+
+    def ebnf(self):
+        return '!{}'.format(self.rule.ebnf())
+
+
 class Optional(Rule):
     def __init__(self, rule):
         self.rule = rule
@@ -164,7 +175,8 @@ class Or(Rule):
         return [subrule for rule in self.rules for subrule in rule.subrules()]
 
     def ebnf(self):
-        return ' | '.join(r.ebnf() for r in self.rules)
+        # grouped, so a labelled Or or one inside a sequence stays one element
+        return '({})'.format(' | '.join(r.ebnf() for r in self.rules))
 
 
 class And(Rule):
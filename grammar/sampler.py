@@ -0,0 +1,118 @@
+import os
+import sys
+import threading
+from collections import Counter
+from .model import ModelNode
+
+# interpreter functions whose frames say what obsidian code is running:
+# code object -> (local holding the node being run, local naming the obsidian function)
+watched = {}
+
+
+def watch(fn, node=None, function=None):
+    watched[fn.__code__] = (node, function)
+
+
+class Sampler:
+    # samples the interpreter thread's python stack from a second thread, so nothing is added to
+    # the code being run; each sample is charged to the obsidian functions on the stack and the
+    # line of the innermost node that came from a source file
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.files = {}
+        self.sources = {}
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def add_file(self, source_map, fnm, text=None):
+        self.files[source_map] = fnm
+        if text is not None:
+            self.sources[fnm] = text.split('\n')
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.sample(frame)
+            # drops the reference so the interpreter's frames aren't kept alive between samples
+            frame = None
+
+    def sample(self, frame):
+        entries = []
+        while frame is not None:
+            locals_ = watched.get(frame.f_code)
+            if locals_ is not None:
+                entries.append((locals_, frame.f_locals))
+            frame = frame.f_back
+        functions = []
+        where = None
+        last = None
+        for (node, function), values in reversed(entries):
+            # a call straight into another watched frame for the same function counts once
+            if function is not None and function in values and values[function] is not last:
+                last = values[function]
+                functions.append(getattr(last, 'name', last))
+            if node is not None:
+                last = None
+            value = values.get(node) if node is not None else None
+            if isinstance(value, ModelNode) and value.span is not None and value.span.source_map is not None:
+                where = value.span
+        if where is None:
+            self.stacks[(None, tuple(functions), None)] += 1
+        else:
+            root = getattr(where.source_map, 'root', where.source_map)
+            self.stacks[(root, tuple(functions), where.line)] += 1
+        self.samples += 1
+
+    def resolved(self):
+        # (file, functions, line) -> samples
+        stacks = Counter()
+        for (root, functions, line), count in self.stacks.items():
+            fnm = '(no source)' if root is None else self.files.get(root, '?')
+            stacks[(fnm, functions, line)] += count
+        return stacks
+
+    def write_collapsed(self, file):
+        # one `frame;frame;frame count` line per stack, as flamegraph.pl and speedscope read them
+        for (fnm, functions, line), count in sorted(self.resolved().items(), key=lambda item: str(item[0])):
+            frames = [os.path.basename(fnm)] + list(functions)
+            if line is not None:
+                frames.append('{}:{}'.format(os.path.basename(fnm), line))
+            print('{} {}'.format(';'.join(frame.replace(';', ':').replace(' ', '_') for frame in frames), count),
+                  file=file)
+
+    def report(self, file, top=10):
+        stacks = self.resolved()
+        total = max(1, self.samples)
+        own = Counter()
+        inclusive = Counter()
+        lines = Counter()
+        for (fnm, functions, line), count in stacks.items():
+            own[functions[-1] if len(functions) > 0 else '(top level)'] += count
+            for name in set(functions):
+                inclusive[name] += count
+            if line is not None:
+                lines[(fnm, line)] += count
+        print('{} samples every {:.1f}ms'.format(self.samples, self.interval * 1000), file=file)
+        print('{:<24} {:>8} {:>8}'.format('function', 'self', 'total'), file=file)
+        for name, count in own.most_common(top):
+            print('{:<24} {:>7.1f}% {:>7.1f}%'.format(
+                name, 100.0 * count / total, 100.0 * (inclusive[name] if name in inclusive else count) / total),
+                file=file)
+        if len(lines) > 0:
+            print('lines:', file=file)
+        for (fnm, line), count in lines.most_common(top):
+            source = self.sources.get(fnm, [])
+            text = source[line - 1].strip() if line <= len(source) else ''
+            print('{:>7.1f}% {:<20} {}'.format(100.0 * count / total, '{}:{}'.format(fnm, line), text), file=file)
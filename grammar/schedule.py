@@ -0,0 +1,146 @@
+import re
+import threading
+import multiprocessing
+from functools import partial
+from .context import Context
+from .emit import capture
+from .fun import parse_stmt
+from .model import Block
+from .sampler import watch
+
+# handlers declare what they change with a `mutates` attribute, e.g. process_fun.mutates = ();
+# anything undeclared is assumed to change the keywords and operators
+conservative = ('keywords', 'operators')
+# what forked workers rely on being as it was at fork time; writing C or filling the
+# specialization cache only matters in the parent
+worker_effects = ('keywords', 'operators', 'macros')
+
+nested_block = re.compile(r'([^\n]*)#\[ENDL\]#\n#\[INDENT\]#')
+leading_markers = re.compile(r'^(\s*#\[[A-Z]+\]#)*\s*')
+identifier = re.compile(r'[_a-zA-Z][_a-zA-Z0-9]*[?!]?')
+
+
+def nested_keywords(body):
+    # a nested block shows up in a body as `keyword header #[ENDL]#` followed by an indent
+    keywords = []
+    for match in nested_block.finditer(body):
+        line = leading_markers.sub('', match.group(1))
+        keyword = identifier.match(line)
+        if keyword is not None:
+            keywords.append(keyword.group())
+    return keywords
+
+
+def mutates(stmt, keywords):
+    if not isinstance(stmt, Block):
+        return ()
+    effects = set()
+    for keyword in [stmt.keyword] + nested_keywords(stmt.body):
+        handler = keywords.get(keyword)
+        effects.update(conservative if handler is None else getattr(handler, 'mutates', conservative))
+    return tuple(sorted(effects))
+
+
+def segments(program, keywords):
+    # runs of statements that leave the context alone, split by statements that may change it
+    segment = []
+    for stmt in program:
+        if len(mutates(stmt, keywords)) == 0:
+            segment.append(stmt)
+            continue
+        if len(segment) > 0:
+            yield True, segment
+            segment = []
+        yield False, [stmt]
+    if len(segment) > 0:
+        yield True, segment
+
+
+def run_stmt(stmt, context):
+    for stmt in parse_stmt(stmt, context):
+        if isinstance(stmt, Block):
+            context.keywords[stmt.keyword](stmt.header, stmt.body, context, context)
+        else:
+            context.emitter.emit(stmt)
+
+
+watch(run_stmt, node='stmt')
+
+
+def declarer(stmt, keywords):
+    return getattr(keywords.get(stmt.keyword), 'declare', None) if isinstance(stmt, Block) else None
+
+
+forked = None
+# forked workers find the program in a global, so one thread forks at a time
+fork_lock = threading.Lock()
+
+
+def run_forked(i, end):
+    # runs in a forked worker, which sees the program and context as they were at fork time.
+    # statements run since can only have declared things, so those declarations, up to the end
+    # of the segment i is in, are made here too
+    global forked
+    program, context, declared = forked
+    for j in range(declared, end):
+        declare = declarer(program[j], context.keywords)
+        if declare is not None:
+            declare(program[j].header, program[j].body, context)
+    forked = (program, context, max(declared, end))
+    emitter, sink = capture(context.emitter)
+    run_stmt(program[i], Context(context.op_parser, context.keywords, context.names, emitter, context.code,
+                                 context.stager, context.macros))
+    emitter.close()
+    return sink.getvalue()
+
+
+class Workers:
+    # one pool for a run of a program, forked when a segment first needs it and kept until
+    # a statement that may change what the workers rely on runs
+    def __init__(self, program, context, jobs):
+        self.program = program
+        self.context = context
+        self.jobs = jobs
+        self.pool = None
+
+    def run(self, start, end):
+        global forked
+        for i in range(start, end):
+            declare = declarer(self.program[i], self.context.keywords)
+            if declare is not None:
+                declare(self.program[i].header, self.program[i].body, self.context)
+        if self.pool is None:
+            with fork_lock:
+                forked = (self.program, self.context, start)
+                self.pool = multiprocessing.get_context('fork').Pool(self.jobs)
+                forked = None
+        for output in self.pool.imap(partial(run_forked, end=end), range(start, end)):
+            self.context.emitter.raw(output)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def run_program(program, context, jobs=None, min_segment=4):
+    if jobs is None or jobs < 2:
+        for stmt in program:
+            run_stmt(stmt, context)
+        return
+    workers = Workers(program, context, jobs)
+    start = 0
+    try:
+        for independent, stmts in segments(program, context.keywords):
+            if independent and len(stmts) >= min_segment:
+                workers.run(start, start + len(stmts))
+            else:
+                for stmt in stmts:
+                    run_stmt(stmt, context)
+                if not independent and not set(mutates(stmts[0], context.keywords)).isdisjoint(worker_effects):
+                    # the workers would run with the context as it was before this
+                    workers.close()
+            start += len(stmts)
+    finally:
+        workers.close()
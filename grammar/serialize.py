@@ -0,0 +1,324 @@
+import mmap
+import struct
+import hashlib
+import weakref
+from .core import core_grammar
+from .model import *
+from .operators import BinaryExpr, ChainExpr
+from .source import Span, Body
+
+# layout: stream header, counts, string offsets, string blob, node records, list records, list pool
+# every field and list item is a u32 whose low two bits tag it as a node, string, list or None
+
+MAGIC = b'OBSAST'
+FORMAT_VERSION = 1
+
+NODE, STRING, LIST, NONE = range(4)
+
+# an image starts with a stream header, then the counts for its tables; a binary output
+# stream writes the stream header once and the counts and tables for each statement
+stream_header = struct.Struct('<6sH16s')
+counts = struct.Struct('<IIIIII')
+node_record = struct.Struct('<BxxxIII')
+list_record = struct.Struct('<II')
+word = struct.Struct('<I')
+
+leaves = [Int, Float, String, Char, Identifier, Op, Symbol]
+
+schema = [
+    (Int, ['literal']),
+    (Float, ['literal']),
+    (String, ['literal']),
+    (Char, ['literal']),
+    (Identifier, ['literal']),
+    (Op, ['literal']),
+    (Symbol, ['symbol']),
+    (EmptyStmt, []),
+    (TupleTarget, ['targets']),
+    (CollectionTarget, ['surrounder', 'contents']),
+    (UnaryExpr, ['op', 'expr']),
+    (TrailerExpr, ['expr', 'surrounder', 'contents']),
+    (Block, ['keyword', 'header', 'body']),
+    (Assignment, ['name', 'expr']),
+    (Tuple, ['contents']),
+    (Collection, ['surrounder', 'contents']),
+    (PartialBinaryExpr, ['exprs']),
+    (BinaryExpr, ['op', 'left', 'right']),
+    (ChainExpr, ['elems']),
+]
+kinds = {cls: kind for kind, (cls, fields) in enumerate(schema)}
+kind_cache = {}
+
+
+def kind_of(value):
+    # nodes read from an image are subclasses of the model classes, so the kind is looked up
+    # along the mro; None for anything that isn't a node
+    t = type(value)
+    if t not in kind_cache:
+        kind_cache[t] = next((kinds[cls] for cls in t.__mro__ if cls in kinds), None)
+    return kind_cache[t]
+
+derived = {
+    Block: {'literal': lambda node: '{} {} #[ENDL]#\n#[INDENT]# {} #[ENDL]#\n#[DEDENT]#'.format(
+        node.keyword, node.header, node.body)},
+}
+
+views = {
+    CollectionTarget: {'contents': contents_view},
+    TrailerExpr: {'contents': contents_view},
+    Collection: {'contents': contents_view},
+}
+
+
+# grammar -> (its revision, its hash), since writing out the whole grammar costs more than most images
+grammar_hashes = weakref.WeakKeyDictionary()
+
+
+def grammar_hash(grammar=core_grammar):
+    cached = grammar_hashes.get(grammar)
+    if cached is None or cached[0] != grammar.revision:
+        text = '{}\n{}'.format(FORMAT_VERSION, grammar.gen_grammar())
+        cached = grammar_hashes[grammar] = (grammar.revision, hashlib.blake2b(text.encode(), digest_size=16).digest())
+    return cached[1]
+
+
+class Writer:
+    def __init__(self):
+        self.strings = {}
+        self.nodes = []
+        self.lists = []
+        self.pool = []
+        self.seen = {}
+
+    def string(self, string):
+        if string not in self.strings:
+            self.strings[string] = len(self.strings)
+        return self.strings[string]
+
+    def value(self, value):
+        if value is None:
+            return NONE
+        elif isinstance(value, str):
+            return self.string(value) << 2 | STRING
+        elif kind_of(value) is not None:
+            return self.node(value) << 2 | NODE
+        return self.list(value) << 2 | LIST
+
+    def list(self, values):
+        items = [self.value(v) for v in values]
+        self.lists.append((len(self.pool), len(items)))
+        self.pool += items
+        return len(self.lists) - 1
+
+    def node(self, node):
+        # shared subtrees are written once
+        if id(node) in self.seen:
+            return self.seen[id(node)][0]
+        kind = kind_of(node)
+        fields = [self.value(getattr(node, field)) for field in schema[kind][1]]
+        index = len(self.nodes)
+        self.seen[id(node)] = (index, node)
+        self.nodes.append(node_record.pack(kind, *(fields + [NONE] * (3 - len(fields)))))
+        return index
+
+    def dumps(self, stmts):
+        return write_header() + self.body(stmts)
+
+    def locations(self):
+        # where the written nodes came from, by their index in the image: the offsets of their
+        # spans, and for blocks the maps their bodies are parsed with
+        spans = [None] * len(self.nodes)
+        bodies = {}
+        for index, node in self.seen.values():
+            if node.span is not None:
+                spans[index] = (node.span.start, node.span.end)
+            body_map = getattr(getattr(node, 'body', None), 'source_map', None)
+            if body_map is not None:
+                bodies[index] = body_map
+        return spans, bodies
+
+    def body(self, stmts):
+        roots = self.list(stmts)
+        blobs = [s.encode() for s in self.strings]
+        offsets = [0]
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+        blob = b''.join(blobs)
+        blob += b'\0' * (-len(blob) % 4)
+        return b''.join([
+            counts.pack(len(blobs), len(self.nodes), len(self.lists), len(self.pool), roots, len(blob)),
+            b''.join(word.pack(o) for o in offsets),
+            blob,
+            b''.join(self.nodes),
+            b''.join(list_record.pack(*l) for l in self.lists),
+            b''.join(word.pack(item) for item in self.pool),
+        ])
+
+
+def write_header():
+    return stream_header.pack(MAGIC, FORMAT_VERSION, grammar_hash())
+
+
+def check_header(data, fnm='<bytes>'):
+    magic, version, ghash = stream_header.unpack_from(data)
+    if magic != MAGIC:
+        raise Exception('{} is not an AST image'.format(fnm))
+    if version != FORMAT_VERSION or ghash != grammar_hash():
+        raise Exception('AST image {} was built for a different grammar; re-parse its source'.format(fnm))
+    return stream_header.size
+
+
+def dumps(stmts):
+    return Writer().dumps(stmts)
+
+
+def dumps_body(stmts):
+    # an image without the stream header, for streams that have already written it
+    return Writer().body(stmts)
+
+
+def dump(stmts, fnm):
+    with open(fnm, 'wb') as f:
+        f.write(dumps(stmts))
+
+
+class LazyFields:
+    # fields are only decoded from the image the first time they are read
+    def __getattr__(self, name):
+        cls = type(self).__bases__[1]
+        fields = schema[kinds[cls]][1]
+        if name in fields:
+            image = self.__dict__['_image']
+            value = image.field(self.__dict__['_index'], fields.index(name))
+            if name in views.get(cls, {}):
+                value = views[cls][name](value)
+        elif name in derived.get(cls, {}):
+            value = derived[cls][name](self)
+        else:
+            raise AttributeError(name)
+        setattr(self, name, value)
+        return value
+
+
+body_field = schema[kinds[Block]][1].index('body')
+lazy_classes = {cls: type('Lazy{}'.format(cls.__name__), (LazyFields, cls), {}) for cls, fields in schema}
+
+
+class AstImage:
+    def __init__(self, data, fnm='<bytes>', file=None, headed=True):
+        # without headed, data is an image body whose stream header was checked elsewhere
+        self.file = file
+        self.data = data
+        start = check_header(data, fnm) if headed else 0
+        (self.num_strings, self.num_nodes, self.num_lists, pool_len, self.roots,
+         blob_len) = counts.unpack_from(self.data, start)
+        self.offsets_start = start + counts.size
+        self.blob_start = self.offsets_start + (self.num_strings + 1) * word.size
+        self.nodes_start = self.blob_start + blob_len
+        self.lists_start = self.nodes_start + self.num_nodes * node_record.size
+        self.pool_start = self.lists_start + self.num_lists * list_record.size
+        # anything after the image is left to whoever wrote it there
+        self.size = self.pool_start + pool_len * word.size
+        self.strings = {}
+        self.nodes = {}
+        self.root_items = None
+        self.source_map = None
+        self.spans = None
+        self.bodies = {}
+
+    def locate(self, source_map, spans, bodies):
+        # nodes read from now on get back the spans and body maps given by Writer.locations
+        self.source_map = source_map
+        self.spans = spans
+        self.bodies = bodies
+
+    def string(self, index):
+        if index not in self.strings:
+            start, end = struct.unpack_from('<II', self.data, self.offsets_start + index * word.size)
+            self.strings[index] = self.data[self.blob_start + start:self.blob_start + end].decode()
+        return self.strings[index]
+
+    def list_items(self, index):
+        start, length = list_record.unpack_from(self.data, self.lists_start + index * list_record.size)
+        return struct.unpack_from('<{}I'.format(length), self.data, self.pool_start + start * word.size)
+
+    def value(self, item):
+        tag, index = item & 3, item >> 2
+        if tag == NODE:
+            return self.node(index)
+        elif tag == STRING:
+            return self.string(index)
+        elif tag == LIST:
+            return [self.value(i) for i in self.list_items(index)]
+        return None
+
+    def field(self, index, field):
+        return self.value(node_record.unpack_from(self.data, self.nodes_start + index * node_record.size)[field + 1])
+
+    def node(self, index):
+        if index not in self.nodes:
+            kind = self.data[self.nodes_start + index * node_record.size]
+            cls = schema[kind][0]
+            if cls in leaves:
+                node = cls(self.field(index, 0))
+            else:
+                node = lazy_classes[cls].__new__(lazy_classes[cls])
+                node._image = self
+                node._index = index
+            if self.spans is not None and self.spans[index] is not None:
+                node.span = Span(self.spans[index][0], self.spans[index][1], self.source_map)
+            if index in self.bodies:
+                node.body = Body(self.field(index, body_field), self.bodies[index])
+            self.nodes[index] = node
+        return self.nodes[index]
+
+    def __len__(self):
+        return list_record.unpack_from(self.data, self.lists_start + self.roots * list_record.size)[1]
+
+    def __getitem__(self, i):
+        if self.root_items is None:
+            self.root_items = self.list_items(self.roots)
+        return self.value(self.root_items[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        if self.file is not None:
+            self.data.close()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load(fnm):
+    f = open(fnm, 'rb')
+    return AstImage(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), fnm, f)
+
+
+def loads(data):
+    return AstImage(data)
+
+
+def loads_body(data):
+    return AstImage(data, headed=False)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    from preprocessor import preprocess
+    from .fun import core_parser
+
+    argparser = ArgumentParser()
+    argparser.add_argument('fnm', help='source file to parse')
+    argparser.add_argument('out', help='AST image to write')
+    args = argparser.parse_args()
+
+    with open(args.fnm, 'r') as f:
+        text, source_map, indent_str = preprocess(f.read())
+    dump(core_parser.parse(text), args.out)
@@ -0,0 +1,162 @@
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+current_source = ContextVar('current_source', default=None)
+
+
+class SegmentMap:
+    # maps offsets in one preprocessing stage's output back to offsets in its input
+    # copied segments map one to one, inserted segments all map to their insertion point
+    def __init__(self):
+        self.out_starts = array('q')
+        self.in_starts = array('q')
+        self.copied = array('b')
+        self.length = 0
+
+    def copy(self, start, end):
+        if end <= start:
+            return
+        if len(self.copied) > 0 and self.copied[-1] and \
+                self.in_starts[-1] + self.length - self.out_starts[-1] == start:
+            self.length += end - start
+            return
+        self.out_starts.append(self.length)
+        self.in_starts.append(start)
+        self.copied.append(1)
+        self.length += end - start
+
+    def insert(self, pos, length):
+        if length <= 0:
+            return
+        self.out_starts.append(self.length)
+        self.in_starts.append(pos)
+        self.copied.append(0)
+        self.length += length
+
+    def __call__(self, offset):
+        i = bisect_right(self.out_starts, offset) - 1
+        if i < 0:
+            return 0
+        if self.copied[i]:
+            return self.in_starts[i] + offset - self.out_starts[i]
+        return self.in_starts[i]
+
+
+class Rewriter:
+    def __init__(self, text):
+        self.text = text
+        self.pieces = []
+        self.segments = SegmentMap()
+
+    def keep(self, start, end):
+        self.pieces.append(self.text[start:end])
+        self.segments.copy(start, end)
+
+    def insert(self, pos, string):
+        self.pieces.append(string)
+        self.segments.insert(pos, len(string))
+
+    def result(self):
+        return ''.join(self.pieces), self.segments
+
+
+class SourceMap:
+    def __init__(self, text):
+        self.line_starts = array('q', [0])
+        pos = text.find('\n')
+        while pos >= 0:
+            self.line_starts.append(pos + 1)
+            pos = text.find('\n', pos + 1)
+        self.stages = []
+
+    def add_stage(self, segments):
+        self.stages.append(segments)
+
+    def original_offset(self, offset):
+        for stage in reversed(self.stages):
+            offset = stage(offset)
+        return offset
+
+    def location(self, offset):
+        # 1-based (line, column) in the original source
+        offset = self.original_offset(offset)
+        line = bisect_right(self.line_starts, offset) - 1
+        return line + 1, offset - self.line_starts[line] + 1
+
+    def line(self, offset):
+        return self.location(offset)[0]
+
+
+class Span:
+    __slots__ = ['start', 'end', 'source_map', 'resolved']
+
+    def __init__(self, start, end, source_map=None):
+        self.start = start
+        self.end = end
+        self.source_map = source_map
+        self.resolved = None
+
+    def resolve(self):
+        if self.source_map is None:
+            return None
+        if self.resolved is None:
+            self.resolved = (self.source_map.location(self.start),
+                             self.source_map.location(max(self.start, self.end - 1)))
+        return self.resolved
+
+    @property
+    def line(self):
+        resolved = self.resolve()
+        return None if resolved is None else resolved[0][0]
+
+    def __repr__(self):
+        resolved = self.resolve()
+        if resolved is None:
+            return 'Span({}-{})'.format(self.start, self.end)
+        (line, col), (end_line, end_col) = resolved
+        return 'Span({}:{}-{}:{})'.format(line, col, end_line, end_col)
+
+
+class BodyMap:
+    # a block body is rebuilt from the block's statements, so offsets in it map back through the
+    # text the block was parsed from a statement at a time, each to where its statement started.
+    # a nested block's body is mapped by that block's own map, from inner[i] = (map, body start)
+    def __init__(self, offsets, starts, inner, parent):
+        self.offsets = offsets
+        self.starts = starts
+        self.inner = inner
+        self.parent = parent
+
+    @property
+    def root(self):
+        return getattr(self.parent, 'root', self.parent)
+
+    def location(self, offset):
+        i = max(0, bisect_right(self.offsets, offset) - 1)
+        if self.inner[i] is not None:
+            body_map, body_start = self.inner[i]
+            if offset - self.offsets[i] >= body_start:
+                return body_map.location(offset - self.offsets[i] - body_start)
+        return self.parent.location(self.starts[i])
+
+    def line(self, offset):
+        return self.location(offset)[0]
+
+
+class Body(str):
+    # a block body that carries its source map, so whatever is parsed from it maps back too
+    def __new__(cls, text, source_map=None):
+        body = super().__new__(cls, text)
+        body.source_map = source_map
+        return body
+
+
+@contextmanager
+def mapping(source_map):
+    token = current_source.set(source_map)
+    try:
+        yield source_map
+    finally:
+        current_source.reset(token)
@@ -0,0 +1,118 @@
+import re
+from .fun import header_parser
+from .cgen import c_number, c_array
+
+# sparse name(B, C, n)
+#     1 0 -2 0
+#     0 0  0 3
+# generates void name(const double *B, double *C, int n) computing C = A B for the fixed
+# matrix A in the body, with B and C row-major and n columns wide
+
+markers = re.compile(r'#\[[A-Z]+\]#')
+c_identifier = re.compile(r'[_a-zA-Z][_a-zA-Z0-9]*')
+
+# rows with at most this fraction of nonzeros are unrolled, denser ones loop over packed arrays
+unroll_density = 0.25
+
+
+def parse_matrix(body):
+    rows = []
+    for line in body.split('#[ENDL]#'):
+        tokens = markers.sub(' ', line).split()
+        row = []
+        negate = False
+        for token in tokens:
+            if token == '-':
+                negate = not negate
+                continue
+            try:
+                value = float(token)
+            except ValueError:
+                raise Exception('Expected a number in a sparse matrix row, got {}'.format(token))
+            row.append(-value if negate else value)
+            negate = False
+        if len(row) > 0:
+            rows.append(row)
+    if len(rows) == 0:
+        raise Exception('A sparse matrix needs at least one row')
+    if any(len(row) != len(rows[0]) for row in rows):
+        raise Exception('Rows of a sparse matrix must all have {} entries'.format(len(rows[0])))
+    return rows
+
+
+def term(value, operand):
+    if value == 1:
+        return operand
+    elif value == -1:
+        return '-{}'.format(operand)
+    return '{} * {}'.format(c_number(value), operand)
+
+
+# the kernel's own locals are prefixed so they can't shadow or clash with the parameters
+prefix = '_sp_'
+col, nz, coef, src = ('{}{}'.format(prefix, local) for local in ['k', 'p', 'a', 'row'])
+
+
+def sparse_kernel(writer, name, params, rows, density=unroll_density):
+    b, c, n = params
+    width = len(rows[0])
+    packed = []
+    for i, row in enumerate(rows):
+        nonzeros = [(j, v) for j, v in enumerate(row) if v != 0]
+        if len(nonzeros) > density * width:
+            writer.line(c_array('double', '{}_v{}'.format(name, i), [c_number(v) for j, v in nonzeros]))
+            writer.line(c_array('int', '{}_j{}'.format(name, i), [str(j) for j, v in nonzeros]))
+            packed.append(i)
+    with writer.block('void {}(const double *restrict {}, double *restrict {}, int {})'.format(name, b, c, n)):
+        for i, row in enumerate(rows):
+            nonzeros = [(j, v) for j, v in enumerate(row) if v != 0]
+            out = '{}[{} * {} + {}]'.format(c, i, n, col)
+            if i in packed:
+                with writer.block('for (int {0} = 0; {0} < {1}; {0}++)'.format(col, n)):
+                    writer.line('{} = 0.0;'.format(out))
+                with writer.block('for (int {0} = 0; {0} < {1}; {0}++)'.format(nz, len(nonzeros))):
+                    writer.line('const double {} = {}_v{}[{}];'.format(coef, name, i, nz))
+                    writer.line('const double *restrict {} = {} + {}_j{}[{}] * {};'.format(src, b, name, i, nz, n))
+                    with writer.block('for (int {0} = 0; {0} < {1}; {0}++)'.format(col, n)):
+                        writer.line('{} += {} * {}[{}];'.format(out, coef, src, col))
+                continue
+            terms = [term(v, '{}[{} * {} + {}]'.format(b, j, n, col)) for j, v in nonzeros]
+            with writer.block('for (int {0} = 0; {0} < {1}; {0}++)'.format(col, n)):
+                writer.line('{} = {};'.format(out, ' + '.join(terms) if len(terms) > 0 else '0.0'))
+
+
+def dense_kernel(writer, name):
+    # the reference the generated kernels are measured against
+    with writer.block('void {}(const double *restrict A, const double *restrict B, double *restrict C, '
+                      'int m, int l, int n)'.format(name)):
+        with writer.block('for (int i = 0; i < m; i++)'):
+            with writer.block('for (int k = 0; k < n; k++)'):
+                writer.line('C[i * n + k] = 0.0;')
+            with writer.block('for (int p = 0; p < l; p++)'):
+                writer.line('const double a = A[i * l + p];')
+                with writer.block('for (int k = 0; k < n; k++)'):
+                    writer.line('C[i * n + k] += a * B[p * n + k];')
+
+
+def process_sparse(header, body, ext_context, global_context):
+    header = header_parser.parse(header)
+    name = header.name.name
+    params = [param.name for param in header.params[1]]
+    if len(params) != 3:
+        raise Exception('sparse {} takes (input, output, columns), got {}'.format(name, ', '.join(params)))
+    # checked before any C is written. a parameter can't reuse the kernel's locals, its name, or
+    # the name_v/name_j tables it reads, all of which it would shadow
+    for param in params:
+        taken = param.startswith(prefix) or param == name or param.startswith(name + '_')
+        if taken or params.count(param) > 1 or c_identifier.fullmatch(param) is None:
+            raise Exception('sparse {} cannot use {} as a parameter name in C'.format(name, param))
+    if ext_context.code is None:
+        raise Exception('sparse {} generates C; give the interpreter somewhere to write it'.format(name))
+    rows = parse_matrix(body)
+    ext_context.emitter.event('kernel', name)
+    sparse_kernel(ext_context.code, name, params, rows)
+    ext_context.code.line()
+
+
+# writes to the shared C output, so it always runs in order
+process_sparse.mutates = ('code',)
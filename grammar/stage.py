@@ -0,0 +1,553 @@
+import re
+import operator
+from .fun import body_parser, expr_parser, parse_ops, parse_stmt
+from .model import *
+from .operators import BinaryExpr, ChainExpr
+from .persistent import Vector, Slice
+from .unpack import plan_for
+from .infer import Inference, INT, UNKNOWN, value_type, compile_typed
+from .arrays import array_types, is_list, from_values, scalar, elements, negate, elementwise, compare
+from .cse import eliminate
+from .sampler import watch
+
+# partial evaluation of fun bodies: values known while staging are plain Python values,
+# anything else is a Dynamic carrying the residual expression that computes it at run time
+
+
+class Dynamic:
+    __slots__ = ['node']
+
+    def __init__(self, node):
+        self.node = node
+
+
+binary_ops = {
+    '^': operator.pow,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '+': operator.add,
+    '-': operator.sub,
+    '&&': lambda a, b: a and b,
+    '||': lambda a, b: a or b,
+}
+
+chain_ops = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+
+# x op identity == x, and x op zero == zero, for operand values known while staging. && and ||
+# give back their left side when it decides them, so theirs only count on the left. x * 0 is
+# only 0 for an int x: a list gives a list of zeros and a float 0.0, so x has to be typed int
+identities = {'*': 1, '+': 0}
+left_identities = {'||': False, '&&': True}
+right_identities = {'-': 0, '^': 1}
+zeros = {'*': 0}
+left_zeros = {'&&': False, '||': True}
+
+builtins = {
+    'range': lambda *args: tuple(range(*args)),
+    'len': len,
+    'sum': sum,
+    'min': min,
+    'max': max,
+    'abs': abs,
+}
+
+constants = {'true': True, 'false': False}
+
+loop_header = re.compile(r'^\s*([_a-zA-Z][_a-zA-Z0-9]*)\s+in\s+(.*)$', re.S)
+
+sequences = (tuple, list, Vector, Slice) + array_types
+
+
+def is_static(value):
+    return not isinstance(value, Dynamic)
+
+
+def reify(value):
+    if isinstance(value, Dynamic):
+        return value.node
+    elif isinstance(value, bool):
+        return Identifier('true' if value else 'false')
+    elif isinstance(value, int):
+        return Int(str(value))
+    elif isinstance(value, float):
+        return Float(repr(value))
+    elif isinstance(value, str):
+        return String('"{}"'.format(value))
+    elif isinstance(value, sequences):
+        return Tuple([reify(v) for v in elements(value)])
+    elif isinstance(value, (ModelNode, BinaryExpr, ChainExpr)):
+        return value
+    raise Exception('Cannot put {} back into a residual program'.format(value))
+
+
+def freeze(value):
+    if isinstance(value, sequences):
+        return ('tuple', tuple(freeze(v) for v in elements(value)))
+    return (type(value).__name__, value)
+
+
+def show(value):
+    if isinstance(value, sequences):
+        return '({})'.format(', '.join(show(v) for v in elements(value)))
+    return repr(value)
+
+
+def assigned(stmts):
+    names = set()
+    for stmt in stmts:
+        if isinstance(stmt, Assignment) and isinstance(stmt.name, Identifier):
+            names.add(stmt.name.name)
+    return names
+
+
+def reads(node, names):
+    # adds the names node reads; False if it can't tell
+    if isinstance(node, Identifier):
+        names.add(node.name)
+    elif isinstance(node, (Int, Float, String, Char, Symbol)):
+        pass
+    elif isinstance(node, BinaryExpr):
+        return reads(node.left, names) and reads(node.right, names)
+    elif isinstance(node, UnaryExpr):
+        return reads(node.expr, names)
+    elif isinstance(node, ChainExpr):
+        return all(reads(e, names) for e in node.elems[::2])
+    elif isinstance(node, Tuple):
+        return all(reads(c, names) for c in node.contents)
+    elif isinstance(node, Call):
+        return reads(node.fn, names) and all(reads(a, names) for a in node.args)
+    elif isinstance(node, Index):
+        return reads(node.expr, names) and reads(node.index, names)
+    else:
+        return False
+    return True
+
+
+def pure(node):
+    # whether leaving node uncomputed loses nothing: it calls nothing, and isn't a list or tuple
+    # literal an operator would broadcast or repeat over
+    if isinstance(node, (Identifier, Int, Float, String, Char, Symbol)):
+        return True
+    elif isinstance(node, BinaryExpr):
+        return pure(node.left) and pure(node.right)
+    elif isinstance(node, UnaryExpr):
+        return pure(node.expr)
+    elif isinstance(node, ChainExpr):
+        return all(pure(e) for e in node.elems[::2])
+    elif isinstance(node, Index):
+        return pure(node.expr) and pure(node.index)
+    return False
+
+
+def droppable(value):
+    if is_static(value):
+        return not isinstance(value, sequences)
+    return pure(value.node)
+
+
+def matches(value, constant):
+    # 1 is not True, nor 0 False, as far as the identities go
+    return is_static(value) and type(value) is type(constant) and value == constant
+
+
+def prune(stmts):
+    # drops assignments nothing reads afterwards, until a statement it can't see into
+    kept = []
+    live = set()
+    for i in range(len(stmts) - 1, -1, -1):
+        stmt = stmts[i]
+        if isinstance(stmt, Assignment) and isinstance(stmt.name, Identifier) and i < len(stmts) - 1:
+            if stmt.name.name not in live:
+                continue
+            live.discard(stmt.name.name)
+            stmt = stmt.expr
+        if not reads(stmt, live):
+            return stmts[:i + 1] + kept[::-1]
+        kept.append(stmts[i])
+    return kept[::-1]
+
+
+class Fun:
+    def __init__(self, name, params, body, context):
+        self.name = name
+        self.params = params
+        self.text = body
+        self.context = context
+        self.parsed = None
+
+    def body(self):
+        if self.parsed is None:
+            self.parsed = parse_body(self.text, self.context)
+        return self.parsed
+
+    def __getstate__(self):
+        # the context is the running interpreter's, so a snapshot is given one when it's loaded
+        state = dict(self.__dict__)
+        state['context'] = None
+        return state
+
+
+def parse_body(text, context):
+    return [s for stmt in body_parser.parse(text, trace=False) for s in parse_stmt(stmt, context)]
+
+
+class Specialization:
+    def __init__(self, fun, static):
+        self.fun = fun
+        self.static = static
+        self.params = [p for p in fun.params if p not in static]
+        self.name = '{}[{}]'.format(fun.name, ', '.join('{} = {}'.format(k, show(v)) for k, v in static.items()))
+        self.body = None
+        self.value = None
+
+
+def bind(target, args):
+    env = dict(target.static) if isinstance(target, Specialization) else {}
+    env.update(zip(target.params, args))
+    return env
+
+
+class Stager:
+    def __init__(self, max_depth=64, cse=False):
+        self.funs = {}
+        self.cache = {}
+        self.specs = {}
+        # fun name -> its specializations, for calls that can run one
+        self.specs_of = {}
+        self.bodies = {}
+        # id(node) -> (node, its parsed parts), holding the node so the id stays its own
+        self.parsed = {}
+        self.max_depth = max_depth
+        # hoist repeated subexpressions of residual bodies into temporaries
+        self.cse = cse
+        # (specialization, argument types) -> typed code, or None where inference fell short
+        self.typed = {}
+        self.returns = {}
+        # calls answered by typed code rather than by staging
+        self.typed_runs = 0
+        self.depth = 0
+        self.hits = 0
+        self.misses = 0
+
+    def define(self, name, params, body, context):
+        self.funs[name] = Fun(name, params, body, context)
+
+    def specialize(self, name, static):
+        # one specialization per function and static-argument signature
+        fun = self.funs[name]
+        key = (name, tuple(sorted((k, freeze(v)) for k, v in static.items())))
+        if key in self.cache:
+            self.hits += 1
+            return self.cache[key]
+        self.misses += 1
+        spec = Specialization(fun, {p: static[p] for p in fun.params if p in static})
+        # cached before staging the body, so recursive calls become calls to the residual function
+        self.cache[key] = spec
+        self.specs[spec.name] = spec
+        self.specs_of.setdefault(name, []).append(spec)
+        env = dict(spec.static)
+        for param in spec.params:
+            env[param] = Dynamic(Identifier(param))
+        body, spec.value = self.nested(fun, env)
+        spec.body = prune(body)
+        if self.cse:
+            spec.body = eliminate(spec.body)
+        return spec
+
+    def nested(self, fun, env):
+        if self.depth >= self.max_depth:
+            raise Exception('Staging {} nested more than {} calls deep'.format(fun.name, self.max_depth))
+        self.depth += 1
+        try:
+            return self.stage(fun.body(), env, fun.context)
+        finally:
+            self.depth -= 1
+
+    def call(self, name, args):
+        # runs a function or a specialization with every argument known
+        target = self.specs[name] if name in self.specs else self.funs[name]
+        if isinstance(target, Specialization):
+            code = self.typed_code(target, args)
+            if code is not None:
+                self.typed_runs += 1
+                return code(bind(target, args))
+            residual, value = self.stage(target.body, bind(target, args), target.fun.context)
+        else:
+            residual, value = self.nested(target, bind(target, args))
+        if not is_static(value) or len(residual) > 1:
+            raise Exception('{} depends on values that are only known at run time'.format(name))
+        return value
+
+    def specialized(self, name, args):
+        # a finished specialization of name whose static values are these arguments, and the
+        # arguments left for its parameters
+        given = dict(zip(self.funs[name].params, args))
+        for spec in self.specs_of.get(name, []):
+            if spec.body is not None and all(freeze(given[p]) == freeze(v) for p, v in spec.static.items()):
+                return spec, [given[p] for p in spec.params]
+        return None, None
+
+    def typed_code(self, spec, args):
+        key = (spec.name, tuple(value_type(a) for a in args))
+        if key not in self.typed:
+            inference = self.infer(spec, key[1])
+            self.typed[key] = compile_typed(spec.body, inference, builtins)
+        return self.typed[key]
+
+    def infer(self, target, types=()):
+        # labels a fun or specialization body given its argument types, unknown where not given
+        env = {param: UNKNOWN for param in target.params}
+        env.update(zip(target.params, types))
+        if isinstance(target, Specialization):
+            env.update((p, value_type(v)) for p, v in target.static.items())
+            inference = Inference(self, target.fun.context, self.returns)
+            inference.body(target.body, env)
+        else:
+            inference = Inference(self, target.context, self.returns)
+            inference.body(target.body(), env)
+        return inference
+
+    def stage(self, stmts, env, context, result=True):
+        # residual statements and the value of the last statement, which ends the residual
+        # statements when result is set
+        residual = []
+        value = None
+        for stmt in stmts:
+            if isinstance(stmt, Assignment):
+                value = self.assign(stmt, env, residual, context)
+            elif isinstance(stmt, Block) and stmt.keyword == 'for':
+                var, iterable, body = self.for_loop(stmt, context)
+                value = self.loop(var, self.eval(iterable, env, context), body, env, residual, context)
+            elif isinstance(stmt, Loop):
+                value = self.loop(stmt.var, self.eval(stmt.iterable, env, context), stmt.body, env, residual,
+                                  context)
+            elif isinstance(stmt, Block):
+                residual.append(stmt)
+                value = Dynamic(stmt)
+            else:
+                value = self.eval(stmt, env, context)
+                if not is_static(value):
+                    residual.append(value.node)
+        if result and is_static(value) and value is not None:
+            residual.append(reify(value))
+        elif result and not is_static(value) and (len(residual) == 0 or residual[-1] is not value.node):
+            residual.append(value.node)
+        return residual, value
+
+    def assign(self, stmt, env, residual, context):
+        value = self.eval(stmt.expr, env, context)
+        if not isinstance(stmt.name, Identifier):
+            if not is_static(value):
+                raise Exception('Cannot stage {} from a value only known at run time'.format(stmt.name))
+            plan_for(stmt).run(value, env)
+            return value
+        name = stmt.name.name
+        if is_static(value):
+            env[name] = value
+            return value
+        if not (isinstance(value.node, Identifier) and value.node.name == name):
+            residual.append(Assignment(stmt.name, value.node))
+        env[name] = Dynamic(Identifier(name))
+        return env[name]
+
+    def for_loop(self, stmt, context):
+        # the variable, collection and parsed body of a for block
+        if id(stmt) not in self.parsed:
+            match = loop_header.match(stmt.header)
+            if match is None:
+                raise Exception('Expected for name in collection, got {}'.format(stmt.header))
+            if stmt.body not in self.bodies:
+                self.bodies[stmt.body] = parse_body(stmt.body, context)
+            iterable = cata(expr_parser.parse(match.group(2)), lambda ast: parse_ops(ast, context))
+            self.parsed[id(stmt)] = (stmt, (match.group(1), iterable, self.bodies[stmt.body]))
+        return self.parsed[id(stmt)][1]
+
+    def arguments(self, node, context):
+        # call arguments are raw chunks until they're first needed
+        if id(node) not in self.parsed:
+            args = [cata(node.contents.element(i), lambda ast: parse_ops(ast, context))
+                    for i in range(node.contents.num_elements())]
+            self.parsed[id(node)] = (node, args)
+        return self.parsed[id(node)][1]
+
+    def loop(self, var, iterable, body, env, residual, context):
+        if is_static(iterable):
+            # unrolled: every iteration is staged with the loop variable known
+            values = []
+            for item in elements(iterable):
+                env[var] = item
+                stmts, value = self.stage(body, env, context, result=False)
+                residual += stmts
+                values.append(value)
+            if all(is_static(v) for v in values):
+                return tuple(values)
+            return Dynamic(Tuple([reify(v) for v in values]))
+        # a residual loop; whatever it assigns is unknown after it
+        env[var] = Dynamic(Identifier(var))
+        for name in assigned(body):
+            env[name] = Dynamic(Identifier(name))
+        stmts, value = self.stage(body, env, context, result=False)
+        loop = Loop(var, iterable.node, stmts)
+        residual.append(loop)
+        return Dynamic(loop)
+
+    def eval(self, node, env, context):
+        if isinstance(node, (Int, Float)):
+            return node.value
+        elif isinstance(node, String):
+            return node.string
+        elif isinstance(node, Char):
+            return node.char
+        elif isinstance(node, Symbol):
+            return node
+        elif isinstance(node, Identifier):
+            if node.name in env:
+                return env[node.name]
+            return constants.get(node.name, Dynamic(node))
+        elif isinstance(node, Tuple):
+            values = [self.eval(c, env, context) for c in node.contents]
+            if all(is_static(v) for v in values):
+                return tuple(values)
+            return Dynamic(Tuple([reify(v) for v in values]))
+        elif isinstance(node, Collection) and node.surrounder == '[':
+            values = [self.eval(e, env, context) for e in self.arguments(node, context)]
+            if all(is_static(v) for v in values):
+                return from_values(values)
+            return Dynamic(node)
+        elif isinstance(node, UnaryExpr):
+            value = self.eval(node.expr, env, context)
+            if is_static(value) and is_list(value):
+                return negate(value) if str(node.op) == '-' else from_values(not v for v in elements(value))
+            if is_static(value):
+                return -value if str(node.op) == '-' else not value
+            return Dynamic(UnaryExpr(node.op, value.node))
+        elif isinstance(node, BinaryExpr):
+            return self.binary(node, self.eval(node.left, env, context), self.eval(node.right, env, context),
+                               context)
+        elif isinstance(node, ChainExpr):
+            return self.chain(node, env, context)
+        elif isinstance(node, TrailerExpr):
+            args = [self.eval(arg, env, context) for arg in self.arguments(node, context)]
+            if node.surrounder == '(':
+                return self.apply(node.expr, args, env, context)
+            elif node.surrounder == '[' and len(args) == 1:
+                return self.index(self.eval(node.expr, env, context), args[0])
+        elif isinstance(node, Call):
+            return self.apply(node.fn, [self.eval(a, env, context) for a in node.args], env, context)
+        elif isinstance(node, Index):
+            return self.index(self.eval(node.expr, env, context), self.eval(node.index, env, context))
+        return Dynamic(node)
+
+    def is_int(self, value, context):
+        # whether value is an int whatever the names in it turn out to be
+        if is_static(value):
+            return type(value) is int
+        return Inference(self, context).expr(value.node, {}) == INT
+
+    def binary(self, node, left, right, context):
+        op = str(node.op)
+        if is_static(left) and is_static(right) and op in binary_ops:
+            if is_list(left) or is_list(right):
+                return elementwise(binary_ops[op], left, right)
+            return binary_ops[op](left, right)
+        if op in left_zeros and matches(left, left_zeros[op]):
+            return left
+        if op in left_identities and matches(left, left_identities[op]):
+            return right
+        for value, other in [(left, right), (right, left)]:
+            if op in zeros and matches(value, zeros[op]) and droppable(other) and self.is_int(other, context):
+                return value
+            if op in identities and matches(value, identities[op]):
+                return other
+        if op in right_identities and matches(right, right_identities[op]):
+            return left
+        return Dynamic(BinaryExpr(node.op, reify(left), reify(right)))
+
+    def chain(self, node, env, context):
+        values = [self.eval(e, env, context) if i % 2 == 0 else e for i, e in enumerate(node.elems)]
+        if all(is_static(v) for v in values[::2]) and any(is_list(v) for v in values[::2]):
+            return compare([chain_ops[str(op)] for op in values[1::2]], values[::2])
+        if all(is_static(v) for v in values[::2]):
+            return all(chain_ops[str(values[i])](values[i - 1], values[i + 1]) for i in range(1, len(values), 2))
+        return Dynamic(ChainExpr([reify(v) if i % 2 == 0 else v for i, v in enumerate(values)]))
+
+    def index(self, value, index):
+        if is_static(value) and is_static(index):
+            return scalar(value[index])
+        return Dynamic(Index(reify(value), reify(index)))
+
+    def apply(self, fn, args, env, context):
+        name = fn.name if isinstance(fn, Identifier) else None
+        static = all(is_static(a) for a in args)
+        if name in builtins and name not in env and static:
+            return scalar(builtins[name](*args))
+        if name in self.specs and static:
+            return self.call(name, args)
+        if name in self.funs and name not in env:
+            fun = self.funs[name]
+            if static:
+                # a call an existing specialization covers runs its typed code where it has any
+                spec, rest = self.specialized(name, args)
+                code = None if spec is None else self.typed_code(spec, rest)
+                if code is not None:
+                    self.typed_runs += 1
+                    return code(bind(spec, rest))
+                # fully known calls are run, not specialized, so they don't fill the cache
+                residual, value = self.nested(fun, dict(zip(fun.params, args)))
+                if is_static(value) and len(residual) <= 1:
+                    return value
+            known = {p: a for p, a in zip(fun.params, args) if is_static(a)}
+            if len(known) > 0:
+                spec = self.specialize(name, known)
+                if spec.body is not None and len(spec.params) == 0 and is_static(spec.value) and \
+                        len(spec.body) <= 1:
+                    return spec.value
+                return Dynamic(Call(Identifier(spec.name), [a.node for a in args if not is_static(a)]))
+        return Dynamic(Call(fn, [reify(a) for a in args]))
+
+
+watch(Stager.nested, function='fun')
+watch(Stager.call, function='target')
+watch(Stager.stage, node='stmt')
+watch(Stager.eval, node='node')
+
+
+def stager_of(context):
+    if context.stager is None:
+        raise Exception('This interpreter has no stager to specialize functions with')
+    return context.stager
+
+
+def process_specialize(header, body, ext_context, global_context):
+    # specialize power
+    #     n = 3
+    # emits power with n fixed at 3 and the rest of its arguments left as parameters
+    stager = stager_of(ext_context)
+    name = header.strip()
+    if name not in stager.funs:
+        raise Exception('Cannot specialize unknown function {}'.format(name))
+    static = {}
+    for stmt in parse_body(body, ext_context):
+        if not isinstance(stmt, Assignment) or not isinstance(stmt.name, Identifier):
+            raise Exception('specialize {} takes lines of the form name = value'.format(name))
+        value = stager.eval(stmt.expr, dict(static), ext_context)
+        if not is_static(value):
+            raise Exception('{} must be known while staging {}'.format(stmt.name.name, name))
+        static[stmt.name.name] = value
+    spec = stager.specialize(name, static)
+    ext_context.emitter.event('function', spec.name)
+    for stmt in spec.body:
+        ext_context.emitter.emit(stmt)
+    ext_context.emitter.event('end_function', spec.name)
+
+
+# fills the shared specialization cache, so it runs in order
+process_specialize.mutates = ('specializations',)
+
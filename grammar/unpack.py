@@ -0,0 +1,102 @@
+from .model import Identifier, TupleTarget, CollectionTarget
+from .persistent import split_top, target_name, arrows, identifier, evaluate, parse_lexemes
+from .arrays import scalar
+
+# destructuring targets compiled once into flat unpack plans: every arity and key check comes
+# first, then each name is stored straight from the slot holding its value, so a value that
+# doesn't match the target binds nothing
+
+
+class Plan:
+    def __init__(self, target):
+        self.target = target
+        self.steps = []
+        self.stores = []
+        self.constants = {}
+        self.slots = 1
+        self.build(target, 'v0')
+        lines = ['def unpack(v0, env):'] + ['    ' + step for step in self.steps]
+        lines += ['    env[{!r}] = {}'.format(name, source) for name, source in self.stores]
+        self.source = '\n'.join(lines)
+        # elements of a packed array come out as numpy scalars, and are stored as python numbers
+        namespace = dict(self.constants, scalar=scalar)
+        exec(compile(self.source, '<unpack {}>'.format(target), 'exec'), namespace)
+        self.run = namespace['unpack']
+
+    def slot(self, source):
+        # a value read more than once, or checked, gets a slot of its own
+        name = 'v{}'.format(self.slots)
+        self.slots += 1
+        self.steps.append('{} = {}'.format(name, source))
+        return name
+
+    def constant(self, value):
+        name = 'k{}'.format(len(self.constants))
+        self.constants[name] = value
+        return name
+
+    def build(self, target, source):
+        if isinstance(target, Identifier):
+            self.stores.append((target.name, source))
+        elif isinstance(target, TupleTarget):
+            targets = list(target.targets)
+            slot = source if source.isidentifier() else self.slot(source)
+            self.steps.append("if len({0}) != {1}: raise Exception("
+                              "'Cannot unpack {{}} values into {1} targets'.format(len({0})))".format(slot, len(targets)))
+            for i, t in enumerate(targets):
+                self.build(t, 'scalar({}[{}])'.format(slot, i))
+        elif isinstance(target, CollectionTarget) and target.surrounder == '[':
+            self.sequence(target.contents, source)
+        elif isinstance(target, CollectionTarget) and target.surrounder == '{':
+            self.map(target.contents, source)
+        else:
+            raise Exception('Cannot destructure into {}'.format(target))
+
+    def sequence(self, contents, source):
+        # the same patterns as persistent.bind_sequence
+        groups = split_top([str(l) for l in contents], {':'})
+        heads = [target_name(names) for group in groups[:-1] for names in split_top(group, {','})]
+        rest = None
+        if len(groups) > 1:
+            rest = target_name(groups[-1])
+        else:
+            heads += [target_name(names) for names in split_top(groups[-1], {','}) if len(names) > 0]
+        slot = source if source.isidentifier() else self.slot(source)
+        text = self.constant(' '.join(str(l) for l in contents))
+        self.steps.append("if len({0}) {1} {2}: raise Exception("
+                          "'Cannot unpack {{}} values into {{}}'.format(len({0}), {3}))".format(
+                              slot, '<' if rest is not None else '!=', len(heads), text))
+        for i, name in enumerate(heads):
+            self.stores.append((name, 'scalar({}[{}])'.format(slot, i)))
+        if rest is not None:
+            self.stores.append((rest, '{}[{}:]'.format(slot, len(heads))))
+
+    def map(self, contents, source):
+        # the same patterns as persistent.bind_map
+        entries = [split_top(e, arrows) for e in split_top([str(l) for l in contents], {',', ';'}) if len(e) > 0]
+        slot = source if source.isidentifier() else self.slot(source)
+        text = self.constant(' '.join(str(l) for l in contents))
+        for groups in entries:
+            if len(groups) != 2:
+                raise Exception('Expected key -> name, got {}'.format(' '.join(str(l) for l in contents)))
+            name = target_name(groups[1])
+            if len(groups[0]) == 1 and identifier.match(groups[0][0]) is not None:
+                if len(entries) != 1:
+                    raise Exception('Cannot unpack a map into {}'.format(' '.join(str(l) for l in contents)))
+                self.steps.append("if len({0}) != 1: raise Exception("
+                                  "'Cannot unpack {{}} entries into {{}}'.format(len({0}), {1}))".format(slot, text))
+                entry = self.slot('next(iter({}.items()))'.format(slot))
+                self.stores.append((groups[0][0], '{}[0]'.format(entry)))
+                self.stores.append((name, '{}[1]'.format(entry)))
+            else:
+                key = self.constant(evaluate(parse_lexemes(groups[0])))
+                missing = self.constant('Key {} not found'.format(' '.join(groups[0])))
+                self.steps.append('if {} not in {}: raise Exception({})'.format(key, slot, missing))
+                self.stores.append((name, '{}[{}]'.format(slot, key)))
+
+
+def plan_for(stmt):
+    # the plan is built the first time an assignment runs and kept on the node
+    if stmt.plan is None:
+        stmt.plan = Plan(stmt.name)
+    return stmt.plan
@@ -1,15 +1,32 @@
+import io
+import os
+import sys
+import time
 import tatsu
+import multiprocessing
 from argparse import ArgumentParser
+from functools import partial
 from preprocessor import preprocess
-from grammar.core import core_grammar
-from grammar.fun import process_fun, parse_ops
+from grammar.fun import core_parser, process_fun, process_for, parse_ops
+from grammar.stage import Stager, process_specialize
+from grammar.macros import Expander, process_macro
+from grammar.infer import report as type_report
+from grammar.sparse import process_sparse
+from grammar.cgen import SourceWriter
 from grammar.model import PartialBinaryExpr, Block, cata
+from grammar.schedule import run_program
 from grammar.context import Context
+from grammar.names import NameTable, interning
+from grammar.hashcons import NodeTable, hashconsing
+from grammar.emit import emitters, make_emitter, capture
+from grammar.diagnostics import Diagnostics, parse_recovering, check_bodies
+from grammar.parsestats import ParseStats, profiling
+from grammar.sampler import Sampler
 from grammar.operators import OperatorGrammar
+from modules import ModuleLoader, report, find_imports
+from snapshots import Snapshot, SnapshotCache
 
 
-core_parser = core_grammar.compile()
-
 op_grammar = OperatorGrammar()
 
 op_grammar.add_op('^', 'right', 8)
@@ -40,23 +57,267 @@ class Keyword:
         self.body_parser = body_parser
         self.process_fn = process_fn
 
-keywords = {'fun': process_fun}
+keywords = {'fun': process_fun, 'for': process_for, 'sparse': process_sparse, 'specialize': process_specialize,
+            'macro': process_macro}
+
+def interpret(text, emitter=None, jobs=None, code=None):
+    emitter = make_emitter('text', sys.stdout) if emitter is None else emitter
+    try:
+        with interning(NameTable()) as names:
+            text, source_map, indent_str = preprocess(text)
+            program = core_parser.parse(text, source_map=source_map, trace=False)
+            context = Context(op_parser, keywords, names, emitter, code, Stager(), Expander())
+            run_program(program, context, jobs)
+    finally:
+        emitter.close()
+        if code is not None:
+            code.close()
+
+
+def run_modules(modules, context, jobs, stats=None):
+    # with stats, the bodies a module parses as it runs are counted and budgeted too, so it runs
+    # in this process where they can be
+    jobs = jobs if stats is None else None
+    for module in modules:
+        start = time.perf_counter()
+        with profiling(stats, module.name, module.text):
+            run_program(module.program, context, jobs)
+        module.run_time = time.perf_counter() - start
+
+
+def run_prelude(prelude, context, jobs, stats=None):
+    # runs the imports with their output captured, so it can go in a snapshot and out as usual
+    emitter = context.emitter
+    context.emitter, sink = capture(emitter)
+    try:
+        run_modules(prelude, context, jobs, stats)
+        context.emitter.close()
+    finally:
+        context.emitter = emitter
+    emitter.raw(sink.getvalue())
+    return sink.getvalue()
 
-def interpret(text):
-    text, line_nums, indent_str = preprocess(text)
-    program = core_parser.parse(text, trace=False)
-    context = Context(op_parser, keywords)
-    for stmt in program:
-        if isinstance(stmt, Block):
-            context.keywords[stmt.keyword](stmt.header, stmt.body, context, context)
+
+def interpret_module(fnm, emitter=None, jobs=None, loader=None, code=None, stager=None, snapshots=None):
+    # runs fnm after everything it imports; returns the modules with their timings. with a
+    # snapshot cache, the state after the imports is saved, and later runs with the same
+    # imports start from it
+    emitter = make_emitter('text', sys.stdout) if emitter is None else emitter
+    loader = ModuleLoader(jobs=jobs) if loader is None else loader
+    stager = Stager() if stager is None else stager
+    try:
+        modules = loader.keyed(fnm)
+        prelude, main = modules[:-1], modules[-1:]
+        key, snapshot = None, None
+        if snapshots is not None and len(prelude) > 0:
+            key = snapshots.key(prelude, op_grammar.gen_grammar(), keywords, type(emitter).__name__)
+            snapshot = snapshots.load(key)
+        with interning(NameTable() if snapshot is None else snapshot.names) as names:
+            if snapshot is not None:
+                loader.parse(main)
+                context = Context(op_parser, snapshot.keywords, names, emitter, code, stager, snapshot.macros)
+                snapshot.restore(context)
+                emitter.raw(snapshot.output)
+                for module in prelude:
+                    module.status = 'snapshot'
+            else:
+                loader.parse(modules)
+                context = Context(op_parser, keywords, names, emitter, code, stager, Expander())
+                if key is not None:
+                    output = run_prelude(prelude, context, jobs, loader.stats)
+                    snapshots.store(key, Snapshot(names, stager, context.keywords, output, context.macros))
+                else:
+                    run_modules(prelude, context, jobs, loader.stats)
+            run_modules(main, context, jobs, loader.stats)
+        return modules
+    finally:
+        emitter.close()
+        if code is not None:
+            code.close()
+
+
+def check(text):
+    # every preprocessing and parse error in text, without running anything
+    imports, text = find_imports(text)
+    diagnostics = Diagnostics(text)
+    with interning(NameTable()):
+        text, source_map, indent_str = preprocess(text, diagnostics)
+        check_bodies(parse_recovering(text, source_map, diagnostics), diagnostics)
+    return diagnostics
+
+
+def find_sources(paths):
+    fnms = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                fnms += [os.path.join(root, f) for f in files if f.endswith('.on')]
         else:
-            print(cata(stmt, lambda ast: parse_ops(ast, context)))
+            fnms.append(path)
+    return sorted(set(fnms))
+
+
+def parse_budget(parse_stats=False, max_parse_steps=None, max_parse_seconds=None):
+    if parse_stats or max_parse_steps is not None or max_parse_seconds is not None:
+        return ParseStats(max_parse_steps, max_parse_seconds)
+    return None
+
+
+def report_run(modules, file, stats=None, stager=None, nodes=None, timings=False, types=False):
+    # what --timings, --parse-stats, --types and --hashcons report once a file has run
+    if timings:
+        report(modules, file)
+    if stats is not None:
+        stats.report(file)
+    if types:
+        type_report(stager, file)
+    if nodes is not None:
+        print('{} expression nodes built, {} distinct'.format(nodes.built, len(nodes)), file=file)
+
+
+def describe(fnm, e):
+    # a parse failure points at its line in the file, as --check does
+    location = getattr(e, 'location', None)
+    if location is not None:
+        return '{}:{}:{}: parse error: {}'.format(e.fnm, *location, e.message.strip().split('\n')[0])
+    return '{}: {}: {}'.format(fnm, type(e).__name__, e)
+
+
+def interpret_file(fnm, format='text', path=(), cache_dir=None, flush_every=None, snapshots=None, timings=False,
+                   parse_stats=False, max_parse_steps=None, max_parse_seconds=None, types=False, hashcons=False,
+                   cse=False):
+    # runs one file of a batch; returns its output, what it reported, and its error if it failed
+    out = io.BytesIO() if format == 'binary' else io.StringIO()
+    err = io.StringIO()
+    budget = parse_budget(parse_stats, max_parse_steps, max_parse_seconds)
+    loader = ModuleLoader(path, cache_dir, stats=budget)
+    stager = Stager(cse=cse)
+    nodes = NodeTable() if hashcons else None
+    try:
+        with hashconsing(nodes):
+            modules = interpret_module(fnm, make_emitter(format, out, flush_every), loader=loader, stager=stager,
+                                       snapshots=None if snapshots is None else SnapshotCache(snapshots))
+    except Exception as e:
+        return fnm, out.getvalue(), err.getvalue(), describe(fnm, e)
+    finally:
+        loader.close()
+    report_run(modules, err, budget if parse_stats else None, stager, nodes, timings, types)
+    return fnm, out.getvalue(), err.getvalue(), None
+
+
+def interpret_batch(fnms, jobs=None, **options):
+    # fork so workers inherit the parsers compiled at import instead of rebuilding them
+    pool = multiprocessing.get_context('fork').Pool(jobs)
+    try:
+        yield from pool.imap(partial(interpret_file, **options), fnms)
+    finally:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
     argparser = ArgumentParser()
-    argparser.add_argument('fnm', help='filename to compile')
+    argparser.add_argument('fnm', nargs='+', help='files or directories to compile')
+    argparser.add_argument('-j', '--jobs', type=int, default=None,
+                           help='number of worker processes for a batch (defaults to the cpu count), '
+                                'or for independent blocks of a single file')
+    argparser.add_argument('--format', choices=sorted(emitters), default='text', help='output format')
+    argparser.add_argument('--flush-every', type=int, default=None,
+                           help='flush output after this many statements (defaults to once at the end)')
+    argparser.add_argument('-I', '--path', action='append', default=[], help='directory to search for imports')
+    argparser.add_argument('--cache', default=None, help='directory to cache parsed modules in')
+    argparser.add_argument('--snapshots', default=None,
+                           help='directory to save the state after a file\'s imports have run in, '
+                                'so later runs with the same imports start from it')
+    argparser.add_argument('--emit-c', default=None, help='file to write C generated by keywords like sparse to')
+    argparser.add_argument('--timings', action='store_true', help='report per-module timings on stderr')
+    argparser.add_argument('--parse-stats', action='store_true',
+                           help='report per-rule backtracking and the lines causing it on stderr')
+    argparser.add_argument('--max-parse-steps', type=int, default=None,
+                           help='give up any one parse of a module or of a block body after this many rule calls')
+    argparser.add_argument('--max-parse-seconds', type=float, default=None,
+                           help='give up any one parse of a module or of a block body after this long')
+    argparser.add_argument('--types', action='store_true',
+                           help='report how much of each fun body type inference could type on stderr')
+    argparser.add_argument('--check', action='store_true',
+                           help='report every syntax error instead of running, recovering after each one')
+    argparser.add_argument('--profile-obsidian', default=None,
+                           help='sample which obsidian functions and lines are running, writing collapsed stacks '
+                                'for flame graphs to this file and a summary to stderr')
+    argparser.add_argument('--profile-interval', type=float, default=0.005, help='seconds between samples')
+    argparser.add_argument('--hashcons', action='store_true',
+                           help='build structurally equal expressions once and share them, '
+                                'reporting how many were shared on stderr')
+    argparser.add_argument('--cse', action='store_true',
+                           help='hoist repeated subexpressions of specialized functions into temporaries')
     args = argparser.parse_args()
 
-    with open(args.fnm, 'r') as f:
-        interpret(f.read())
+    fnms = find_sources(args.fnm)
+    if args.check:
+        failures = 0
+        for fnm in fnms:
+            with open(fnm) as f:
+                diagnostics = check(f.read())
+            diagnostics.report(sys.stdout, fnm)
+            failures += len(diagnostics)
+        sys.exit(1 if failures > 0 else 0)
+    if len(fnms) == 1 and not os.path.isdir(args.fnm[0]):
+        stats = parse_budget(args.parse_stats, args.max_parse_steps, args.max_parse_seconds)
+        sampler = None
+        jobs = args.jobs
+        if args.profile_obsidian is not None:
+            # forked workers aren't sampled
+            sampler = Sampler(args.profile_interval)
+            jobs = None
+        loader = ModuleLoader(args.path, args.cache, jobs, stats)
+        code = None if args.emit_c is None else SourceWriter(open(args.emit_c, 'w'))
+        stager = Stager(cse=args.cse)
+        snapshots = None if args.snapshots is None else SnapshotCache(args.snapshots)
+        nodes = NodeTable() if args.hashcons else None
+        if sampler is not None:
+            sampler.start()
+        try:
+            with hashconsing(nodes):
+                modules = interpret_module(fnms[0], make_emitter(args.format, sys.stdout, args.flush_every),
+                                           jobs, loader, code, stager, snapshots)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+        loader.close()
+        if code is not None:
+            code.sink.close()
+        report_run(modules, sys.stderr, stats if args.parse_stats else None, stager, nodes, args.timings, args.types)
+        if sampler is not None:
+            for module in modules:
+                sampler.add_file(module.source_map, module.fnm, module.text)
+            with open(args.profile_obsidian, 'w') as f:
+                sampler.write_collapsed(f)
+            sampler.report(sys.stderr)
+        sys.exit(0)
+
+    # these write one file for the whole run, which a batch of files would fight over
+    for flag, value in [('--emit-c', args.emit_c), ('--profile-obsidian', args.profile_obsidian)]:
+        if value is not None:
+            argparser.error('{} takes a single file, not a batch of {}'.format(flag, len(fnms)))
+    failures = 0
+    batch = interpret_batch(fnms, args.jobs, format=args.format, path=args.path, cache_dir=args.cache,
+                            flush_every=args.flush_every, snapshots=args.snapshots, timings=args.timings,
+                            parse_stats=args.parse_stats, max_parse_steps=args.max_parse_steps,
+                            max_parse_seconds=args.max_parse_seconds, types=args.types, hashcons=args.hashcons,
+                            cse=args.cse)
+    for fnm, output, reported, error in batch:
+        if args.format == 'binary':
+            sys.stdout.buffer.write(output)
+        else:
+            print('==> {} <=='.format(fnm))
+            sys.stdout.write(output)
+        if reported:
+            print('==> {} <=='.format(fnm), file=sys.stderr)
+            sys.stderr.write(reported)
+        if error is not None:
+            failures += 1
+            print('error: {}'.format(error), file=sys.stderr)
+        sys.stdout.flush()
+    if failures > 0:
+        print('{} of {} files failed'.format(failures, len(fnms)), file=sys.stderr)
+        sys.exit(1)
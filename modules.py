@@ -0,0 +1,192 @@
+import os
+import re
+import time
+import pickle
+import hashlib
+import multiprocessing
+from tatsu.exceptions import FailedParse
+from preprocessor import preprocess
+from grammar.fun import core_parser
+from grammar.serialize import Writer, grammar_hash, loads, load
+
+# `import a.b` on a line of its own loads a/b.on, looked up next to the importing file
+# and then along the search path
+import_line = re.compile(r'^import[ \t]+([_a-zA-Z][_a-zA-Z0-9]*(?:\.[_a-zA-Z][_a-zA-Z0-9]*)*)[ \t]*$', re.M)
+
+
+def find_imports(text):
+    # import lines are blanked rather than removed so line numbers still match the file
+    names = [match.group(1) for match in import_line.finditer(text)]
+    return names, import_line.sub('', text)
+
+
+class Module:
+    def __init__(self, fnm, name, text):
+        self.fnm = fnm
+        self.name = name
+        self.imports, self.text = find_imports(text)
+        self.deps = []
+        self.key = None
+        self.program = None
+        self.source_map = None
+        self.status = None
+        self.parse_time = 0.0
+        self.run_time = 0.0
+
+
+def parse_text(text, stats=None, label=None, fnm=None):
+    start = time.perf_counter()
+    original = text
+    try:
+        text, source_map, indent_str = preprocess(text)
+        if stats is None:
+            program = core_parser.parse(text, source_map=source_map, trace=False)
+        else:
+            program = stats.parse(core_parser, text, source_map, label, original)
+    except FailedParse as e:
+        # tatsu's position is in the preprocessed text; the failure carries where it is in the file
+        if getattr(e, 'location', None) is None:
+            e.location = source_map.location(e.pos)
+        e.fnm = fnm
+        raise
+    return program, source_map, time.perf_counter() - start
+
+
+def cache_entry(program, source_map):
+    # the AST image, followed by the source map and where each node came from, so a module read
+    # back from the cache can still be located in its file
+    writer = Writer()
+    image = writer.dumps(program)
+    spans, bodies = writer.locations()
+    return image + pickle.dumps((source_map, spans, bodies), pickle.HIGHEST_PROTOCOL)
+
+
+def read_entry(image):
+    source_map, spans, bodies = pickle.loads(image.data[image.size:])
+    image.locate(source_map, spans, bodies)
+    return image, source_map
+
+
+def parse_forked(text, fnm):
+    # runs in a forked worker; the tree comes back as a cache entry
+    program, source_map, elapsed = parse_text(text, fnm=fnm)
+    return cache_entry(program, source_map), elapsed
+
+
+class ModuleLoader:
+    def __init__(self, path=(), cache_dir=None, jobs=None, stats=None):
+        # with stats, every module is parsed here, skipping the caches, so it gets counted
+        self.path = list(path)
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        self.stats = stats
+        self.memory = {}
+        self.images = []
+
+    def resolve(self, name, importer):
+        relative = os.path.join(*name.split('.')) + '.on'
+        for root in [os.path.dirname(importer)] + self.path:
+            fnm = os.path.join(root, relative)
+            if os.path.isfile(fnm):
+                return os.path.normpath(fnm)
+        raise Exception('Cannot find module {} imported from {}'.format(name, importer))
+
+    def graph(self, fnm):
+        # modules in dependency order, each after everything it imports
+        modules = {}
+        order = []
+        visiting = []
+
+        def visit(fnm, name):
+            if fnm in visiting:
+                cycle = visiting[visiting.index(fnm):] + [fnm]
+                raise Exception('Import cycle: {}'.format(' -> '.join(cycle)))
+            if fnm in modules:
+                return modules[fnm]
+            visiting.append(fnm)
+            with open(fnm, 'r') as f:
+                module = Module(fnm, name, f.read())
+            for dep in module.imports:
+                module.deps.append(visit(self.resolve(dep, fnm), dep))
+            visiting.pop()
+            modules[fnm] = module
+            order.append(module)
+            return module
+
+        visit(os.path.normpath(fnm), '__main__')
+        return order
+
+    def cache_path(self, key):
+        return os.path.join(self.cache_dir, '{}.ast'.format(key))
+
+    def lookup(self, module):
+        if module.key in self.memory:
+            module.program, module.source_map = self.memory[module.key]
+            module.status = 'cached'
+            return True
+        if self.cache_dir is not None and os.path.exists(self.cache_path(module.key)):
+            image = load(self.cache_path(module.key))
+            self.images.append(image)
+            module.program, module.source_map = read_entry(image)
+            module.status = 'disk'
+            self.memory[module.key] = (module.program, module.source_map)
+            return True
+        return False
+
+    def store(self, module, entry=None):
+        module.status = 'parsed'
+        self.memory[module.key] = (module.program, module.source_map)
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fnm = self.cache_path(module.key)
+        with open(fnm + '.tmp', 'wb') as f:
+            f.write(cache_entry(module.program, module.source_map) if entry is None else entry)
+        os.replace(fnm + '.tmp', fnm)
+
+    def keyed(self, fnm):
+        modules = self.graph(fnm)
+        # a module's key covers its own text and its imports' keys, so editing a module
+        # invalidates it and everything that imports it, directly or not
+        ghash = grammar_hash().hex()
+        for module in modules:
+            key = [ghash, module.text] + [dep.key for dep in module.deps]
+            module.key = hashlib.blake2b('\0'.join(key).encode(), digest_size=16).hexdigest()
+        return modules
+
+    def load(self, fnm):
+        return self.parse(self.keyed(fnm))
+
+    def parse(self, modules):
+        missing = [module for module in modules if self.stats is not None or not self.lookup(module)]
+
+        # parsing doesn't depend on imports, so every missing module can be parsed at once
+        if self.jobs is not None and self.jobs > 1 and len(missing) > 1 and self.stats is None:
+            pool = multiprocessing.get_context('fork').Pool(min(self.jobs, len(missing)))
+            try:
+                results = pool.starmap(parse_forked, [(module.text, module.fnm) for module in missing])
+            finally:
+                pool.close()
+                pool.join()
+            for module, (entry, elapsed) in zip(missing, results):
+                module.program, module.source_map = read_entry(loads(entry))
+                module.parse_time = elapsed
+                self.store(module, entry)
+        else:
+            for module in missing:
+                module.program, module.source_map, module.parse_time = parse_text(
+                    module.text, self.stats, module.name, module.fnm)
+                self.store(module)
+        return modules
+
+    def close(self):
+        self.memory = {key: entry for key, entry in self.memory.items() if entry[0] not in self.images}
+        for image in self.images:
+            image.close()
+        self.images = []
+
+
+def report(modules, file):
+    for module in modules:
+        print('{:>9.1f}ms parse {:>9.1f}ms run  {:<6} {} ({})'.format(
+            module.parse_time * 1000, module.run_time * 1000, module.status, module.name, module.fnm), file=file)
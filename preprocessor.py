@@ -1,6 +1,8 @@
 import re
 import tatsu
 from tatsu.model import ModelBuilderSemantics
+from tatsu.exceptions import FailedParse
+from grammar.source import SourceMap, Rewriter
 
 comment = r'#.*\n'
 open_comment = r'#\['
@@ -37,139 +39,236 @@ class Surround:
 surround_model = tatsu.compile(surround_grammar, semantics=ModelBuilderSemantics(types=[Surround]))
 
 
-def strip_block_comments(text):
+def fail(diagnostics, message, offset, source_map):
+    # raises unless there's somewhere to collect the error so preprocessing can carry on
+    if diagnostics is None:
+        raise Exception('{} at line {}'.format(message, source_map.line(offset)))
+    diagnostics.add('preprocess', message, offset, source_map)
+
+
+def finish(rewriter, source_map):
+    text, segments = rewriter.result()
+    source_map.add_stage(segments)
+    return text
+
+
+def substitute(text, old, new, source_map):
+    rewriter = Rewriter(text)
+    kept = 0
+    pos = text.find(old)
+    while pos >= 0:
+        rewriter.keep(kept, pos)
+        rewriter.insert(pos, new)
+        kept = pos + len(old)
+        pos = text.find(old, kept)
+    rewriter.keep(kept, len(text))
+    return finish(rewriter, source_map)
+
+
+def split_lines(text):
+    offset = 0
+    for line in text.split('\n'):
+        yield offset, line
+        offset += len(line) + 1
+
+
+def strip_block_comments(text, source_map, diagnostics=None):
     depth = 0
     start = 0
+    kept = 0
+    rewriter = Rewriter(text)
     open_pattern = re.compile(open_comment)
     close_pattern = re.compile(close_comment)
     open_match = open_pattern.search(text)
     close_match = close_pattern.search(text)
-    line_nums = list(range(len(text.split('\n'))))
     while open_match is not None or close_match is not None:
-        # print('BEGIN')
-        # print(text)
-        # print('END')
         if open_match is not None and (close_match is None or open_match.start() < close_match.start()):
-            # print('Reading open match at {}; at depth {}'.format(open_match.start(), depth))
             match = open_match
             if depth == 0:
                 start = open_match.start()
             depth += 1
             open_match = open_pattern.search(text, match.end())
         else:
-            # print('Reading close match at {}; at depth {}'.format(close_match.start(), depth))
             match = close_match
             if depth == 0:
-                line_pos = text[:match.start()].count('\n')
-                line_num = line_nums[line_pos]
-                raise Exception('Too many close comments at line {}'.format(line_num + 1))
+                fail(diagnostics, 'Too many close comments', match.start(), source_map)
+                rewriter.keep(kept, match.start())
+                kept = match.end()
+                close_match = close_pattern.search(text, kept)
+                continue
             elif depth > 1:
                 close_match = close_pattern.search(text, match.end())
             else:
-                end = match.end()
-                num_lines = text[start:end].count('\n')
-                start_pos = text[:start].count('\n') + 1
-                line_nums = line_nums[:start_pos] + line_nums[start_pos + num_lines:]
-                next_start = match.start()
-                text = text[:start] + text[end:]
-                open_match = open_pattern.search(text)
-                close_match = close_pattern.search(text)
+                rewriter.keep(kept, start)
+                kept = match.end()
+                open_match = open_pattern.search(text, kept)
+                close_match = close_pattern.search(text, kept)
             depth -= 1
     if depth > 0:
-        line_num = text[:start].count('\n')
-        raise Exception('Unmatched block comment; depth at end of file {}; open comment at line {}'.format(depth, line_num + 1))
-    return text, line_nums
+        # recovers by treating the unmatched open as a line comment
+        fail(diagnostics, 'Unmatched block comment; depth at end of file {}; open comment'.format(depth),
+             start, source_map)
+    rewriter.keep(kept, len(text))
+    return finish(rewriter, source_map)
+
+
+def strip_line_comments(text, source_map):
+    rewriter = Rewriter(text)
+    kept = 0
+    for match in re.finditer(r'#[^\n]*\n', text):
+        rewriter.keep(kept, match.start())
+        kept = match.end() - 1
+    rewriter.keep(kept, len(text))
+    return finish(rewriter, source_map)
 
 
-def strip_line_comments(text):
-    return re.sub(r'#[^\n]*\n', '\n', text)
+def balanced_sections(text, source_map, diagnostics):
+    # what surround_model would give, skipping the brackets that don't pair up
+    pairs = {')': '(', ']': '[', '}': '{'}
+    stack = []
+    skipped = set()
+    for match in re.finditer(r'[(){}\[\]]', text):
+        char = match.group()
+        if char in pairs:
+            if len(stack) > 0 and text[stack[-1]] == pairs[char]:
+                stack.pop()
+            else:
+                fail(diagnostics, 'Unmatched {}'.format(char), match.start(), source_map)
+                skipped.add(match.start())
+        else:
+            stack.append(match.start())
+    for pos in stack:
+        fail(diagnostics, 'Unclosed {}'.format(text[pos]), pos, source_map)
+        skipped.add(pos)
+    sections = []
+    depth = 0
+    kept = 0
+    for match in re.finditer(r'[(){}\[\]]', text):
+        if match.start() in skipped:
+            continue
+        if match.group() in pairs:
+            depth -= 1
+            if depth == 0:
+                sections.append(Surround({'left': '', 'contents': [text[kept:match.end()]], 'right': ''}))
+                kept = match.end()
+        else:
+            if depth == 0:
+                sections.append(text[kept:match.start()])
+                kept = match.start()
+            depth += 1
+    sections.append(text[kept:])
+    return sections
 
 
-def strip_inner_newlines(text, line_nums):
-    ast = surround_model.parse(text, whitespace='')
-    stripped = ''
-    line_pos = 0
+def strip_inner_newlines(text, source_map, diagnostics=None):
+    try:
+        ast = surround_model.parse(text, whitespace='')
+    except Exception as e:
+        if diagnostics is None:
+            if isinstance(e, FailedParse):
+                # the position is in the text with comments stripped
+                e.location = source_map.location(e.pos)
+            raise
+        ast = balanced_sections(text, source_map, diagnostics)
+    rewriter = Rewriter(text)
+    kept = 0
+    pos = 0
     for section in ast:
         if isinstance(section, Surround):
             section = section.text()
-            line_nums = line_nums[:line_pos] + line_nums[line_pos + section.count('\n'):]
-            stripped += section.replace('\n', '#[INNERNEWLINE]#')
-        else:
-            stripped += section
-            line_pos += section.count('\n')
-    return stripped, line_nums
+            newline = text.find('\n', pos, pos + len(section))
+            while newline >= 0:
+                rewriter.keep(kept, newline)
+                rewriter.insert(newline, '#[INNERNEWLINE]#')
+                kept = newline + 1
+                newline = text.find('\n', kept, pos + len(section))
+        pos += len(section)
+    rewriter.keep(kept, len(text))
+    return finish(rewriter, source_map)
 
 
-def insert_outer_newlines(text):
-    return text.replace('\n', '#[ENDL]#\n')
+def insert_outer_newlines(text, source_map):
+    return substitute(text, '\n', '#[ENDL]#\n', source_map)
 
 
-def find_indent_str(text, line_nums):
-    for line, line_num in zip(text.split('\n'), line_nums):
+def find_indent_str(text, source_map, diagnostics=None):
+    # with diagnostics, a badly indented line is reported and the next indented line tried
+    for offset, line in split_lines(text):
         if re.search(r'^\s', line) is not None and re.fullmatch(r'\s', line[0]) is not None:
 
             char = line[0]
             if line[0] not in [' ', '\t']:
-                raise Exception('Invalid whitespace at line {}'.format(line_num))
+                fail(diagnostics, 'Invalid whitespace', offset, source_map)
+                continue
 
             indent_match = re.match(char + '+', line)
             whitespace_match = re.search(r'\s+', line)
 
             if not len(indent_match[0]) == len(whitespace_match[0]):
-                raise Exception('Mixed indentation at line {}'.format(line_num))
+                fail(diagnostics, 'Mixed indentation', offset + len(indent_match[0]), source_map)
+                continue
             return char * len(indent_match[0])
     return None
                 
 
-def find_indents(text, indent_str, line_nums):
+def find_indents(text, indent_str, source_map, diagnostics=None):
     lines = []
-    for line, line_num in zip(text.split('\n'), line_nums):
+    for offset, line in split_lines(text):
         if re.search(r'^\s', line) is not None and re.fullmatch(r'\s', line[0]) is not None:
             whitespace_match = re.match(r'\s+', line)
             indent_match = re.fullmatch(indent_str + '+', whitespace_match[0])
             if indent_match is None:
-                raise Exception('Invalid indentation at line {}'.format(line_num))
+                # recovers with however many whole indents the line starts with
+                fail(diagnostics, 'Invalid indentation', offset, source_map)
+                indent_match = re.match('(?:{})*'.format(re.escape(indent_str)), whitespace_match[0])
+                lines.append((int(indent_match.end() / len(indent_str)), offset + whitespace_match.end()))
+                continue
             num_indents = int(len(whitespace_match[0]) / len(indent_str))
-            line = (num_indents, indent_match.end(), line)
+            line = (num_indents, offset + indent_match.end())
         else:
-            line = (0, 0, line)
+            line = (0, offset)
         lines.append(line)
     return lines
 
 
-def insert_dedents(lines):
-    indented_lines = []
+def insert_dedents(text, lines, source_map):
+    rewriter = Rewriter(text)
+    kept = 0
     indent_level = 0
-    for num_indents, line_start, line in lines:
+    for num_indents, line_start in lines:
+        if num_indents != indent_level:
+            rewriter.keep(kept, line_start)
+            kept = line_start
         if num_indents > indent_level:
-            line = line[:line_start] + '#[INDENT]#' * (num_indents - indent_level) + line[line_start:]
+            rewriter.insert(line_start, '#[INDENT]#' * (num_indents - indent_level))
         elif num_indents < indent_level:
-            line = line[:line_start] + '#[DEDENT]#' * (indent_level - num_indents) + line[line_start:]
-        indented_lines.append(line)
+            rewriter.insert(line_start, '#[DEDENT]#' * (indent_level - num_indents))
         indent_level = num_indents
-    indented_lines[-1] += '#[DEDENT]#' * indent_level
-    return '\n'.join(indented_lines)
+    rewriter.keep(kept, len(text))
+    rewriter.insert(len(text), '#[DEDENT]#' * indent_level)
+    return finish(rewriter, source_map)
 
 
-def insert_indents(text, line_nums):
-    indent_str = find_indent_str(text, line_nums)
+def insert_indents(text, source_map, diagnostics=None):
+    indent_str = find_indent_str(text, source_map, diagnostics)
     if indent_str is None:
         return text, ''
-    lines = find_indents(text, indent_str, line_nums)
-    text = insert_dedents(lines)
+    lines = find_indents(text, indent_str, source_map, diagnostics)
+    text = insert_dedents(text, lines, source_map)
     return text, indent_str
 
 
-def replace_newlines(text):
-    return text.replace('#[INNERNEWLINE]#', '\n')
-
+def replace_newlines(text, source_map):
+    return substitute(text, '#[INNERNEWLINE]#', '\n', source_map)
 
-def preprocess(text):
-    text, line_nums = strip_block_comments(text)
-    text = strip_line_comments(text)
-    text, noendl_line_nums = strip_inner_newlines(text, line_nums)
-    text = insert_outer_newlines(text)
-    text, indent_str = insert_indents(text, noendl_line_nums)
-    text = replace_newlines(text)
-    return text, line_nums, indent_str
 
+def preprocess(text, diagnostics=None):
+    # errors are collected in diagnostics when given, otherwise the first one is raised
+    source_map = SourceMap(text)
+    text = strip_block_comments(text, source_map, diagnostics)
+    text = strip_line_comments(text, source_map)
+    text = strip_inner_newlines(text, source_map, diagnostics)
+    text = insert_outer_newlines(text, source_map)
+    text, indent_str = insert_indents(text, source_map, diagnostics)
+    text = replace_newlines(text, source_map)
+    return text, source_map, indent_str
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import traceback
+import socketserver
+from collections import deque
+from argparse import ArgumentParser
+from client import RUN, HEALTH, OUT, ERR, EXIT, FrameWriter, default_socket, recv_frame, send_frame
+from interpreter import interpret_module
+from modules import ModuleLoader
+
+
+def timed_out(signum, frame):
+    raise Exception('Request timed out')
+
+
+class InterpretHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        kind, payload = recv_frame(self.request)
+        if kind == HEALTH:
+            self.health()
+        elif kind == RUN:
+            self.run(json.loads(payload.decode()))
+        else:
+            send_frame(self.request, ERR, 'Unknown request {}\n'.format(kind).encode())
+            send_frame(self.request, EXIT, b'2')
+
+    def health(self):
+        server = self.server
+        status = {
+            'status': 'ok',
+            'pid': server.pid,
+            'uptime': time.time() - server.started,
+            'served': server.served,
+            'active': len(server.active_children or ()),
+            'waiting': len(server.waiting),
+            'max_children': server.max_children,
+        }
+        send_frame(self.request, OUT, json.dumps(status).encode())
+        send_frame(self.request, EXIT, b'0')
+
+    def run(self, request):
+        # each request runs in its own forked child, so rebinding stdout is safe
+        sys.stdout = FrameWriter(self.request, OUT)
+        sys.stderr = FrameWriter(self.request, ERR)
+        if self.server.timeout_secs is not None:
+            signal.signal(signal.SIGALRM, timed_out)
+            signal.alarm(self.server.timeout_secs)
+        status = 0
+        # imports are found next to the file, then along the client's path and the server's
+        loader = ModuleLoader(request.get('path', []) + self.server.path, self.server.cache_dir)
+        try:
+            interpret_module(request['fnm'], loader=loader)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            loader.close()
+        signal.alarm(0)
+        send_frame(self.request, EXIT, str(status).encode())
+
+
+class InterpretServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    # how long to wait for a new connection's first byte before forking for it anyway
+    peek_timeout = 1.0
+
+    def __init__(self, path, max_children=8, timeout_secs=None, import_path=(), cache_dir=None):
+        self.max_children = max_children
+        self.timeout_secs = timeout_secs
+        self.path = list(import_path)
+        self.cache_dir = cache_dir
+        self.started = time.time()
+        self.served = 0
+        self.pid = os.getpid()
+        # requests that came in while every child was busy
+        self.waiting = deque()
+        super().__init__(path, InterpretHandler)
+
+    def kind(self, request):
+        request.settimeout(self.peek_timeout)
+        try:
+            return request.recv(1, socket.MSG_PEEK)
+        except socket.timeout:
+            return None
+        finally:
+            request.settimeout(None)
+
+    def process_request(self, request, client_address):
+        # health checks are answered here rather than in a child, so they get through while every
+        # child is busy; anything else waits for a free child
+        self.served += 1
+        if self.kind(request) == HEALTH:
+            request.settimeout(self.peek_timeout)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+        elif len(self.active_children or ()) >= self.max_children:
+            self.waiting.append((request, client_address))
+        else:
+            super().process_request(request, client_address)
+
+    def collect_children(self, *, blocking=False):
+        # reaps the children that have exited, only waiting for them when the server is closing,
+        # so the loop stays free to answer health checks
+        for pid in list(self.active_children or ()):
+            try:
+                done, status = os.waitpid(pid, 0 if blocking else os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done == pid:
+                self.active_children.discard(pid)
+
+    def service_actions(self):
+        super().service_actions()
+        while len(self.waiting) > 0 and len(self.active_children or ()) < self.max_children:
+            super().process_request(*self.waiting.popleft())
+
+    def server_close(self):
+        for request, client_address in self.waiting:
+            self.shutdown_request(request)
+        self.waiting.clear()
+        super().server_close()
+
+
+def serve(path=None, max_children=8, timeout_secs=None, import_path=(), cache_dir=None):
+    path = default_socket() if path is None else path
+    if os.path.exists(path):
+        os.unlink(path)
+    server = InterpretServer(path, max_children, timeout_secs, import_path, cache_dir)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # waiting requests start from service_actions, which runs once per poll
+        server.serve_forever(poll_interval=0.05)
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    argparser = ArgumentParser()
+    argparser.add_argument('--socket', default=None, help='path of the server socket')
+    argparser.add_argument('--max-children', type=int, default=8, help='maximum concurrent requests')
+    argparser.add_argument('--timeout', type=int, default=None, help='seconds before a request is killed')
+    argparser.add_argument('-I', '--path', action='append', default=[], help='directory to search for imports')
+    argparser.add_argument('--cache', default=None, help='directory to cache parsed modules in')
+    args = argparser.parse_args()
+
+    serve(args.socket, args.max_children, args.timeout, args.path, args.cache)
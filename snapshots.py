@@ -0,0 +1,90 @@
+import os
+import glob
+import pickle
+import hashlib
+
+# a snapshot is the interpreter's state once a program's imports have run: the name table, the
+# stager's functions and specializations, the keywords and macros, and what the imports emitted. a later run
+# importing the same modules starts from it instead of running them again. snapshots are keyed on
+# the imports' module keys and on the interpreter's own source, so editing either invalidates them
+
+SNAPSHOT_VERSION = 1
+
+root = os.path.dirname(os.path.abspath(__file__))
+interpreter_sources = ['interpreter.py', 'modules.py', 'preprocessor.py', 'snapshots.py', os.path.join('grammar', '*.py')]
+interpreter_digest = None
+
+
+def interpreter_hash():
+    global interpreter_digest
+    if interpreter_digest is None:
+        digest = hashlib.blake2b(str(SNAPSHOT_VERSION).encode(), digest_size=16)
+        for pattern in interpreter_sources:
+            for fnm in sorted(glob.glob(os.path.join(root, pattern))):
+                with open(fnm, 'rb') as f:
+                    digest.update(os.path.relpath(fnm, root).encode() + b'\0' + f.read() + b'\0')
+        interpreter_digest = digest.hexdigest()
+    return interpreter_digest
+
+
+class Snapshot:
+    # what the stager knows is kept, not the stager, so a run keeps its own stager's settings
+    kept = ['funs', 'specs', 'specs_of', 'cache', 'bodies']
+
+    def __init__(self, names, stager, keywords, output, macros=None):
+        self.names = names
+        self.definitions = {attr: getattr(stager, attr) for attr in self.kept}
+        self.keywords = keywords
+        self.output = output
+        self.macros = macros
+
+    def restore(self, context):
+        for attr, value in self.definitions.items():
+            setattr(context.stager, attr, value)
+        # functions defined by the imports run in the context of the run that loaded them
+        for fun in context.stager.funs.values():
+            fun.context = context
+
+
+# what unpickling a damaged file can raise, depending on where the damage is
+unreadable = (pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, KeyError,
+              TypeError, ValueError, MemoryError)
+
+
+class SnapshotCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, modules, operators, keywords, format):
+        parts = [interpreter_hash(), operators, ' '.join(sorted(keywords)), format] + [m.key for m in modules]
+        return hashlib.blake2b('\0'.join(parts).encode(), digest_size=16).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{}.snapshot'.format(key))
+
+    def load(self, key):
+        fnm = self.path(key)
+        if not os.path.exists(fnm):
+            return None
+        try:
+            with open(fnm, 'rb') as f:
+                snapshot = pickle.load(f)
+        except unreadable:
+            snapshot = None
+        if not isinstance(snapshot, Snapshot):
+            # a truncated or corrupt snapshot is thrown away, and the run rebuilds it
+            try:
+                os.remove(fnm)
+            except FileNotFoundError:
+                pass
+            return None
+        return snapshot
+
+    def store(self, key, snapshot):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fnm = self.path(key)
+        # batch workers may store the same snapshot at once, so each writes its own temporary file
+        tmp = '{}.{}.tmp'.format(fnm, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fnm)
@@ -0,0 +1,179 @@
+import gc
+import sys
+import math
+import time
+import pytest
+import preprocessor
+from preprocessor import preprocess
+from interpreter import op_parser, keywords
+from grammar.fun import core_parser, parse_ops
+from grammar.model import Block, Identifier, UnaryExpr, Op, Int, PartialBinaryExpr, cata
+from grammar.context import Context
+from grammar.source import SourceMap
+
+# each stage is run on inputs that grow geometrically along one axis at a time, and the slope of
+# log time against log size is checked against the exponent the stage is allowed. a stage that
+# scales worse than declared fails its test
+
+steps = 4
+repeat = 3
+tolerance = 0.4
+# each timing runs a stage often enough to take at least this long, so fast stages fit above noise
+min_time = 0.002
+
+
+def lines(n):
+    return ''.join('x{0} = {0} + 1\n'.format(i) for i in range(n))
+
+
+def nested(n):
+    # n blocks each indented one deeper than the last
+    return ''.join('{}fun f{}(x)\n'.format('    ' * i, i) for i in range(n)) + '    ' * n + 'x\n'
+
+
+def comments(n):
+    return ''.join('#[ block {} ]# x{} = 1 # line {}\n'.format(i, i, i) for i in range(n))
+
+
+def nested_comments(n):
+    return '#[ ' * n + 'x' + ' ]#' * n + '\ny = 1\n'
+
+
+def bracketed(n):
+    # one bracket spanning n lines, the line_nums slicing in strip_inner_newlines
+    return 'x = [\n' + ''.join('    {},\n'.format(i) for i in range(n)) + ']\n'
+
+
+def chain(n):
+    ops = ['+', '*', '-', '/']
+    return 'x = ' + ' '.join('{} {}'.format(i, ops[i % 4]) for i in range(n)) + ' 1\n'
+
+
+def staged(fn):
+    # a preprocessor stage on the text as it arrives at that stage
+    def run(text):
+        return fn(text, SourceMap(text))
+    return run
+
+
+def indents(text):
+    source_map = SourceMap(text)
+    return preprocessor.insert_indents(preprocessor.insert_outer_newlines(text, source_map), source_map)
+
+
+def parse(text):
+    processed, source_map, indent_str = preprocess(text)
+    return lambda: core_parser.parse(processed, source_map=source_map, trace=False)
+
+
+def ops_input(n):
+    exprs = [Int(str(i)) for i in range(n + 1)]
+    elems = [exprs[0]]
+    for i in range(n):
+        elems += [Op('+*-/'[i % 4]), exprs[i + 1]]
+    return PartialBinaryExpr(elems)
+
+
+def unary_input(n):
+    expr = Identifier('x')
+    for i in range(n):
+        expr = UnaryExpr('-', expr)
+    return expr
+
+
+def nest_blocks(n):
+    # what the block semantics build for n nested blocks, innermost first
+    block = Block(Identifier('fun'), ['f', '(x)'], [['x']])
+    for i in range(n - 1):
+        block = Block(Identifier('fun'), ['f', '(x)'], [block])
+    return block
+
+
+context = Context(op_parser, keywords)
+
+# (stage, axis, make input of size n, function of that input, allowed exponent, sizes)
+cases = [
+    ('strip_block_comments', 'comments', comments, staged(preprocessor.strip_block_comments), 1, 500),
+    ('strip_block_comments', 'depth', nested_comments, staged(preprocessor.strip_block_comments), 1, 500),
+    ('strip_line_comments', 'comments', comments, staged(preprocessor.strip_line_comments), 1, 500),
+    ('strip_inner_newlines', 'lines', lines, staged(preprocessor.strip_inner_newlines), 1, 500),
+    ('strip_inner_newlines', 'bracketed lines', bracketed, staged(preprocessor.strip_inner_newlines), 1, 500),
+    ('insert_outer_newlines', 'lines', lines, staged(preprocessor.insert_outer_newlines), 1, 500),
+    ('insert_indents', 'lines', lines, indents, 1, 500),
+    ('insert_indents', 'depth', nested, indents, 1, 50),
+    ('replace_newlines', 'lines', lines, staged(preprocessor.replace_newlines), 1, 500),
+    ('preprocess', 'lines', lines, preprocess, 1, 500),
+    ('preprocess', 'depth', nested, preprocess, 1, 50),
+    ('preprocess', 'chain', chain, preprocess, 1, 500),
+    ('core parse', 'lines', lambda n: parse(lines(n)), lambda run: run(), 1, 25),
+    ('core parse', 'depth', lambda n: parse(nested(n)), lambda run: run(), 1, 8),
+    ('core parse', 'chain', lambda n: parse(chain(n)), lambda run: run(), 1, 25),
+    ('parse_ops', 'chain', ops_input, lambda ast: parse_ops(ast, context), 1, 25),
+    ('cata', 'depth', unary_input, lambda ast: cata(ast, lambda node: node), 1, 50),
+    ('cata', 'statements', lambda n: [unary_input(2) for i in range(n)], lambda ast: cata(ast, lambda node: node), 1, 500),
+    ('cata', 'blocks', lambda n: [nest_blocks(2) for i in range(n)], lambda ast: cata(ast, lambda node: node), 1, 500),
+    ('cata', 'block depth', nest_blocks, lambda ast: cata(ast, lambda node: node), 1, 50),
+    ('Block', 'lines', lambda n: [['x', '=', str(i)] for i in range(n)],
+     lambda body: Block(Identifier('fun'), ['f', '(x)'], body), 1, 500),
+    # every level of a block keeps the text of the levels inside it
+    ('Block', 'depth', lambda n: n, nest_blocks, 2, 50),
+]
+
+
+def calls_per_timing(fn, value):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            fn(value)
+        if time.perf_counter() - start >= min_time:
+            return number
+        number *= 2
+
+
+def measure(fn, value, number, repeat):
+    best = None
+    # collections landing in some runs and not others would skew the fit
+    gc.disable()
+    try:
+        for i in range(repeat):
+            start = time.perf_counter()
+            for j in range(number):
+                fn(value)
+            elapsed = (time.perf_counter() - start) / number
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    return best
+
+
+def slope(sizes, times):
+    # least squares fit of log time against log size
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(t) for t in times]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sum((x - mx) ** 2 for x in xs)
+
+
+def exponent(make, fn, base, repeat):
+    sizes = [base * 2 ** i for i in range(steps)]
+    inputs = [make(n) for n in sizes]
+    number = calls_per_timing(fn, inputs[0])
+    return slope(sizes, [measure(fn, value, number, repeat) for value in inputs])
+
+
+@pytest.mark.parametrize('stage, axis, make, fn, allowed, base', cases, ids=['{} ({})'.format(*c[:2]) for c in cases])
+def test_scaling(stage, axis, make, fn, allowed, base):
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    fit = exponent(make, fn, base, repeat)
+    if fit > allowed + tolerance:
+        # a busy machine can bend one fit, so a stage only fails if a second, longer fit agrees
+        fit = min(fit, exponent(make, fn, base, repeat * 3))
+    assert fit <= allowed + tolerance, '{} scales as n^{:.2f} in {}, allowed n^{}'.format(stage, fit, axis, allowed)
+
+
+def test_catches_quadratic():
+    # the fit itself has to tell a quadratic stage from a linear one
+    quadratic = lambda n: [i * j for i in range(n) for j in range(n)]
+    assert exponent(lambda n: n, quadratic, 50, repeat) > 1 + tolerance
@@ -0,0 +1,50 @@
+import io
+import os
+from modules import ModuleLoader
+from grammar.emit import BinaryEmitter, TextEmitter, read_frames
+from grammar.serialize import dumps, loads
+
+# trees read back from the module cache are lazy subclasses of the model classes, and have to
+# write out again as the nodes they stand for
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def cached(tmp_path, name):
+    fnm = os.path.join(here, name)
+    ModuleLoader(cache_dir=str(tmp_path)).load(fnm)
+    loader = ModuleLoader(cache_dir=str(tmp_path))
+    modules = loader.load(fnm)
+    assert modules[-1].status == 'disk'
+    return loader, modules[-1].program
+
+
+def text(stmts):
+    out = io.StringIO()
+    emitter = TextEmitter(out)
+    for stmt in stmts:
+        emitter.emit(stmt)
+    emitter.close()
+    return out.getvalue()
+
+
+def test_cached_image_round_trips(tmp_path):
+    loader, program = cached(tmp_path, 'deconstruct.on')
+    try:
+        again = loads(dumps(list(program)))
+        assert text(again) == text(program)
+    finally:
+        loader.close()
+
+
+def test_cached_image_emits_binary(tmp_path):
+    loader, program = cached(tmp_path, 'deconstruct.on')
+    try:
+        out = io.BytesIO()
+        emitter = BinaryEmitter(out)
+        for stmt in program:
+            emitter.emit(stmt)
+        emitter.close()
+        assert text(read_frames(out.getvalue())) == text(program)
+    finally:
+        loader.close()